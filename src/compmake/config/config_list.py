@@ -8,17 +8,20 @@ __all__ = [
     'CONFIG_GENERAL',
     'CONFIG_APPEARANCE',
     'CONFIG_PARALLEL',
+    'CONFIG_STORAGE',
 ]
 
 CONFIG_GENERAL = 'General configuration'
 CONFIG_APPEARANCE = 'Visualization'
 CONFIG_PARALLEL = 'Multiprocessing backend'
 CONFIG_MULTYVAC = 'Multyvac backend'
+CONFIG_STORAGE = 'Storage'
 
 add_config_section(name=CONFIG_GENERAL, desc='', order=-1)
 add_config_section(name=CONFIG_APPEARANCE, desc='', order=2)
 add_config_section(name=CONFIG_PARALLEL, desc='', order=3)
 add_config_section(name=CONFIG_MULTYVAC, desc='', order=4)
+add_config_section(name=CONFIG_STORAGE, desc='', order=1)
 
 add_config_switch('recurse', False,
                   desc="Default choice for parmake and make whether to run "
@@ -32,11 +35,25 @@ add_config_switch('new_process', False,
 
 add_config_switch('check_params', False,
                   desc="If true, erases the cache if job parameters appear "
-                       "to change.",
+                       "to change. (The old parameters are loaded only if "
+                       "their digest differs.)",
                   # Very useful but you need to define __eq__() in all the
                   # objects you use as parameters.",
                   section=CONFIG_GENERAL)
 
+add_config_switch('code_fingerprints', False,
+                  desc="Remake the jobs whose function changed: the code "
+                       "of the functions (and of the module-level functions "
+                       "they call) is fingerprinted when the jobs are "
+                       "defined.",
+                  section=CONFIG_GENERAL)
+
+add_config_switch('early_cutoff', False,
+                  desc="Record the digests of the job results, and do not "
+                       "remake a job whose dependencies were remade with "
+                       "the same results as before.",
+                  section=CONFIG_GENERAL)
+
 add_config_switch('manager_wait', 0.1,
                   desc="Sleep time, in seconds, to wait if no job has finished. ",
 #                   "Low value gives responsiveness but higher CPU usage",
@@ -97,6 +114,20 @@ add_config_switch('max_parallel_jobs', cpu_count(),
                        "cpu_count().",
                   section=CONFIG_PARALLEL)
 
+add_config_switch('worker_prefetch', 256,
+                  desc="The parmake workers read the arguments and the "
+                       "dependencies of their next job while computing, "
+                       "up to this size (MB; 0 disables it).",
+                  section=CONFIG_PARALLEL)
+
+add_config_switch('shared_results', 0,
+                  desc="The parmake workers hand the results with large "
+                       "buffers (e.g. NumPy arrays) to the jobs that use "
+                       "them in shared memory, up to this size in total "
+                       "(MB; 0 disables it). Needs Python >= 3.8; the "
+                       "arrays received are read-only.",
+                  section=CONFIG_PARALLEL)
+
 if False: # To re-implement
     add_config_switch('max_mem_load', 90.0,
                       desc="Maximum physical memory load (%)",
@@ -144,3 +175,102 @@ add_config_switch('multyvac_sync_up', '',
 add_config_switch('multyvac_core', 'c2',
                       desc="Multyvac core (c1,c2,f2)",
                       section=CONFIG_MULTYVAC)
+
+add_config_switch('db_backend', 'filesystem',
+                  desc="Storage backend used when creating a new DB: "
+                       "'filesystem' (one file per record), 'sqlite' "
+                       "(one WAL-mode SQLite file) or 'segments' (records "
+                       "appended to segment files; see the command "
+                       "compact).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('db_layout', 'flat',
+                  desc="Directory layout used when creating a new filesystem "
+                       "DB: 'flat' or 'sharded' (<db>/ab/cd/<key>, for DBs "
+                       "with many jobs). Use migrate_layout for existing DBs.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('serializer', 'pickle',
+                  desc="Serializer for the records in the DB: 'pickle' "
+                       "(highest protocol, up to 5), 'cloudpickle', 'dill' "
+                       "or 'msgpack' (compact; needs the package installed).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('serializers', '',
+                  desc="Serializer per key type, overriding 'serializer'; "
+                       "for example 'cm-job:msgpack,cm-cache:msgpack'. "
+                       "Key types: cm-job, cm-cache, cm-args, cm-res, "
+                       "cm-logs.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('compression', 'auto',
+                  desc="Compression of the records in compressed DBs: "
+                       "'auto' (fastest available: lz4, zstd, zlib), "
+                       "'none', or a codec with optional level, such as "
+                       "'zstd:19', 'zlib:9', 'lzma' (slower, smaller).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('compression_threshold', 4096,
+                  desc="Records smaller than this (bytes, after "
+                       "serialization) are not compressed.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('dedup_results', False,
+                  desc="Store identical job results only once, in a "
+                       "content-addressed store (cm-blob-<digest>).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('memory_cache', 64,
+                  desc="Size (MB) of the in-memory cache of the job records "
+                       "(cm-job, cm-cache, small results); 0 disables it.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('memory_cache_max_result', 65536,
+                  desc="Results larger than this (bytes, in the DB) are not "
+                       "kept in the in-memory cache.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('db_threads', 8,
+                  desc="Threads used to read many records at once "
+                       "(db.get_many()); 1 disables the parallel reads.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('job_index', True,
+                  desc="Keep the state, command and timings of the jobs in "
+                       "<db>/.compmake-jobs.sqlite, used by 'stats' and by "
+                       "aliases such as $failed.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('graph_index', True,
+                  desc="Keep the relations between the jobs (children, "
+                       "parents, jobs defined) in "
+                       "<db>/.compmake-graph.sqlite, used by the queries "
+                       "on the dependencies.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('durability', 'none',
+                  desc="When the records are fsync()ed: 'none' (never), "
+                       "'batch' (together, after each job and every "
+                       "durability_interval ms) or 'strict' (each record "
+                       "before the write returns).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('durability_interval', 1000,
+                  desc="With durability 'batch', the maximum time (ms) "
+                       "between the fsync()s while writing.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('storage_server_cache', 256,
+                  desc="Size (MB) of the cache of the storage server "
+                       "(command storage-server).",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('storage_server_max_result', 16 * 1024 * 1024,
+                  desc="Results larger than this (bytes, in the DB) are not "
+                       "kept in the cache of the storage server.",
+                  section=CONFIG_STORAGE)
+
+add_config_switch('storage_server_connect', False,
+                  desc="If a storage server is running for the DB, use it "
+                       "instead of opening the DB directly.",
+                  section=CONFIG_STORAGE)
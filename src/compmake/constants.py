@@ -12,6 +12,8 @@ class CompmakeConstants(object):
     job_id_key = 'job_id'
     extra_dep_key = 'extra_dep'
     command_name_key = 'command_name'
+    serializer_key = 'serializer'
+    lazy_deps_key = 'lazy_deps'
 
     # Compmake returns:
     # 0                      if everything all right
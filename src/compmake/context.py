@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+from contextlib import contextmanager
+
 import six
 
 from contracts import contract
@@ -11,30 +13,46 @@ __all__ = [
 
 
 class Context(object):
-    @contract(db='None|str|isinstance(StorageFilesystem)',
+    @contract(db='None|str|isinstance(StorageFilesystem)|'
+                 'isinstance(StorageSQLite)|isinstance(StorageSegments)|'
+                 'isinstance(MemoryCache)|isinstance(StorageClient)',
               currently_executing='None|list(str)')
     def __init__(self, db=None, currently_executing=None):
         """
-            db: if a string, it is used as path for the DB
+            db: if a string, it is used as path for the DB; the backend
+                is detected for an existing DB, or chosen with the
+                config switch ``db_backend`` for a new one.
             
             currently_executing: str, job currently executing
                 defaults to ['root']
+
+            Unless it is already one, the DB is wrapped in a MemoryCache
+            (config switch ``memory_cache``); not a StorageClient, whose
+            server keeps the cache.
         """
         if currently_executing is None:
             currently_executing = ['root']
-        from compmake import StorageFilesystem
+        from compmake.storage import MemoryCache, open_storage
 
         if db is None:
             prog, _ = os.path.splitext(os.path.basename(sys.argv[0]))
 
             # logger.info('Context(): Using default storage dir %r.' % prog)
             dirname = 'out-%s' % prog
-            db = StorageFilesystem(dirname, compress=True)
+            db = open_storage(dirname, compress=True)
 
         if isinstance(db, six.string_types):
-            db = StorageFilesystem(db, compress=True)
+            db = open_storage(db, compress=True)
 
         assert db is not None
+        if (not isinstance(db, MemoryCache) and
+                hasattr(db, 'cache_token')):
+            from compmake import get_compmake_config
+            max_mb = get_compmake_config('memory_cache')
+            if max_mb > 0:
+                max_result = get_compmake_config('memory_cache_max_result')
+                db = MemoryCache(db, max_bytes=int(max_mb * 1024 * 1024),
+                                 max_result_bytes=max_result)
         self.compmake_db = db
         self._jobs_defined_in_this_session = set()
         self.currently_executing = currently_executing
@@ -46,6 +64,9 @@ class Context(object):
         # counters for prefixes (generate_job_id)
         self.generate_job_id_counters = {}
 
+        # 'new', 'changed', 'unchanged' -> number of jobs defined
+        self.definition_counts = {}
+
     # This is used to make sure that the user doesn't define the same job
     # twice.
     @contract(job_id=str)
@@ -63,9 +84,47 @@ class Context(object):
         """ Called only when initializing the context. """
         self._jobs_defined_in_this_session = set(jobs)
 
+    def count_job_definition(self, what):
+        """ Counts a job defined: 'new', 'changed' or 'unchanged'. """
+        self.definition_counts[what] = self.definition_counts.get(what, 0) + 1
+
+    def pop_definition_counts(self):
+        """ Returns the counts of the jobs defined since the last
+            call. """
+        counts = self.definition_counts
+        self.definition_counts = {}
+        return counts
+
     def get_compmake_db(self):
         return self.compmake_db
 
+    @contextmanager
+    def batch_definitions(self):
+        """
+            Within this block, the jobs defined are kept in memory and
+            written to the DB at the end, all at once::
+
+                with context.batch_definitions():
+                    for i in range(100000):
+                        context.comp(f, i)
+
+            The final state of the DB is the same. This is done
+            automatically while a dynamic job (``comp_dynamic``) runs.
+        """
+        from compmake.storage import BatchDB
+        db = self.compmake_db
+        if isinstance(db, BatchDB):
+            # already batching
+            yield
+            return
+        self.compmake_db = BatchDB(db)
+        try:
+            yield
+        finally:
+            batch = self.compmake_db
+            self.compmake_db = db
+            batch.flush()
+
     def get_comp_prefix(self):
         return self._job_prefix
 
@@ -95,12 +95,14 @@ def clean_cache_relations(job_id, db):
                 # print('     changed in %s' % parent_job.children)
 
 
-def mark_to_remake(job_id, db):
-    """ Delets and invalidates the cache for this object """
+def mark_to_remake(job_id, db, reason=None):
+    """ Delets and invalidates the cache for this object.
+        ``reason`` is shown by the command "why". """
     # TODO: think of the difference between this and clean_target
     cache = get_job_cache(job_id, db)
     if cache.state == Cache.DONE:
         cache.timestamp = Cache.TIMESTAMP_TO_REMAKE
+        cache.remake_reason = reason
     set_job_cache(job_id, cache, db=db)
 
 
@@ -125,6 +127,17 @@ def mark_as_failed(job_id, exception=None, backtrace=None, db=None):
     set_job_cache(job_id, cache, db=db)
 
 
+def dependencies_digests(job, db):
+    """ Returns a dict job_id -> result_digest for the dependencies of
+        the job whose result has a digest. """
+    res = {}
+    for child in job.children:
+        digest = getattr(get_job_cache(child, db=db), 'result_digest', None)
+        if digest is not None:
+            res[child] = digest
+    return res
+
+
 def make(job_id, context, echo=False):  # @UnusedVariable
     """
         Makes a single job.
@@ -165,6 +178,11 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     job = get_job(job_id, db=db)
     cache = get_job_cache(job_id, db=db)
 
+    if get_compmake_config('early_cutoff'):
+        hashes_dependencies = dependencies_digests(job, db)
+    else:
+        hashes_dependencies = {}
+
     if cache.state == Cache.DONE:
         prev_defined_jobs = set(cache.jobs_defined)
         # print('%s had previously defined %s' % (job_id, prev_defined_jobs))
@@ -249,13 +267,14 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     try:
         result = job_compute(job=job, context=context)
 
-        assert isinstance(result, dict) and len(result) == 5
+        assert isinstance(result, dict) and len(result) == 6
         user_object = result['user_object']
         new_jobs = result['new_jobs']
         int_load_results = result['int_load_results']
         int_compute = result['int_compute']
         int_gc = result['int_gc']
         int_gc.stop()
+        prefetch = result['prefetch']
 
     except KeyboardInterrupt as e:
         bt = traceback.format_exc()
@@ -333,7 +352,10 @@ def make(job_id, context, echo=False):  # @UnusedVariable
 
     # print('Now %s has deleted %s' % (job_id, deleted_jobs))
 
-    set_job_userobject(job_id, user_object, db=db)
+    # (jobs in old DBs do not have the attribute)
+    serializer = getattr(job, 'serializer', None)
+    digest = set_job_userobject(job_id, user_object, db=db,
+                                serializer=serializer)
     int_save_results.stop()
 
     #    logger.debug('Save time for %s: %s s' % (job_id, walltime_save_result))
@@ -355,6 +377,8 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     cache.int_compute = int_compute
     cache.int_gc = int_gc
     cache.int_save_results = int_save_results
+    if prefetch is not None:
+        cache.prefetch_hits, cache.prefetch_misses = prefetch
 
     cache.timestamp = end_time
 
@@ -362,6 +386,8 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     cache.cputime_used = int_make.get_cputime_used()
     cache.host = host
     cache.jobs_defined = new_jobs
+    cache.result_digest = digest
+    cache.hashes_dependencies = hashes_dependencies
     set_job_cache(job_id, cache, db=db)
 
     return dict(user_object=user_object,
@@ -13,9 +13,10 @@ __all__ = [
 ]
 
 
-def get_job_userobject_resolved(job_id, db):
+def get_job_userobject_resolved(job_id, db, lazy=False):
     """ This gets the job's result, and recursively substitute all
-    dependencies. """
+    dependencies. If lazy is True, the dependencies are substituted
+    with proxies that load them when used (see lazy_deps.py). """
     ob = get_job_userobject(job_id, db)
     all_deps = collect_dependencies(ob)
     for dep in all_deps:
@@ -23,10 +24,15 @@ def get_job_userobject_resolved(job_id, db):
             msg = 'Cannot resolve %r: dependency %r was not done.' % (
             job_id, dep)
             raise CompmakeBug(msg)
+    if lazy:
+        from .lazy_deps import LazyLoader
+        return substitute_dependencies(ob, db, loader=LazyLoader(db))
     return substitute_dependencies(ob, db)
 
 
-def substitute_dependencies(a, db):
+def substitute_dependencies(a, db, loader=None):
+    """ Substitutes the promises with the results of the jobs; if a
+        LazyLoader is given, with proxies that load them when used. """
     from compmake import Promise
 
     # XXX: this is a workaround
@@ -35,7 +41,8 @@ def substitute_dependencies(a, db):
     
     if isinstance(a, dict):
         ca = type(a)
-        rest = [(k, substitute_dependencies(v, db=db)) for k, v in a.items()]
+        rest = [(k, substitute_dependencies(v, db=db, loader=loader))
+                for k, v in a.items()]
         try:
             res = ca(rest)
             #print('%s->%s' % (a, str(res)))
@@ -46,7 +53,8 @@ def substitute_dependencies(a, db):
 
     elif isinstance(a, list):
         # XXX: This fails for subclasses of list
-        return type(a)([substitute_dependencies(x, db=db) for x in a])
+        return type(a)([substitute_dependencies(x, db=db, loader=loader)
+                        for x in a])
     elif isinstance(a, tuple):
         # First, check that there are dependencies
         deps_in_tuple = collect_dependencies(a)
@@ -57,13 +65,17 @@ def substitute_dependencies(a, db):
         assert not isnamedtupleinstance(a), a
 
         ta = type(a)
-        contents = ([substitute_dependencies(x, db=db) for x in a])
+        contents = ([substitute_dependencies(x, db=db, loader=loader)
+                     for x in a])
         try:
             return ta(contents)
         except TypeError as e:
             msg = 'Cannot reconstruct complex tuple.'
             raise_wrapped(ValueError, e, msg, ta=ta, contents=contents)
     elif isinstance(a, Promise):
+        if loader is not None:
+            from .lazy_deps import LazyResult
+            return LazyResult(a.job_id, loader)
         s = get_job_userobject(a.job_id, db=db)
         return substitute_dependencies(s, db=db)
     else:
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    Where the space of the DB goes (command ``du``).
+"""
+from collections import defaultdict, namedtuple
+
+from ..storage.serializers import key_type
+from .garbage import job_key_types, parse_ref_record, record_sizes
+from .job_index import load_job_index
+from .storage import digest2blobkey, job2key, job2userobjectkey
+
+__all__ = [
+    'DiskUsage',
+    'disk_usage',
+]
+
+# by_key_type: key type -> (records, bytes); by_command, by_defined_by:
+# function / defining job -> bytes; results: list of (bytes, job_id),
+# largest first
+DiskUsage = namedtuple('DiskUsage', 'by_key_type by_command by_defined_by '
+                                    'results total')
+
+
+def disk_usage(db, all_job_ids, job_ids=None):
+    """
+        Returns the :py:class:`DiskUsage` of the records of the jobs
+        ``job_ids`` (default: all the records of the DB).
+
+        The keys are listed once and the sizes are read all at once
+        (``cache_tokens()`` of the DB, which stat()s the files in
+        parallel); the function and the defining job of each job are
+        read from the job index, if used.
+
+        A content-addressed result used by several jobs is counted once,
+        for the first of them.
+    """
+    all_job_ids = list(all_job_ids)
+    selected = set(all_job_ids if job_ids is None else job_ids)
+    keys = db.keys()
+
+    # job_id -> keys of the job (including the results it owns)
+    job2keys = defaultdict(list)
+    # digest -> jobs using it
+    digest2jobs = defaultdict(list)
+    for key in keys:
+        kt = key_type(key)
+        if kt in job_key_types or kt == 'cm-job':
+            job2keys[key[len(kt) + 1:]].append(key)
+        elif kt == 'cm-ref':
+            digest, using = parse_ref_record(db, key)
+            if not using:
+                continue
+            digest2jobs[digest].extend(using)
+            job2keys[min(using)].append(key)
+    for digest, using in digest2jobs.items():
+        job2keys[min(using)].append(digest2blobkey(digest))
+
+    if job_ids is None:
+        considered = keys
+    else:
+        considered = []
+        for job_id in sorted(selected):
+            considered.extend(job2keys.get(job_id, []))
+    sizes = record_sizes(db, considered)
+
+    by_key_type = defaultdict(lambda: [0, 0])
+    for key in considered:
+        if not key in sizes:
+            continue  # removed meanwhile
+        t = by_key_type[key_type(key) or 'other']
+        t[0] += 1
+        t[1] += sizes[key]
+
+    job_bytes = {}
+    for job_id in selected:
+        job_bytes[job_id] = sum(sizes.get(k, 0) for k in job2keys[job_id])
+
+    # the size of the result is the one of the blob, if any
+    result_bytes = {}
+    for job_id in selected:
+        key = job2userobjectkey(job_id)
+        if key in sizes:
+            result_bytes[job_id] = sizes[key]
+    for digest, using in digest2jobs.items():
+        nbytes = sizes.get(digest2blobkey(digest), None)
+        if nbytes is None:
+            continue
+        for job_id in using:
+            if job_id in result_bytes:
+                result_bytes[job_id] = nbytes
+    results = sorted(((n, j) for j, n in result_bytes.items()),
+                     key=lambda x: (-x[0], x[1]))
+
+    by_command = defaultdict(lambda: 0)
+    by_defined_by = defaultdict(lambda: 0)
+    jobs = get_commands(db, all_job_ids, selected)
+    for job_id, nbytes in job_bytes.items():
+        if not job_id in jobs:
+            continue  # not a job anymore (see "gc")
+        command, defined_by = jobs[job_id]
+        by_command[command] += nbytes
+        by_defined_by[defined_by] += nbytes
+
+    total = sum(sizes.values())
+    return DiskUsage(by_key_type=dict((k, tuple(v))
+                                      for k, v in by_key_type.items()),
+                     by_command=dict(by_command),
+                     by_defined_by=dict(by_defined_by),
+                     results=results, total=total)
+
+
+def get_commands(db, all_job_ids, job_ids):
+    """ Returns a dict job_id -> (command, defining job). """
+    index = load_job_index(db, all_job_ids)
+    if index is not None:
+        rows = index.get(job_ids)
+        return dict((job_id, (row.command, row.defined_by))
+                    for job_id, row in rows.items())
+    values = db.get_many([job2key(job_id) for job_id in job_ids])
+    res = {}
+    for job_id in job_ids:
+        job = values.get(job2key(job_id), None)
+        if job is not None:
+            res[job_id] = (job.command_desc, job.defined_by[-1])
+    return res
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    Fingerprints of the code of the job functions (config switch
+    ``code_fingerprints``).
+
+    The fingerprint of a function is the SHA1 of its bytecode, its
+    constants (the nested functions included, the docstring excluded),
+    the names it uses, its default arguments, and the fingerprints of the
+    module-level functions it refers to by name. It is stored in the Job
+    when the job is defined; if it differs from the one of the previous
+    definition, the job is marked to remake (see comp_()).
+
+    Moving a function around in its file does not change the fingerprint
+    (the line numbers are not used). The functions that call each other
+    are fingerprinted together (see visit_components()).
+"""
+import hashlib
+import types
+
+import six
+
+__all__ = [
+    'code_fingerprint',
+]
+
+# function -> fingerprint
+fingerprints = {}
+
+
+def code_fingerprint(command):
+    """ Returns the fingerprint (a hex string) of the code of the job
+        function, or None if it is not a Python function. """
+    func = get_function(command)
+    if func is None:
+        return None
+    return function_fingerprint(func)
+
+
+def get_function(command):
+    if isinstance(command, types.FunctionType):
+        return command
+    if isinstance(command, types.MethodType):
+        return six.get_method_function(command)
+    return None
+
+
+def function_fingerprint(func):
+    if func not in fingerprints:
+        visit_components(func)
+    return fingerprints[func]
+
+
+def visit_components(func):
+    """ Computes the fingerprints of the functions reachable from func
+        that are not memoized yet.
+
+        The functions that refer to each other (the strongly connected
+        components, found with Tarjan's algorithm) are fingerprinted
+        together, after the ones they refer to; so the fingerprint of a
+        function in a cycle does not depend on where we started, and it
+        is memoized like the others. """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    refs = {}
+
+    def visit(f):
+        index[f] = lowlink[f] = len(index)
+        stack.append(f)
+        on_stack.add(f)
+        refs[f] = references(f)
+        for _, ob in refs[f]:
+            if ob in fingerprints:
+                continue
+            if ob not in index:
+                visit(ob)
+                lowlink[f] = min(lowlink[f], lowlink[ob])
+            elif ob in on_stack:
+                lowlink[f] = min(lowlink[f], index[ob])
+
+        if lowlink[f] == index[f]:
+            component = []
+            while True:
+                g = stack.pop()
+                on_stack.remove(g)
+                component.append(g)
+                if g is f:
+                    break
+            set_component_fingerprints(component, refs)
+
+    visit(func)
+
+
+def set_component_fingerprints(component, refs):
+    """ The references to the functions in the same component are
+        followed only once: the component is hashed as a whole (its
+        functions sorted by their own hash) and each function gets its
+        own hash plus the one of the component. A function that refers
+        only to itself gets its own hash. """
+    members = set(component)
+    local = {}
+    for f in component:
+        h = hashlib.sha1()
+        hash_function(h, f)
+        for name, ob in refs[f]:
+            h.update(name.encode('utf-8'))
+            if ob not in members:
+                h.update(fingerprints[ob].encode('ascii'))
+        local[f] = h.hexdigest()
+
+    if len(component) == 1:
+        fingerprints[component[0]] = local[component[0]]
+        return
+
+    h = hashlib.sha1()
+    for f in sorted(component, key=lambda x: local[x]):
+        h.update(local[f].encode('ascii'))
+        for _, ob in refs[f]:
+            if ob in members:
+                h.update(local[ob].encode('ascii'))
+    digest = h.hexdigest()
+    for f in component:
+        fh = hashlib.sha1()
+        fh.update(local[f].encode('ascii'))
+        fh.update(digest.encode('ascii'))
+        fingerprints[f] = fh.hexdigest()
+
+
+def hash_function(h, func):
+    code = six.get_function_code(func)
+    consts = code.co_consts
+    if consts and func.__doc__ is not None and consts[0] == func.__doc__:
+        consts = consts[1:]
+    hash_code(h, code, consts)
+    h.update(constant_repr(six.get_function_defaults(func)))
+
+
+def references(func):
+    """ Returns the list of (name, function) referred to by func. """
+    res = []
+    globals_ = six.get_function_globals(func)
+    for name in sorted(names_used(six.get_function_code(func))):
+        ob = globals_.get(name, None)
+        if is_module_function(ob):
+            res.append((name, ob))
+    wrapped = getattr(func, '__wrapped__', None)
+    if isinstance(wrapped, types.FunctionType):
+        res.append(('<wrapped>', wrapped))
+    for cell in six.get_function_closure(func) or ():
+        try:
+            ob = cell.cell_contents
+        except ValueError:  # empty cell
+            continue
+        if isinstance(ob, types.FunctionType):
+            res.append(('<closure>', ob))
+    return res
+
+
+def is_module_function(ob):
+    """ True for a function defined at the top level of its module. """
+    if not isinstance(ob, types.FunctionType):
+        return False
+    return six.get_function_globals(ob).get(ob.__name__, None) is ob
+
+
+def hash_code(h, code, consts):
+    h.update(code.co_code)
+    h.update(constant_repr(code.co_names))
+    for c in consts:
+        if isinstance(c, types.CodeType):
+            hash_code(h, c, c.co_consts)
+        else:
+            h.update(constant_repr(c))
+
+
+def names_used(code):
+    """ The names used by the code and by the nested code. """
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names.update(names_used(c))
+    return names
+
+
+def constant_repr(c):
+    """ Returns bytes representing the constant, the same in every
+        process (the order of the frozensets is not). """
+    return _constant_repr(c).encode('utf-8')
+
+
+def _constant_repr(c):
+    if c is None or isinstance(c, (bool, float, complex) + six.integer_types):
+        return repr(c)
+    if isinstance(c, (six.text_type, six.binary_type)):
+        return repr(c)
+    if isinstance(c, tuple):
+        return '(%s)' % ','.join(_constant_repr(x) for x in c)
+    if isinstance(c, frozenset):
+        return '{%s}' % ','.join(sorted(_constant_repr(x) for x in c))
+    # (the repr of other objects might contain their address)
+    return '<%s>' % type(c).__name__
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    Finds what is left in a DB by the jobs that do not exist anymore and
+    by interrupted runs (command ``gc``).
+"""
+import os
+import re
+import shutil
+import time
+from collections import namedtuple
+
+from ..storage.parallel_io import io_map
+from ..storage.serializers import key_type
+from .storage import job2key, job2userobjectkey
+
+__all__ = [
+    'Garbage',
+    'find_garbage',
+    'remove_garbage',
+]
+
+# what: 'record', 'file' or 'dir'; name: the key or the path
+Garbage = namedtuple('Garbage', 'category what name nbytes')
+
+# the records '<type>-<job_id>' of a job
+job_key_types = ['cm-res', 'cm-args', 'cm-cache', 'cm-logs']
+
+# written by safe_write() and by the segments backend
+tmp_file_pattern = re.compile(r'\.tmp[.-]\d+$')
+
+# directories of the DB with the files of the runs
+sge_spool = 'sge'
+new_process_results = 'parmake_job2_new_process'
+
+
+def find_garbage(db, min_age=3600):
+    """
+        Returns the list of :py:class:`Garbage` in the DB: the records
+        of the jobs that do not exist (results, arguments, caches, logs),
+        the content-addressed results without references, and the files
+        older than ``min_age`` seconds left by interrupted writes,
+        by the SGE backend, and by ``parmake new_process=1``.
+
+        The keys and the files are listed once; the files are
+        stat()ed in parallel.
+    """
+    return find_orphan_records(db) + find_garbage_files(db.basepath, min_age)
+
+
+def find_orphan_records(db):
+    keys = db.keys()
+    keyset = set(keys)
+    # the digests of the results of existing jobs
+    used = set()
+    orphans = []
+    for key in keys:
+        kt = key_type(key)
+        if kt in job_key_types:
+            job_id = key[len(kt) + 1:]
+            if not job2key(job_id) in keyset:
+                orphans.append(('orphan %s' % kt, key))
+        elif kt == 'cm-ref':
+            # cm-ref-<digest> (or cm-ref-<digest>-<job_id>, older)
+            digest, job_ids = parse_ref_record(db, key)
+            if any(job2key(job_id) in keyset and
+                   job2userobjectkey(job_id) in keyset
+                   for job_id in job_ids):
+                used.add(digest)
+            else:
+                orphans.append(('orphan cm-ref', key))
+    for key in keys:
+        if key_type(key) == 'cm-blob':
+            if not key[len('cm-blob-'):] in used:
+                orphans.append(('unreferenced cm-blob', key))
+
+    sizes = record_sizes(db, [key for _, key in orphans])
+    return [Garbage(category, 'record', key, sizes.get(key, 0))
+            for category, key in orphans]
+
+
+def parse_ref_record(db, key):
+    """ Returns the digest and the jobs of a 'cm-ref' record. """
+    digest, _, job_id = key[len('cm-ref-'):].partition('-')
+    if job_id:
+        # written by an older version: one key per reference
+        return digest, [job_id]
+    try:
+        return digest, sorted(db[key])
+    except Exception:  # deleted meanwhile, or unreadable
+        return digest, []
+
+
+def record_sizes(db, keys):
+    """ Returns a dict key -> size in the DB. """
+    f = getattr(db, 'cache_tokens', None)
+    if f is not None:
+        sizes = dict((k, size) for k, (_, size) in f(keys).items())
+    else:
+        sizes = {}
+    for key in keys:
+        if sizes.get(key, None) is None:
+            sizes[key] = db.sizeof(key)
+    return sizes
+
+
+def find_garbage_files(basepath, min_age):
+    if not os.path.exists(basepath):
+        return []
+    found = []
+    for dirpath, dirnames, filenames in os.walk(basepath):
+        rel = os.path.relpath(dirpath, basepath)
+        if rel == sge_spool:
+            # one directory for each run
+            for d in dirnames:
+                found.append(('SGE spool', 'dir', os.path.join(dirpath, d)))
+            dirnames[:] = []
+            continue
+        for fn in filenames:
+            filename = os.path.join(dirpath, fn)
+            if tmp_file_pattern.search(fn):
+                found.append(('temporary file', 'file', filename))
+            elif rel == new_process_results and fn.endswith('.pickle'):
+                found.append(('new_process result', 'file', filename))
+
+    now = time.time()
+
+    def check(x):
+        category, what, name = x
+        try:
+            if what == 'dir':
+                mtime, nbytes = dir_usage(name)
+            else:
+                st = os.stat(name)
+                mtime, nbytes = st.st_mtime, st.st_size
+        except OSError:  # removed meanwhile
+            return None
+        if now - mtime < min_age:
+            return None
+        return Garbage(category, what, name, nbytes)
+
+    return [g for g in io_map(check, found) if g is not None]
+
+
+def dir_usage(dirname):
+    """ Returns the last modification time and the size of the files
+        in the directory. """
+    mtime = os.stat(dirname).st_mtime
+    nbytes = 0
+    for dirpath, _, filenames in os.walk(dirname):
+        for fn in filenames:
+            st = os.stat(os.path.join(dirpath, fn))
+            mtime = max(mtime, st.st_mtime)
+            nbytes += st.st_size
+    return mtime, nbytes
+
+
+def remove_garbage(db, garbage):
+    """ Removes what :py:func:`find_garbage` found; returns the bytes
+        reclaimed. The files are removed in parallel. """
+    nbytes = 0
+    for g in garbage:
+        if g.what == 'record' and g.name in db:
+            del db[g.name]
+            nbytes += g.nbytes
+
+    def remove(g):
+        try:
+            if g.what == 'dir':
+                shutil.rmtree(g.name)
+            else:
+                os.remove(g.name)
+        except OSError:  # removed meanwhile
+            return 0
+        return g.nbytes
+
+    files = [g for g in garbage if g.what != 'record']
+    nbytes += sum(io_map(remove, files))
+    return nbytes
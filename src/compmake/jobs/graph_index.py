@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+    An index of the relations between the jobs (children, parents, jobs
+    defined), so that the queries in ``jobs/queries.py`` do not read the
+    Job and Cache records, and so that the closures (all the parents, all
+    the children, the definition closure) are one breadth-first search.
+
+    In memory, the jobs are numbered densely, and each relation is kept
+    in "compressed sparse row" form: the jobs related to the job ``i``
+    are ``targets[offsets[i]:offsets[i + 1]]``. The rows that change
+    afterwards are kept in a dict, and merged in the arrays from time
+    to time.
+
+    The rows are persisted in ``<basepath>/.compmake-graph.sqlite``,
+    written together with the job and cache records (see
+    ``jobs/storage.py``), so that the index is read from the records only
+    once. Each row has a sequence number, so that the rows written by the
+    other processes (for example, the ``parmake`` workers) are read again.
+"""
+import json
+import os
+import sqlite3
+from array import array
+from collections import deque
+
+from compmake import get_compmake_config, logger
+
+from ..storage.batch import BatchDB
+from ..structures import Cache
+from .index_marker import (index_marker_filename, invalidate_index_marker,
+                           read_index_marker, renew_index_marker)
+
+__all__ = [
+    'GraphIndex',
+    'commit_graph_index',
+    'get_graph_index',
+    'graph_index_writing',
+    'load_graph_index',
+    'refresh_graph_index',
+    'update_graph_index',
+]
+
+
+class GraphIndex(object):
+    """
+        The relations ``children`` and ``parents`` (as in the Job
+        records) and ``defines`` (the jobs defined, for the jobs that are
+        done), in memory and in the table ``graph`` of
+        ``<basepath>/.compmake-graph.sqlite``.
+
+        The jobs that were deleted, and the ones that are only referenced,
+        have a row with ``present`` 0.
+
+        The changes are written by :py:func:`commit_marks` or
+        :py:func:`commit` (but the queries of the process see them
+        before). As for the job index, the commits are not fsync()ed: the
+        index can always be rebuilt from the DB; the jobs whose records
+        were being written are listed in the table ``inflight``, and the
+        index is valid only for the token in the DB (see
+        :py:class:`JobIndex`).
+    """
+
+    index_filename = '.compmake-graph.sqlite'
+    # PRAGMA user_version; the table is created again if different
+    version = 2
+    # see index_marker.py
+    marker = 'graph'
+
+    relations = ['children', 'parents', 'defines']
+
+    # the changed rows are merged in the arrays when there are more
+    compact_min = 1024
+
+    # see JobIndex.marked_max
+    marked_max = 1000
+
+    def __init__(self, basepath):
+        self.filename = os.path.join(basepath, GraphIndex.index_filename)
+        self.conn = None
+        self.pid = None
+        self.ino = None
+        # PRAGMA data_version when the rows were last read
+        self.data_version = None
+        # list of (job_id, values) to write at commit()
+        self.pending = []
+        # jobs to list in 'inflight', and the ones listed
+        self.marks = []
+        self.marked = set()
+        # the token to write at commit(), after a rebuild
+        self.pending_token = None
+        self.loaded = False
+        # the process that called sync() since expire()
+        self.synced = None
+        self._clear()
+
+    def __repr__(self):
+        return 'GraphIndex(%r)' % self.filename
+
+    def _clear(self):
+        # int -> job_id, and job_id -> int
+        self.ids = []
+        self.id2int = {}
+        # int -> 1 if the job exists
+        self.present = bytearray()
+        # relation -> (offsets, targets)
+        self.csr = dict((r, (array('l', [0]), array('l')))
+                        for r in GraphIndex.relations)
+        # relation -> int -> tuple of ints, the rows changed since
+        self.changed = dict((r, {}) for r in GraphIndex.relations)
+        # the highest sequence number read
+        self.seq = 0
+
+    def _get_connection(self):
+        ino = _inode(self.filename)
+        if self.conn is None or self.pid != os.getpid() or ino != self.ino:
+            if ino != self.ino:
+                # a new file (or the first time): read it all
+                self.loaded = False
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != GraphIndex.version:
+                for table in ['graph', 'inflight', 'meta']:
+                    conn.execute('DROP TABLE IF EXISTS %s' % table)
+                conn.execute('PRAGMA user_version=%d' % GraphIndex.version)
+                self.loaded = False
+            conn.execute('CREATE TABLE IF NOT EXISTS graph '
+                         '(job_id TEXT PRIMARY KEY, '
+                         'seq INTEGER NOT NULL DEFAULT 0, '
+                         'present INTEGER NOT NULL DEFAULT 0, '
+                         "children TEXT NOT NULL DEFAULT '[]', "
+                         "parents TEXT NOT NULL DEFAULT '[]', "
+                         "defines TEXT NOT NULL DEFAULT '[]')")
+            conn.execute('CREATE INDEX IF NOT EXISTS graph_seq '
+                         'ON graph (seq)')
+            conn.execute('CREATE TABLE IF NOT EXISTS inflight '
+                         '(job_id TEXT PRIMARY KEY)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(name TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('COMMIT')
+            self.conn = conn
+            self.pid = os.getpid()
+            self.ino = _inode(self.filename)
+            # (the rows written meanwhile are read by refresh())
+            self.data_version = None
+        return self.conn
+
+    def _int(self, job_id):
+        i = self.id2int.get(job_id, None)
+        if i is None:
+            i = len(self.ids)
+            self.ids.append(job_id)
+            self.id2int[job_id] = i
+            self.present.append(0)
+        return i
+
+    def _row(self, relation, i):
+        row = self.changed[relation].get(i, None)
+        if row is not None:
+            return row
+        offsets, targets = self.csr[relation]
+        if i + 1 < len(offsets):
+            return targets[offsets[i]:offsets[i + 1]]
+        return ()
+
+    def _apply(self, job_id, values):
+        i = self._int(job_id)
+        for name, value in values.items():
+            if name == 'present':
+                self.present[i] = value
+            else:
+                self.changed[name][i] = tuple(self._int(j) for j in value)
+
+    def _compact(self, force=False):
+        limit = max(GraphIndex.compact_min, len(self.ids) // 4)
+        for relation in GraphIndex.relations:
+            if not force and len(self.changed[relation]) <= limit:
+                continue
+            offsets = array('l', [0])
+            targets = array('l')
+            for i in range(len(self.ids)):
+                targets.extend(self._row(relation, i))
+                offsets.append(len(targets))
+            self.csr[relation] = (offsets, targets)
+            self.changed[relation] = {}
+
+    def _read_rows(self, rows):
+        for job_id, seq, present, children, parents, defines in rows:
+            self._apply(job_id, dict(present=present,
+                                     children=json.loads(children),
+                                     parents=json.loads(parents),
+                                     defines=json.loads(defines)))
+            self.seq = max(self.seq, seq)
+
+    def _update(self, job_id, values):
+        self.pending.append((job_id, values))
+
+    def set_job(self, job_id, job):
+        self._update(job_id, dict(present=1, children=sorted(job.children),
+                                  parents=sorted(job.parents)))
+
+    def set_cache(self, job_id, cache):
+        if cache.state == Cache.DONE:
+            defines = sorted(cache.jobs_defined)
+        else:
+            defines = []
+        self._update(job_id, dict(defines=defines))
+
+    def delete(self, job_id):
+        self._update(job_id, dict(present=0, children=[], parents=[]))
+
+    def writing(self, job_id):
+        """ The records of the job are going to be written; the job is
+            listed in 'inflight' by :py:func:`commit_marks`. """
+        if not job_id in self.marked:
+            self.marks.append(job_id)
+
+    def commit_marks(self):
+        """ Lists in 'inflight' the jobs passed to :py:func:`writing`,
+            and writes the changes so far, in one transaction; call it
+            before writing their records. """
+        if not self.marks:
+            return
+        marks, self.marks = self.marks, []
+        if len(self.marked) > GraphIndex.marked_max:
+            # (their records were written: this is before the next ones)
+            unmark, self.marked = self.marked, set()
+        else:
+            unmark = set()
+        if self._write(marks, unmark):
+            self.marked.update(marks)
+
+    def commit(self):
+        """ Writes the changes, in one transaction, and removes the jobs
+            from 'inflight'. """
+        if not self.pending and not self.marked and not self.pending_token:
+            return
+        marked, self.marked = self.marked, set()
+        self._write([], marked)
+
+    def apply_last(self):
+        """ Shows the last change to the queries, before it is written. """
+        if self.loaded and self.pending:
+            self._apply(*self.pending[-1])
+
+    def _write(self, marks, unmark):
+        """ Writes the changes, lists ``marks`` in 'inflight' and removes
+            ``unmark``, in one transaction. Returns False if it failed
+            (then the index is removed). """
+        pending, self.pending = self.pending, []
+        token, self.pending_token = self.pending_token, None
+        c = self._get_connection()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                c.executemany('DELETE FROM inflight WHERE job_id=?',
+                              [(job_id,) for job_id in unmark])
+                c.executemany('INSERT OR IGNORE INTO inflight VALUES (?)',
+                              [(job_id,) for job_id in marks])
+                if token is not None:
+                    c.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              ('token', token))
+                q = 'SELECT COALESCE(MAX(seq), 0) FROM graph'
+                seq = c.execute(q).fetchone()[0]
+                # nobody else wrote since we read
+                uptodate = self.loaded and seq == self.seq
+                for job_id, values in pending:
+                    seq += 1
+                    names = sorted(values)
+                    c.execute('INSERT OR IGNORE INTO graph (job_id) '
+                              'VALUES (?)', (job_id,))
+                    q = 'UPDATE graph SET seq=?, %s WHERE job_id=?' % (
+                        ', '.join('%s=?' % n for n in names))
+                    params = ([seq] + [_encode(values[n]) for n in names] +
+                              [job_id])
+                    c.execute(q, params)
+            except:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('COMMIT')
+        except sqlite3.Error as e:
+            # The index would not be correct anymore.
+            msg = 'Could not update the graph index %s: %s' % (
+                self.filename, e)
+            logger.warning(msg)
+            self.remove()
+            return False
+        if self.loaded:
+            for job_id, values in pending:
+                self._apply(job_id, values)
+            if uptodate:
+                self.seq = seq
+            self._compact()
+        return True
+
+    def remove(self):
+        """ Removes the file; it is rebuilt by the next query. """
+        self.conn = None
+        self.pending = []
+        self.marks = []
+        self.marked = set()
+        self.pending_token = None
+        self.loaded = False
+        self.synced = None
+        self._clear()
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(self.filename + suffix)
+            except OSError:
+                pass
+
+    def sync(self, db):
+        """
+            Brings the index up to date: the first time, it reads all the
+            rows, and then the records of the jobs of the DB that are not
+            listed (or that do not exist anymore) or that are in
+            'inflight'; afterwards, the rows written by the other
+            processes. If the token of the DB is not the one of the index,
+            or if it was deleted meanwhile, the index is rebuilt.
+        """
+        self._get_connection()
+        marker = index_marker_filename(db, GraphIndex.marker)
+        if self.loaded and not os.path.exists(marker):
+            # written by a process without the index
+            self.loaded = False
+        if self.loaded:
+            self.refresh()
+        else:
+            self._load(db)
+        self.synced = os.getpid()
+
+    def expire(self):
+        """ The next :py:func:`load_graph_index` calls :py:func:`sync`
+            again. """
+        self.synced = None
+
+    def token(self):
+        """ Returns the token of the DB for which the index is valid. """
+        c = self._get_connection()
+        row = c.execute("SELECT value FROM meta WHERE name='token'").fetchone()
+        return row[0] if row is not None else None
+
+    def refresh(self):
+        """ Reads the rows written by the other processes. """
+        c = self._get_connection()
+        version = c.execute('PRAGMA data_version').fetchone()[0]
+        if version == self.data_version:
+            return
+        self.data_version = version
+        q = ('SELECT job_id, seq, present, children, parents, defines '
+             'FROM graph WHERE seq > ? ORDER BY seq')
+        self._read_rows(c.execute(q, (self.seq,)))
+        self._compact()
+
+    def _load(self, db):
+        from .storage import all_jobs
+
+        self._clear()
+        c = self._get_connection()
+        token = read_index_marker(db, GraphIndex.marker)
+        rebuild = token is None or token != self.token()
+        if rebuild:
+            # (the writers without the index delete it from now on)
+            token = renew_index_marker(db, GraphIndex.marker)
+        self.data_version = c.execute('PRAGMA data_version').fetchone()[0]
+        q = ('SELECT job_id, seq, present, children, parents, defines '
+             'FROM graph')
+        self._read_rows(c.execute(q))
+        self._compact(force=True)
+        self.loaded = True
+
+        # (the changes not written yet stay pending)
+        batch, self.pending = self.pending, []
+        try:
+            all_job_ids = set(all_jobs(db))
+            listed = set(job_id for job_id, i in self.id2int.items()
+                         if self.present[i])
+            for job_id in sorted(listed - all_job_ids):
+                self.delete(job_id)
+            if rebuild:
+                missing = all_job_ids
+                self.pending_token = token
+            else:
+                missing = all_job_ids - listed
+                missing.update(all_job_ids.intersection(
+                    row[0] for row in c.execute('SELECT job_id FROM inflight')))
+            self.add_from_db(db, sorted(missing))
+            # (the jobs in 'inflight' stay there: their rows are pending)
+            self._write([], set())
+        finally:
+            # (and the queries still see them)
+            for job_id, values in batch:
+                self._apply(job_id, values)
+            self.pending = batch + self.pending
+
+    def add_from_db(self, db, job_ids):
+        """ Reads the records of the jobs and writes their rows. """
+        from .storage import get_jobs_and_caches
+
+        chunk_size = 1000
+        for i in range(0, len(job_ids), chunk_size):
+            chunk = job_ids[i:i + chunk_size]
+            jobs, caches = get_jobs_and_caches(chunk, db)
+            for job_id in sorted(jobs):
+                self.set_job(job_id, jobs[job_id])
+                self.set_cache(job_id, caches[job_id])
+
+    def exists(self, job_id):
+        i = self.id2int.get(job_id, None)
+        return i is not None and self.present[i] == 1
+
+    def direct(self, relation, job_id):
+        """ Returns the set of the jobs related to the job, or None if
+            the job does not exist. """
+        if not self.exists(job_id):
+            return None
+        ids = self.ids
+        return set(ids[j] for j in self._row(relation, self.id2int[job_id]))
+
+    def closure(self, relation, job_ids):
+        """
+            Returns the set of the jobs reached from ``job_ids`` following
+            the relation (the jobs ``job_ids`` are included only if
+            reached). The jobs that do not exist are included, but
+            not followed.
+        """
+        seen = bytearray(len(self.ids))
+        queue = deque()
+        for job_id in job_ids:
+            i = self.id2int.get(job_id, None)
+            if i is not None:
+                queue.append(i)
+        present = self.present
+        reached = []
+        while queue:
+            i = queue.popleft()
+            if not present[i]:
+                continue
+            for j in self._row(relation, i):
+                if not seen[j]:
+                    seen[j] = 1
+                    reached.append(j)
+                    queue.append(j)
+        ids = self.ids
+        return set(ids[j] for j in reached)
+
+
+def _inode(filename):
+    try:
+        return os.stat(filename).st_ino
+    except OSError:
+        return None
+
+
+def _encode(value):
+    if isinstance(value, int):
+        return value
+    return json.dumps(list(value))
+
+
+# filename -> GraphIndex
+graph_indices = {}
+
+
+def get_graph_index(db):
+    """ Returns the :py:class:`GraphIndex` of the DB, or None if it is
+        not used (config switch ``graph_index``). """
+    if not get_compmake_config('graph_index'):
+        return None
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    if not basepath in graph_indices:
+        graph_indices[basepath] = GraphIndex(basepath)
+    return graph_indices[basepath]
+
+
+def load_graph_index(db):
+    """ Returns the index of the DB, or None if it is not used. Inside a
+        batch (``BatchDB``), the queries read the records.
+
+        The index is brought up to date (:py:func:`GraphIndex.sync`) by
+        the first query after :py:func:`commit_graph_index`, that is,
+        once for each iteration of the manager and for each command. """
+    if isinstance(db, BatchDB):
+        return None
+    index = get_graph_index(db)
+    if index is not None and (not index.loaded or
+                              index.synced != os.getpid()):
+        index.sync(db)
+    return index
+
+
+def refresh_graph_index(job_ids, db):
+    """ Reads again the rows of the jobs, for the records that were
+        written without the functions in ``jobs/storage.py``. """
+    index = get_graph_index(db)
+    if index is not None:
+        index.add_from_db(db, list(job_ids))
+        index.commit()
+
+
+def graph_index_writing(db, job_id):
+    """ Call before writing the records of the job (see
+        ``job_index_writing()``). """
+    index = get_graph_index(db)
+    if index is None:
+        invalidate_index_marker(db, GraphIndex.marker)
+        # (if it was used before, in this process)
+        previous = graph_indices.get(getattr(db, 'basepath', None), None)
+        if previous is not None:
+            previous.expire()
+        return
+    index.writing(job_id)
+    if not isinstance(db, BatchDB):
+        index.commit_marks()
+
+
+def update_graph_index(db, method, job_id, *args):
+    """ Calls ``method`` of the index of the DB; the changes are
+        written by the next :py:func:`graph_index_writing` or
+        :py:func:`commit_graph_index` (in a batch, by
+        ``BatchDB.flush()``). """
+    index = get_graph_index(db)
+    if index is None:
+        return
+    getattr(index, method)(job_id, *args)
+    if not isinstance(db, BatchDB):
+        index.apply_last()
+
+
+def commit_graph_index(db):
+    """ Writes the changes to the index of the DB, and removes the jobs
+        written from 'inflight'; the next query reads the rows written
+        by the other processes. """
+    if isinstance(db, BatchDB):
+        return
+    index = get_graph_index(db)
+    if index is not None:
+        index.commit()
+        index.expire()
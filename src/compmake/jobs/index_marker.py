@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    The markers that tell whether the job index and the graph index are
+    still valid for the DB.
+
+    When an index is built from the records, a random token is written
+    both to the file ``<basepath>/.compmake-<name>.token`` and to the
+    index. The processes that write the job records without updating
+    the index (config switch ``job_index`` or ``graph_index`` off)
+    remove the file first, so the index is read again from the records
+    by the next process using it.
+
+    Only the processes that know about the markers remove them: the
+    records written by the versions without the indices are not noticed.
+"""
+import errno
+import os
+import uuid
+
+__all__ = [
+    'index_marker_filename',
+    'invalidate_index_marker',
+    'read_index_marker',
+    'renew_index_marker',
+]
+
+
+def index_marker_filename(db, name):
+    """ Returns the name of the file, or None if the DB is not in a
+        directory. """
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    return os.path.join(basepath, '.compmake-%s.token' % name)
+
+
+def read_index_marker(db, name):
+    """ Returns the token of the index, or None if it was invalidated. """
+    filename = index_marker_filename(db, name)
+    if filename is None:
+        return None
+    try:
+        with open(filename) as f:
+            return f.read().strip() or None
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def renew_index_marker(db, name):
+    """ Writes and returns a new token; call it before reading the
+        records from which the index is built. """
+    token = uuid.uuid4().hex
+    filename = index_marker_filename(db, name)
+    if filename is None:
+        return token
+    tmp = '%s.tmp.%d' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(token + '\n')
+    os.rename(tmp, filename)
+    return token
+
+
+def invalidate_index_marker(db, name):
+    """ Removes the token; call it before writing a record without
+        updating the index. """
+    filename = index_marker_filename(db, name)
+    if filename is None:
+        return
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -6,6 +6,9 @@ from contracts import check_isinstance, contract
 from ..exceptions import CompmakeBug
 from ..structures import Job
 from .dependencies import collect_dependencies, substitute_dependencies
+from .lazy_deps import LazyLoader
+from .prefetch import PrefetchedDB, take_prefetched
+from .shared_results import SharedResultsDB, take_shared
 from .storage import get_job_args, job_userobject_exists
 
 __all__ = [
@@ -13,8 +16,9 @@ __all__ = [
 ]
 
 
-def get_cmd_args_kwargs(job_id, db):
-    """ Substitutes dependencies and gets actual cmd, args, kwargs. """
+def get_cmd_args_kwargs(job_id, db, loader=None):
+    """ Substitutes dependencies and gets actual cmd, args, kwargs.
+        If a LazyLoader is given, the dependencies are loaded lazily. """
     command, args, kwargs = get_job_args(job_id, db=db)
     kwargs = dict(**kwargs)
     # Let's check that all dependencies have been computed
@@ -23,8 +27,8 @@ def get_cmd_args_kwargs(job_id, db):
         if not job_userobject_exists(dep, db):
             msg = 'Dependency %r was not done.' % dep
             raise CompmakeBug(msg)
-    args2 = substitute_dependencies(args, db=db)
-    kwargs2 = substitute_dependencies(kwargs, db=db)
+    args2 = substitute_dependencies(args, db=db, loader=loader)
+    kwargs2 = substitute_dependencies(kwargs, db=db, loader=loader)
     return command, args2, kwargs2
 
 
@@ -42,7 +46,17 @@ def job_compute(job, context):
 
     int_load_results = IntervalTimer()
 
-    command, args, kwargs = get_cmd_args_kwargs(job_id, db=db)
+    # in the parmake workers, what was prefetched for this job
+    db_args = take_prefetched(job_id, db)
+    # ... and the results in shared memory
+    db_args = take_shared(job, db_args)
+    # (jobs in old DBs do not have the attribute)
+    if getattr(job, 'lazy_deps', False):
+        loader = LazyLoader(db_args)
+    else:
+        loader = None
+    command, args, kwargs = get_cmd_args_kwargs(job_id, db=db_args,
+                                                loader=loader)
 
     int_load_results.stop()
 
@@ -55,6 +69,8 @@ def job_compute(job, context):
                                    job_id=job_id,
                                    command=command, args=args, kwargs=kwargs)
         int_compute.stop()
+        if loader is not None:
+            loader.account_time(int_load_results, int_compute)
 
         assert isinstance(res, dict)
         assert len(res) == 2, list(res.keys())
@@ -64,21 +80,34 @@ def job_compute(job, context):
         res['int_load_results'] = int_load_results
         res['int_compute'] = int_compute
         res['int_gc'] = IntervalTimer()
+        res['prefetch'] = prefetch_stats(db_args)
         return res
     else:
         int_compute = IntervalTimer()
         user_object = command(*args, **kwargs)
         int_compute.stop()
+        if loader is not None:
+            loader.account_time(int_load_results, int_compute)
 
         res = dict(user_object=user_object, new_jobs=[])
 
         res['int_load_results'] = int_load_results
         res['int_compute'] = int_compute
         res['int_gc'] = IntervalTimer()
+        res['prefetch'] = prefetch_stats(db_args)
 
         return res
 
 
+def prefetch_stats(db_args):
+    """ Returns (hits, misses), or None if not prefetching. """
+    if isinstance(db_args, SharedResultsDB):
+        db_args = db_args.db
+    if isinstance(db_args, PrefetchedDB):
+        return db_args.hits, db_args.misses
+    return None
+
+
 def execute_with_context(db, context, job_id, command, args, kwargs):
     """ Returns a dictionary with fields "user_object" and "new_jobs" """
     from compmake.context import Context
@@ -100,7 +129,9 @@ def execute_with_context(db, context, job_id, command, args, kwargs):
     # context is one of the arguments
     assert context in args
 
-    res = command(*args, **kwargs)
+    # the jobs defined are written all together at the end
+    with context.batch_definitions():
+        res = command(*args, **kwargs)
 
     generated = set(context.get_jobs_defined_in_this_session())
     context.reset_jobs_defined_in_this_session(already)
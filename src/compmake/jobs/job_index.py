@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+    A table with the metadata of the jobs (state, timestamp, command,
+    level, defining job, timings, size of the result), kept up to date by
+    the functions in ``jobs/storage.py``, so that ``stats``, ``du`` and
+    the aliases such as ``$failed`` or ``$level1`` do not read the Job
+    and Cache records.
+"""
+import os
+import sqlite3
+from collections import namedtuple
+
+from compmake import get_compmake_config, logger
+
+from ..storage.batch import BatchDB
+from .index_marker import (invalidate_index_marker, read_index_marker,
+                           renew_index_marker)
+
+__all__ = [
+    'JobIndex',
+    'JobInfo',
+    'commit_job_index',
+    'get_job_index',
+    'job_index_writing',
+    'load_job_index',
+    'refresh_job_index',
+    'update_job_index',
+]
+
+JobInfo = namedtuple('JobInfo', 'state timestamp command depth dynamic '
+                                'defined_by walltime cputime result_size')
+
+# SQLITE_MAX_VARIABLE_NUMBER is 999 in older versions
+max_query_variables = 900
+
+
+class JobIndex(object):
+    """
+        The table ``jobs`` in ``<basepath>/.compmake-jobs.sqlite``,
+        with one row for each job.
+
+        A row added by :py:func:`set_job` has state NULL (unknown) until
+        :py:func:`set_cache`, or until it is read from the DB by
+        :py:func:`sync`.
+
+        The changes are kept in memory until :py:func:`commit_marks` or
+        :py:func:`commit`. The file can be shared by several processes;
+        the connection is opened again after a fork. The commits are not
+        fsync()ed: the index can always be rebuilt from the DB (see
+        :py:func:`sync`).
+
+        Before the records of a job are written, the job is listed in
+        the table ``inflight`` (:py:func:`writing`), until the commit of
+        its new row: if the process dies in between, the row is read
+        again from the DB. The rows changed so far are written in the
+        same transaction, and the jobs stay listed until
+        :py:func:`commit` (called after each job and each iteration of
+        the manager), so that the records of a job written one after the
+        other need one transaction. The index is valid only for the token
+        in the DB (see index_marker.py).
+    """
+
+    index_filename = '.compmake-jobs.sqlite'
+    # PRAGMA user_version; the table is created again if different
+    version = 3
+    # see index_marker.py
+    marker = 'jobs'
+
+    columns = ['state', 'timestamp', 'command', 'depth', 'dynamic',
+               'defined_by', 'walltime', 'cputime', 'result_size']
+
+    # the jobs listed in 'inflight' are removed by commit_marks() when
+    # there are more
+    marked_max = 1000
+
+    def __init__(self, basepath):
+        self.filename = os.path.join(basepath, JobIndex.index_filename)
+        self.conn = None
+        self.pid = None
+        self.ino = None
+        # list of (query, params) to execute at commit()
+        self.pending = []
+        # jobs to list in 'inflight', and the ones listed
+        self.marks = []
+        self.marked = set()
+
+    def __repr__(self):
+        return 'JobIndex(%r)' % self.filename
+
+    def __getstate__(self):
+        # the connection cannot be pickled (nor shared across processes)
+        d = dict(self.__dict__)
+        d.update(conn=None, pid=None, ino=None, pending=[], marks=[],
+                 marked=set())
+        return d
+
+    def _get_connection(self):
+        ino = _inode(self.filename)
+        if self.conn is None or self.pid != os.getpid() or ino != self.ino:
+            # (a new file if the DB was removed)
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != JobIndex.version:
+                # written by another version: rebuilt by sync()
+                for table in ['jobs', 'inflight', 'meta']:
+                    conn.execute('DROP TABLE IF EXISTS %s' % table)
+                conn.execute('PRAGMA user_version=%d' % JobIndex.version)
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs '
+                         '(job_id TEXT PRIMARY KEY, '
+                         'state INTEGER, timestamp REAL, '
+                         'command TEXT, depth INTEGER, dynamic INTEGER, '
+                         'defined_by TEXT, walltime REAL, cputime REAL, '
+                         'result_size INTEGER NOT NULL DEFAULT 0)')
+            # for the aliases and for GROUP BY in summary()
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state '
+                         'ON jobs (state)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_command '
+                         'ON jobs (command, state)')
+            conn.execute('CREATE TABLE IF NOT EXISTS inflight '
+                         '(job_id TEXT PRIMARY KEY)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(name TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('COMMIT')
+            self.conn = conn
+            self.pid = os.getpid()
+            self.ino = _inode(self.filename)
+        return self.conn
+
+    def _update(self, job_id, values):
+        names = sorted(values)
+        self.pending.append(('INSERT OR IGNORE INTO jobs (job_id) VALUES (?)',
+                             (job_id,)))
+        q = 'UPDATE jobs SET %s WHERE job_id=?' % (
+            ', '.join('%s=?' % n for n in names))
+        self.pending.append((q, tuple(values[n] for n in names) + (job_id,)))
+
+    def set_job(self, job_id, job):
+        self._update(job_id, job_values(job))
+
+    def set_cache(self, job_id, cache):
+        self._update(job_id, cache_values(cache))
+
+    def set_result_size(self, job_id, nbytes):
+        self._update(job_id, dict(result_size=nbytes))
+
+    def delete(self, job_id):
+        self.pending.append(('DELETE FROM jobs WHERE job_id=?', (job_id,)))
+
+    def writing(self, job_id):
+        """ The records of the job are going to be written; the job is
+            listed in 'inflight' by :py:func:`commit_marks`. """
+        if not job_id in self.marked:
+            self.marks.append(job_id)
+
+    def commit_marks(self):
+        """ Lists in 'inflight' the jobs passed to :py:func:`writing`,
+            and writes the changes so far, in one transaction; call it
+            before writing their records. """
+        if not self.marks:
+            return
+        marks, self.marks = self.marks, []
+        queries, self.pending = self.pending, []
+        if len(self.marked) > JobIndex.marked_max:
+            # (their records were written: this is before the next ones)
+            q = 'DELETE FROM inflight WHERE job_id=?'
+            queries.extend((q, (job_id,)) for job_id in self.marked)
+            self.marked = set()
+        q = 'INSERT OR IGNORE INTO inflight VALUES (?)'
+        queries.extend((q, (job_id,)) for job_id in marks)
+        self._execute(queries)
+        self.marked.update(marks)
+
+    def commit(self):
+        """ Writes the changes, in one transaction, and removes the jobs
+            from 'inflight'. """
+        if not self.pending and not self.marked:
+            return
+        pending, self.pending = self.pending, []
+        marked, self.marked = self.marked, set()
+        q = 'DELETE FROM inflight WHERE job_id=?'
+        self._execute(pending + [(q, (job_id,)) for job_id in marked])
+
+    def _execute(self, queries):
+        c = self._get_connection()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                for q, params in queries:
+                    c.execute(q, params)
+            except:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('COMMIT')
+        except sqlite3.Error as e:
+            # The index would not be correct anymore.
+            msg = 'Could not update the job index %s: %s' % (self.filename, e)
+            logger.warning(msg)
+            self.remove()
+
+    def remove(self):
+        """ Removes the file; it is rebuilt by the next query. """
+        self.conn = None
+        self.pending = []
+        self.marks = []
+        self.marked = set()
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(self.filename + suffix)
+            except OSError:
+                pass
+
+    def count(self):
+        c = self._get_connection()
+        return c.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def job_ids(self, where=None, params=()):
+        """ Returns the set of the jobs matching the SQL condition
+            ``where`` on the columns (all jobs if None). """
+        q = 'SELECT job_id FROM jobs'
+        if where is not None:
+            q += ' WHERE ' + where
+        c = self._get_connection()
+        return set(row[0] for row in c.execute(q, params))
+
+    def get(self, job_ids):
+        """ Returns a dict job_id -> :py:class:`JobInfo` for the jobs
+            in the index. """
+        c = self._get_connection()
+        job_ids = list(job_ids)
+        res = {}
+        for i in range(0, len(job_ids), max_query_variables):
+            chunk = job_ids[i:i + max_query_variables]
+            q = ('SELECT job_id, %s FROM jobs WHERE job_id IN (%s)' %
+                 (', '.join(JobIndex.columns), ','.join(['?'] * len(chunk))))
+            for row in c.execute(q, chunk):
+                res[row[0]] = JobInfo(*row[1:])
+        return res
+
+    def summary(self, job_ids=None):
+        """ Returns a dict command -> state -> number of jobs, for the
+            given jobs (all if None). """
+        c = self._get_connection()
+        q = 'SELECT command, state, COUNT(*) FROM jobs'
+        if job_ids is not None:
+            job_ids = set(job_ids)
+            if len(job_ids) < self.count():
+                c.execute('CREATE TEMP TABLE IF NOT EXISTS selected '
+                          '(job_id TEXT PRIMARY KEY)')
+                c.execute('BEGIN')
+                c.execute('DELETE FROM selected')
+                c.executemany('INSERT INTO selected VALUES (?)',
+                              ((j,) for j in job_ids))
+                c.execute('COMMIT')
+                q += ' WHERE job_id IN (SELECT job_id FROM selected)'
+        q += ' GROUP BY command, state'
+        res = {}
+        for command, state, n in c.execute(q):
+            res.setdefault(command, {})[state] = n
+        return res
+
+    def token(self):
+        """ Returns the token of the DB for which the index is valid. """
+        c = self._get_connection()
+        row = c.execute("SELECT value FROM meta WHERE name='token'").fetchone()
+        return row[0] if row is not None else None
+
+    def sync(self, db, all_job_ids):
+        """
+            Brings the index up to date with the jobs in the DB,
+            ``all_job_ids``. If the token of the DB is not the one of the
+            index, the index is rebuilt. If the number of rows is the
+            same, the rows are assumed to be correct; otherwise the rows
+            of the jobs that do not exist are removed, and the missing
+            ones are read from the DB, as the ones with an unknown state
+            and the ones in 'inflight'.
+        """
+        self.commit()
+        all_job_ids = set(all_job_ids)
+        token = read_index_marker(db, JobIndex.marker)
+        if token is None or token != self.token():
+            self.rebuild(db, all_job_ids)
+            return
+        missing = self.job_ids('state IS NULL')
+        c = self._get_connection()
+        missing.update(row[0] for row in
+                       c.execute('SELECT job_id FROM inflight'))
+        if self.count() != len(all_job_ids):
+            present = self.job_ids()
+            for job_id in present - all_job_ids:
+                self.delete(job_id)
+            missing.update(all_job_ids - present)
+        missing.intersection_update(all_job_ids)
+        if missing:
+            self.add_from_db(db, sorted(missing))
+        self.commit()
+
+    def rebuild(self, db, all_job_ids):
+        """ Reads all the rows from the DB. """
+        # (the writers without the index delete it from now on)
+        token = renew_index_marker(db, JobIndex.marker)
+        self.pending.append(('DELETE FROM jobs', ()))
+        self.add_from_db(db, sorted(all_job_ids))
+        self.pending.append(('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             ('token', token)))
+        self.commit()
+
+    def add_from_db(self, db, job_ids):
+        """ Reads the records of the jobs and writes their rows. """
+        from .storage import (get_jobs_and_caches, job2userobjectkey,
+                              job_userobject_sizeof, result_ref_max_size)
+        from .garbage import record_sizes
+
+        chunk_size = 1000
+        for i in range(0, len(job_ids), chunk_size):
+            chunk = job_ids[i:i + chunk_size]
+            jobs, caches = get_jobs_and_caches(chunk, db)
+            keys = [job2userobjectkey(j) for j in jobs]
+            exists = db.contains_many(keys)
+            sizes = record_sizes(db, [k for k in keys if k in exists])
+            for job_id in sorted(jobs):
+                values = job_values(jobs[job_id])
+                values.update(cache_values(caches[job_id]))
+                nbytes = sizes.get(job2userobjectkey(job_id), 0) or 0
+                if 0 < nbytes <= result_ref_max_size:
+                    # can be a reference to a content-addressed result
+                    nbytes = job_userobject_sizeof(job_id, db)
+                values['result_size'] = nbytes
+                self._update(job_id, values)
+
+
+def _inode(filename):
+    try:
+        return os.stat(filename).st_ino
+    except OSError:
+        return None
+
+
+def job_values(job):
+    return dict(command=job.command_desc,
+                depth=len(job.defined_by) - 1,
+                dynamic=int(bool(job.needs_context)),
+                defined_by=job.defined_by[-1])
+
+
+def cache_values(cache):
+    return dict(state=cache.state,
+                timestamp=cache.timestamp,
+                walltime=cache.walltime_used,
+                cputime=cache.cputime_used)
+
+
+# filename -> JobIndex
+job_indices = {}
+
+
+def get_job_index(db):
+    """ Returns the :py:class:`JobIndex` of the DB, or None if it is not
+        used (config switch ``job_index``). """
+    if not get_compmake_config('job_index'):
+        return None
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    if not basepath in job_indices:
+        job_indices[basepath] = JobIndex(basepath)
+    return job_indices[basepath]
+
+
+def load_job_index(db, all_job_ids):
+    """ Returns the index of the DB in sync with the jobs
+        ``all_job_ids`` (see :py:func:`JobIndex.sync`), or None. """
+    index = get_job_index(db)
+    if index is not None:
+        index.sync(db, all_job_ids)
+    return index
+
+
+def refresh_job_index(job_ids, db):
+    """ Reads again the rows of the jobs, for the records that were
+        written without the functions in ``jobs/storage.py``. """
+    index = get_job_index(db)
+    if index is not None:
+        index.add_from_db(db, list(job_ids))
+        index.commit()
+
+
+def job_index_writing(db, job_id):
+    """ Call before writing the records of the job: the job is listed in
+        'inflight' (in a batch, by ``BatchDB.flush()``); if the index is
+        not used, it is invalidated. """
+    index = get_job_index(db)
+    if index is None:
+        invalidate_index_marker(db, JobIndex.marker)
+        return
+    index.writing(job_id)
+    if not isinstance(db, BatchDB):
+        index.commit_marks()
+
+
+def update_job_index(db, method, job_id, *args):
+    """ Calls ``method`` of the index of the DB; the changes are
+        written by the next :py:func:`job_index_writing` or
+        :py:func:`commit_job_index` (in a batch, by ``BatchDB.flush()``).
+    """
+    index = get_job_index(db)
+    if index is None:
+        return
+    getattr(index, method)(job_id, *args)
+
+
+def commit_job_index(db):
+    """ Writes the changes to the index of the DB, and removes the jobs
+        written from 'inflight'. """
+    if isinstance(db, BatchDB):
+        return
+    index = get_job_index(db)
+    if index is not None:
+        index.commit()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    Lazy substitution of the dependencies, for jobs defined with
+    ``comp(..., lazy_deps=True)``.
+
+    Each Promise in the arguments is replaced by a :py:class:`LazyResult`,
+    a proxy that loads the result of the job the first time it is used
+    (attribute, item, operator, ``isinstance()``, ...). The time spent
+    loading is accounted in ``int_load_results`` rather than in
+    ``int_compute``.
+"""
+import operator
+
+from ..structures import IntervalTimer
+
+__all__ = [
+    'LazyLoader',
+    'LazyResult',
+]
+
+
+class LazyLoader(object):
+    """ Loads the results for the proxies of one job, once each, and
+        keeps track of the time spent. """
+
+    def __init__(self, db):
+        self.db = db
+        self.loaded = {}  # job_id -> value
+        self.walltime = 0.0
+        self.cputime = 0.0
+
+    def load(self, job_id):
+        if not job_id in self.loaded:
+            from .dependencies import substitute_dependencies
+            from .storage import get_job_userobject
+            timer = IntervalTimer()
+            ob = get_job_userobject(job_id, db=self.db)
+            # the results can contain other promises
+            ob = substitute_dependencies(ob, db=self.db, loader=self)
+            timer.stop()
+            self.walltime += timer.get_walltime_used()
+            self.cputime += timer.get_cputime_used()
+            self.loaded[job_id] = ob
+        return self.loaded[job_id]
+
+    def account_time(self, int_load_results, int_compute):
+        """ Moves the time spent loading during the computation
+            from int_compute to int_load_results. """
+        int_load_results.t1 += self.walltime
+        int_load_results.c1 += self.cputime
+        int_compute.t0 += self.walltime
+        int_compute.c0 += self.cputime
+
+
+def _identity(x):
+    return x
+
+
+class LazyResult(object):
+    """ Transparent proxy for the result of the job ``job_id``. """
+
+    __slots__ = ['_job_id', '_loader']
+
+    def __init__(self, job_id, loader):
+        object.__setattr__(self, '_job_id', job_id)
+        object.__setattr__(self, '_loader', loader)
+
+    def _lazy_load(self):
+        return self._loader.load(self._job_id)
+
+    def _lazy_is_loaded(self):
+        return self._job_id in self._loader.loaded
+
+    # isinstance() uses __class__
+    @property
+    def __class__(self):
+        return type(self._lazy_load())
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lazy_load(), name)
+
+    def __repr__(self):
+        return repr(self._lazy_load())
+
+    def __str__(self):
+        return str(self._lazy_load())
+
+    def __bool__(self):
+        return bool(self._lazy_load())
+
+    __nonzero__ = __bool__
+
+    def __hash__(self):
+        return hash(self._lazy_load())
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __reduce__(self):
+        # pickling (and deepcopy) sees the actual value
+        return _identity, (self._lazy_load(),)
+
+
+def _unwrap(x):
+    if type(x) is LazyResult:
+        return x._lazy_load()
+    return x
+
+
+def _forward(name):
+    def method(self, *args, **kwargs):
+        return getattr(self._lazy_load(), name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+def _binary(op):
+    def method(self, other):
+        return op(self._lazy_load(), _unwrap(other))
+
+    return method
+
+
+def _reflected(op):
+    def method(self, other):
+        return op(_unwrap(other), self._lazy_load())
+
+    return method
+
+
+for _name in ['__getitem__', '__setitem__', '__delitem__', '__len__',
+              '__iter__', '__reversed__', '__contains__', '__call__',
+              '__enter__', '__exit__', '__int__', '__float__', '__index__',
+              '__neg__', '__pos__', '__abs__', '__invert__']:
+    setattr(LazyResult, _name, _forward(_name))
+
+for _name, _op in [('eq', operator.eq), ('ne', operator.ne),
+                   ('lt', operator.lt), ('le', operator.le),
+                   ('gt', operator.gt), ('ge', operator.ge)]:
+    setattr(LazyResult, '__%s__' % _name, _binary(_op))
+
+for _name, _op in [('add', operator.add), ('sub', operator.sub),
+                   ('mul', operator.mul), ('truediv', operator.truediv),
+                   ('floordiv', operator.floordiv), ('mod', operator.mod),
+                   ('pow', operator.pow), ('and', operator.and_),
+                   ('or', operator.or_), ('xor', operator.xor),
+                   ('lshift', operator.lshift), ('rshift', operator.rshift)]:
+    setattr(LazyResult, '__%s__' % _name, _binary(_op))
+    setattr(LazyResult, '__r%s__' % _name, _reflected(_op))
+
+if hasattr(operator, 'div'):  # Python 2
+    setattr(LazyResult, '__div__', _binary(operator.div))
+    setattr(LazyResult, '__rdiv__', _reflected(operator.div))
+
+if hasattr(operator, 'matmul'):
+    setattr(LazyResult, '__matmul__', _binary(operator.matmul))
+    setattr(LazyResult, '__rmatmul__', _reflected(operator.matmul))
@@ -9,7 +9,8 @@ from abc import ABCMeta, abstractmethod
 from multiprocessing import TimeoutError
 
 from compmake.constants import CompmakeConstants
-from compmake.jobs.storage import db_job_add_dynamic_children, db_job_add_parent
+from compmake.jobs.storage import (db_job_add_dynamic_children,
+                                   db_job_add_parent, indices_commit)
 from compmake.state import get_compmake_config
 from contracts import ContractsMeta, contract, indent
 
@@ -19,7 +20,7 @@ from .queries import direct_children, direct_parents
 from .uptodate import CacheQueryDB
 from ..events import publish
 from ..exceptions import CompmakeBug, HostFailed, JobFailed, JobInterrupted
-from ..jobs import (assert_job_exists, get_job_cache, job_cache_exists,
+from ..jobs import (assert_job_exists, get_job, get_job_cache, job_cache_exists,
                     job_exists, job_userobject_exists)
 from ..jobs.actions_newprocess import result_dict_check
 from ..structures import Cache
@@ -273,6 +274,10 @@ class Manager(ManagerLog):
 
             self.log('chosen next_job', job_id=job_id)
 
+            if self.is_cut_off(job_id):
+                self.job_cut_off(job_id)
+                continue
+
             self.start_job(job_id)
             n += 1
 
@@ -564,6 +569,53 @@ class Manager(ManagerLog):
         del self.processing2result[job_id]
         self.done.add(job_id)
 
+        self.schedule_parents(job_id)
+
+    def is_cut_off(self, job_id):
+        """ True if the job, about to start, is up to date after all,
+            because its dependencies were remade with the same results
+            (see the config switch ``early_cutoff``).
+
+            The job is ready, so its dependencies are done or up to
+            date: only their caches are read, and compared with the
+            digests that the job used. """
+        if not get_compmake_config('early_cutoff'):
+            return False
+        cache = get_job_cache(job_id, db=self.db)
+        used = getattr(cache, 'hashes_dependencies', None)
+        if (cache.state != Cache.DONE or not used or
+                cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+            return False
+        for child in direct_children(job_id, db=self.db):
+            child_cache = get_job_cache(child, db=self.db)
+            if child_cache.state != Cache.DONE:
+                return False
+            if child_cache.timestamp <= cache.timestamp:
+                continue
+            # (a result without digest cannot be compared)
+            digest = getattr(child_cache, 'result_digest', None)
+            if digest is None or used.get(child, None) != digest:
+                return False
+        for definer in get_job(job_id, db=self.db).defined_by:
+            if definer == 'root' or definer in self.done:
+                continue
+            if get_job_cache(definer, db=self.db).state != Cache.DONE:
+                return False
+        return True
+
+    def job_cut_off(self, job_id):
+        """ Marks the job in ready_todo as done without running it. """
+        self.log('job_cut_off', job_id=job_id)
+        self.check_invariants()
+        publish(self.context, 'manager-job-succeeded', job_id=job_id)
+        self.ready_todo.remove(job_id)
+        self.done.add(job_id)
+
+        self.schedule_parents(job_id)
+
+    def schedule_parents(self, job_id):
+        """ Moves the parents of the job (done) that are now ready
+            from todo to ready_todo. """
         # parent_jobs = set(direct_parents(job_id, db=self.db))
         from compmake.jobs.uptodate import direct_uptodate_deps_inverse
         parent_jobs = direct_uptodate_deps_inverse(job_id, db=self.db)
@@ -704,6 +756,9 @@ class Manager(ManagerLog):
                     publish(self.context, 'manager-phase', phase='wait')
 
                 self.loop_until_something_finishes()
+                indices_commit(self.db)
+                # the fsync()s of the durability 'batch'
+                self.db.sync()
                 self.check_invariants()
             self.log(indent(self._get_situation_string(), 'ending: '))
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    Prefetching in the ``parmake`` workers.
+
+    With each job, the manager sends the job that it will probably give
+    next to the same worker (the "hint"). While the current job computes,
+    a thread of the worker reads the arguments of the hinted job and
+    reads and deserializes the results of its dependencies, up to the
+    size given by the config switch ``worker_prefetch``.
+
+    When the job is then run, its records are taken from what was
+    prefetched (a "hit") if they have not changed in the meantime, and
+    read from the DB otherwise (a "miss"); the counts are saved in the
+    fields ``prefetch_hits`` and ``prefetch_misses`` of the Cache.
+"""
+import copy
+import os
+import threading
+
+from compmake import get_compmake_config
+
+from .shared_results import SharedResults
+from .storage import (get_job, get_job_userobject, job2jobargskey,
+                      job2userobjectkey)
+
+__all__ = [
+    'Prefetcher',
+    'PrefetchedDB',
+]
+
+
+class Prefetcher(object):
+    """
+        The prefetching thread of a worker. The thread uses its own copy
+        of the DB object (without the open files and connections).
+    """
+
+    # the one of this worker process (see get_worker_prefetcher())
+    current = None
+
+    def __init__(self, db, max_bytes):
+        # (the workers receive a new DB object with each job)
+        self.db = db
+        self.basepath = db.basepath
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self.thread_db = None
+        self.thread = None
+        # the job being prefetched, and the one to prefetch after take()
+        self.job_id = None
+        self.next_hint = None
+        self.cancelled = False
+        # key -> (cache token, value)
+        self.loaded = {}
+
+    def set_hint(self, job_id):
+        """ Sets the job to prefetch once the current one is taken. """
+        self.next_hint = job_id
+
+    def _start(self, job_id):
+        self._stop()
+        if self.thread_db is None:
+            # (copied here, while the DB object is not being used)
+            self.thread_db = copy.deepcopy(self.db)
+        self.job_id = job_id
+        self.cancelled = False
+        self.loaded = {}
+        self.thread = threading.Thread(target=self._prefetch,
+                                       args=(job_id,),
+                                       name='compmake-prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _stop(self):
+        if self.thread is not None:
+            self.cancelled = True
+            self.thread.join()
+            self.thread = None
+
+    def _prefetch(self, job_id):
+        db = self.thread_db
+        try:
+            job = get_job(job_id, db)
+            args_key = job2jobargskey(job_id)
+            tokens = db.cache_tokens([args_key])
+            if not args_key in tokens:
+                return
+            # The arguments are deserialized by the worker, with the
+            # __main__ module of the job (see get_job_args()).
+            nbytes = tokens[args_key][1]
+            self.loaded[args_key] = (tokens[args_key][0],
+                                     db.get_record(args_key))
+            if getattr(job, 'lazy_deps', False):
+                # loaded only if used
+                return
+            # (can include some that are not in the arguments)
+            deps = sorted(job.children)
+            keys = [job2userobjectkey(d) for d in deps]
+            tokens = db.cache_tokens(keys)
+            for dep, key in zip(deps, keys):
+                if self.cancelled or not key in tokens:
+                    return
+                if SharedResults.is_shared(dep):
+                    continue  # will be mapped
+                token, size = tokens[key]
+                if nbytes + size > self.max_bytes:
+                    return
+                nbytes += size
+                self.loaded[key] = (token, get_job_userobject(dep, db))
+        except Exception:
+            # It will be read again by the worker, which reports errors.
+            pass
+
+    def take(self, job_id, db):
+        """
+            Returns the :py:class:`PrefetchedDB` for running the job,
+            with what was prefetched for it that is still valid; then
+            starts prefetching the hinted job.
+        """
+        if self.job_id == job_id:
+            # waiting is not worse than reading the same records
+            self.thread.join()
+            self.thread = None
+            loaded = self.loaded
+        else:
+            self._stop()
+            loaded = {}
+        self.job_id = None
+        self.loaded = {}
+
+        tokens = db.cache_tokens(list(loaded)) if loaded else {}
+        values = {}
+        for key, (token, value) in loaded.items():
+            if key in tokens and tokens[key][0] == token:
+                values[key] = value
+        prefetched = PrefetchedDB(db, values)
+
+        if self.next_hint is not None and self.next_hint != job_id:
+            self._start(self.next_hint)
+        self.next_hint = None
+        return prefetched
+
+
+class PrefetchedDB(object):
+    """
+        A view of the DB used while running one job: the records
+        prefetched for it are taken from memory, once; the arguments and
+        the results read from the DB are counted as misses.
+    """
+
+    def __init__(self, db, values):
+        self.db = db
+        # key -> the record (arguments) or the value (results)
+        self.values = values
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'PrefetchedDB(%r)' % self.db
+
+    def __getattr__(self, name):
+        # everything else is the DB's
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def __getitem__(self, key):
+        if key in self.values:
+            self.hits += 1
+            value = self.values.pop(key)
+            if key.startswith('cm-args-'):
+                value = self.db.loads(value)
+            return value
+        if key.startswith('cm-args-') or key.startswith('cm-res-'):
+            self.misses += 1
+        return self.db[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.db
+
+
+def get_worker_prefetcher(db):
+    """ Returns the :py:class:`Prefetcher` of this worker process, or
+        None if prefetching is disabled (config switch
+        ``worker_prefetch``) or not possible with the DB. """
+    max_mb = get_compmake_config('worker_prefetch')
+    if not max_mb or not hasattr(db, 'cache_tokens'):
+        return None
+    p = Prefetcher.current
+    if p is None or p.pid != os.getpid() or p.basepath != db.basepath:
+        p = Prefetcher(db, max_bytes=max_mb * 1024 * 1024)
+        Prefetcher.current = p
+    return p
+
+
+def take_prefetched(job_id, db):
+    """ Returns the DB to use to run the job: a :py:class:`PrefetchedDB`
+        in the workers that prefetch, else ``db``. """
+    p = Prefetcher.current
+    if p is None or p.pid != os.getpid() or p.basepath != db.basepath:
+        return db
+    return p.take(job_id, db)
@@ -9,6 +9,7 @@ from contracts.utils import raise_wrapped, check_isinstance
 from compmake.exceptions import CompmakeBug
 from compmake.jobs.storage import get_job_cache
 from compmake.structures import Cache
+from .graph_index import load_graph_index
 
 
 __all__ = [
@@ -51,6 +52,14 @@ def definition_closure(jobs, db):
     #print('definition_closure(%s)' % jobs)
     check_isinstance(jobs, (list, set))
     jobs = set(jobs)
+    index = load_graph_index(db)
+    if index is not None:
+        result = index.closure('defines', jobs)
+        for a in sorted(jobs | result):
+            if not index.exists(a):
+                print('Warning: job %r does not exist anymore; ignoring.' % a)
+        return result
+
     from compmake.jobs.uptodate import CacheQueryDB
     cq = CacheQueryDB(db)
     stack = set(jobs)
@@ -77,6 +86,11 @@ def direct_parents(job_id, db):
     """ Returns the direct parents of the specified job.
         (Jobs that depend directly on this one) """
     check_isinstance(job_id,six.string_types)
+    index = load_graph_index(db)
+    if index is not None:
+        res = index.direct('parents', job_id)
+        if res is not None:
+            return res
     with trace_bugs('direct_parents(%r)' % job_id):
         computation = get_job(job_id, db=db)
         return set(computation.parents)
@@ -85,6 +99,11 @@ def direct_parents(job_id, db):
 def direct_children(job_id, db):
     """ Returns the direct children (dependencies) of the specified job """
     check_isinstance(job_id, six.string_types)
+    index = load_graph_index(db)
+    if index is not None:
+        res = index.direct('children', job_id)
+        if res is not None:
+            return res
     with trace_bugs('direct_children(%r)' % job_id):
         computation = get_job(job_id, db=db)
         return set(computation.children)
@@ -93,11 +112,24 @@ def direct_children(job_id, db):
 def children(job_id, db):
     """ Returns children, children of children, etc. """
     check_isinstance(job_id, six.string_types)
-    with trace_bugs('children(%r)' % job_id):
+    return closure(job_id, direct_children, 'children', db)
+
+
+def closure(job_id, direct, relation, db):
+    """ Returns the closure of the relation, with the graph index if
+        used, else following ``direct()``; iteratively in both cases,
+        visiting each job once. """
+    index = load_graph_index(db)
+    if index is not None and index.exists(job_id):
+        return index.closure(relation, [job_id])
+    with trace_bugs('%s(%r)' % (relation, job_id)):
         t = set()
-        for c in direct_children(job_id, db=db):
-            t.add(c)
-            t.update(children(c, db=db))
+        queue = [job_id]
+        while queue:
+            for c in direct(queue.pop(), db=db):
+                if not c in t:
+                    t.add(c)
+                    queue.append(c)
         return t
 
 
@@ -130,11 +162,4 @@ def parents(job_id, db):
     """ Returns the set of all the parents, grandparents, etc.
         (does not include job_id) """
     check_isinstance(job_id, six.string_types)
-
-    with trace_bugs('parents(%r)' % job_id):
-        t = set()
-        parents_jobs = direct_parents(job_id, db=db)
-        for p in parents_jobs:
-            t.add(p)
-            t.update(parents(p, db=db))
-        return t
+    return closure(job_id, direct_parents, 'parents', db)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+    Hand-off of the results between the ``parmake`` workers in shared
+    memory (config switch ``shared_results``; needs Python >= 3.8, for
+    ``multiprocessing.shared_memory`` and the pickle protocol 5).
+
+    A worker that computes a result with large buffers (for example,
+    NumPy arrays) pickles it again with the protocol 5, with the buffers
+    "out of band", copied to a shared memory segment. The result is
+    written to the DB as usual, before the job is reported as done: the
+    DB is still the reference.
+
+    The segment is then owned by the manager, which sends its description
+    with the jobs that use the result; the workers running them map the
+    segment instead of reading and deserializing the record, so that the
+    arrays use the shared memory directly, without copies. These arrays
+    are read-only. The manager unlinks the segment once no job left to
+    do needs it.
+
+    A segment is used only if the record in the DB is still the one that
+    was shared: the DB must give a ``cache_tokens()`` that can be
+    compared across processes (see :py:func:`shared_results_supported`).
+"""
+import os
+
+from compmake import get_compmake_config
+
+from .storage import job2userobjectkey
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    import pickle
+    from pickle import PickleBuffer
+except ImportError:
+    SharedMemory = None
+
+__all__ = [
+    'SharedResults',
+    'SharedResultsDB',
+    'SharedSegments',
+    'share_result',
+    'shared_memory_supported',
+    'shared_results_supported',
+    'take_shared',
+]
+
+# the smaller buffers are pickled with the rest of the result
+min_buffer_size = 64 * 1024
+
+
+def shared_memory_supported():
+    """ Returns True if the results can be shared. """
+    return SharedMemory is not None
+
+
+def shared_results_supported(db):
+    """ Returns True if the results in the DB can be shared: the
+        backends that have ``cache_tokens()`` (the filesystem, the
+        segments and SQLite) give tokens that are valid across
+        processes; the storage server does not. """
+    return hasattr(db, 'cache_tokens')
+
+
+def share_result(job_id, user_object, db):
+    """
+        Copies the large buffers of the result of the job (already in the
+        DB) to a new shared memory segment, if they fit in the size given
+        by the config switch ``shared_results``.
+
+        Returns the description of the segment, or None if the result is
+        not worth sharing.
+    """
+    if not shared_results_supported(db):
+        return None
+    max_bytes = get_compmake_config('shared_results') * 1024 * 1024
+    buffers = []
+
+    def buffer_callback(b):
+        if b.raw().nbytes < min_buffer_size:
+            return True  # in band
+        buffers.append(b)
+        return False
+
+    try:
+        data = pickle.dumps(user_object, protocol=5,
+                            buffer_callback=buffer_callback)
+    except Exception:
+        # will be read from the DB
+        return None
+    nbytes = sum(b.raw().nbytes for b in buffers)
+    # (the rest is sent through the queues)
+    if not buffers or nbytes > max_bytes or len(data) > nbytes:
+        return None
+
+    key = job2userobjectkey(job_id)
+    tokens = db.cache_tokens([key])
+    if not key in tokens:
+        return None
+
+    shm = SharedMemory(create=True, size=nbytes)
+    offsets = []
+    offset = 0
+    for b in buffers:
+        raw = b.raw()
+        shm.buf[offset:offset + raw.nbytes] = raw
+        offsets.append((offset, raw.nbytes))
+        offset += raw.nbytes
+    name = shm.name
+    shm.close()
+    return dict(name=name, data=data, buffers=offsets, nbytes=nbytes,
+                token=tokens[key][0])
+
+
+class SharedSegments(object):
+    """
+        The segments owned by the manager, at most ``max_bytes``
+        in total.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # All the processes must use the same tracker, which unlinks the
+        # segments left if the manager dies; the workers started after
+        # this use this one.
+        resource_tracker.ensure_running()
+        # job_id -> (description, SharedMemory, parents)
+        self.segments = {}
+        self.nbytes = 0
+
+    def add(self, job_id, description, parents):
+        """ Takes the ownership of the segment with the result of the
+            job, used by the jobs ``parents``. """
+        try:
+            shm = SharedMemory(name=description['name'])
+        except OSError:
+            return
+        nbytes = description['nbytes']
+        if job_id in self.segments or self.nbytes + nbytes > self.max_bytes:
+            unlink_segment(shm)
+            return
+        self.segments[job_id] = (description, shm, set(parents))
+        self.nbytes += nbytes
+
+    def descriptions(self, job_ids):
+        """ Returns a dict job_id -> description for the results of the
+            jobs that are in shared memory. """
+        return dict((job_id, self.segments[job_id][0])
+                    for job_id in job_ids if job_id in self.segments)
+
+    def release_unneeded(self, pending):
+        """ Unlinks the segments that no job in ``pending`` needs. """
+        for job_id, (_, _, parents) in list(self.segments.items()):
+            if not parents & pending:
+                self.release(job_id)
+
+    def release(self, job_id):
+        description, shm, _ = self.segments.pop(job_id)
+        self.nbytes -= description['nbytes']
+        unlink_segment(shm)
+
+    def release_all(self):
+        for job_id in list(self.segments):
+            self.release(job_id)
+
+
+def unlink_segment(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except OSError:
+        pass
+
+
+class SharedResults(object):
+    """ The results in shared memory that a worker process can map. """
+
+    pid = None
+    # job_id -> description
+    available = {}
+    # name -> SharedMemory
+    handles = {}
+
+    @staticmethod
+    def set_available(descriptions):
+        """ Sets the results that can be mapped while running the next
+            job (given by the manager with the job). """
+        if SharedResults.pid != os.getpid():
+            # (the handles of the manager are not ours)
+            SharedResults.pid = os.getpid()
+            SharedResults.handles = {}
+        SharedResults.available = descriptions
+        names = set(d['name'] for d in descriptions.values())
+        for name, shm in list(SharedResults.handles.items()):
+            if name in names:
+                continue
+            try:
+                shm.close()
+            except BufferError:
+                # still used by some array
+                continue
+            del SharedResults.handles[name]
+
+    @staticmethod
+    def is_shared(job_id):
+        return job_id in SharedResults.available
+
+    @staticmethod
+    def load(description):
+        name = description['name']
+        if not name in SharedResults.handles:
+            SharedResults.handles[name] = SharedMemory(name=name)
+        buf = SharedResults.handles[name].buf
+        buffers = [buf[offset:offset + n].toreadonly()
+                   for offset, n in description['buffers']]
+        return pickle.loads(description['data'], buffers=buffers)
+
+
+def take_shared(job, db):
+    """ Returns the DB to use to read the dependencies of the job: a
+        :py:class:`SharedResultsDB` if some of them are in shared
+        memory, else ``db``. """
+    available = SharedResults.available
+    if (not available or SharedResults.pid != os.getpid() or
+            not shared_results_supported(db)):
+        return db
+    deps = sorted(d for d in job.children if d in available)
+    if not deps:
+        return db
+    keys = [job2userobjectkey(d) for d in deps]
+    tokens = db.cache_tokens(keys)
+    values = {}
+    for dep, key in zip(deps, keys):
+        description = available[dep]
+        if not key in tokens or tokens[key][0] != description['token']:
+            continue  # changed in the meantime
+        try:
+            values[key] = SharedResults.load(description)
+        except OSError:
+            continue  # already unlinked
+    if not values:
+        return db
+    return SharedResultsDB(db, values)
+
+
+class SharedResultsDB(object):
+    """
+        A view of the DB used while running one job: the results in
+        shared memory are taken from there.
+    """
+
+    def __init__(self, db, values):
+        self.db = db
+        # key -> the result
+        self.values = values
+        self.hits = 0
+
+    def __repr__(self):
+        return 'SharedResultsDB(%r)' % self.db
+
+    def __getattr__(self, name):
+        # everything else is the DB's
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def __getitem__(self, key):
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+        return self.db[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.db
@@ -3,13 +3,29 @@
     These are all wrappers around the raw methods in storage
 """
 
+import copy
+import hashlib
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
 from compmake.exceptions import CompmakeBug, CompmakeException, CompmakeDBError
 from compmake.utils.pickle_frustration import pickle_main_context_load
 from contracts import contract
 from contracts.utils import raise_desc
 
-from ..structures import Cache, Job
-from ..utils import wildcard_to_regexp
+from ..storage.batch import BatchDB
+from ..storage.records import compress_record
+from ..storage.serializers import (choose_serializer, serialize,
+                                   serialize_canonical)
+from ..structures import Cache, Job, ResultRef
+from .graph_index import (commit_graph_index, graph_index_writing,
+                          update_graph_index)
+from .job_index import commit_job_index, job_index_writing, update_job_index
 
 
 def job2key(job_id):
@@ -27,12 +43,9 @@ def all_jobs(db, force_db=False):
         If force_db is True, read jobs from DB.
         Otherwise, use local cache.
      """
-    pattern = job2key('*')
-    regexp = wildcard_to_regexp(pattern)
-
-    for key in db.keys():
-        if regexp.match(key):
-            yield key2job(key)
+    prefix = job2key('')
+    for key in db.keys(prefix=prefix):
+        yield key2job(key)
 
 
 def get_job(job_id, db):
@@ -58,17 +71,61 @@ def set_job(job_id, job, db):
     # TODO: check if they changed
     key = job2key(job_id)
     assert (isinstance(job, Job))
+    indices_writing(db, job_id)
     db[key] = job
+    update_job_index(db, 'set_job', job_id, job)
+    update_graph_index(db, 'set_job', job_id, job)
+
+
+def indices_writing(db, job_id):
+    """ Call before writing the job and cache records (see
+        :py:func:`job_index_writing`). """
+    job_index_writing(db, job_id)
+    graph_index_writing(db, job_id)
+
+
+def indices_commit(db):
+    """ Writes the changes to the indices; call it after each job, and
+        at the end of each iteration of the manager and of each command.
+    """
+    commit_job_index(db)
+    commit_graph_index(db)
 
 
 def delete_job(job_id, db):
     key = job2key(job_id)
+    indices_writing(db, job_id)
     del db[key]
+    update_job_index(db, 'delete', job_id)
+    update_graph_index(db, 'delete', job_id)
 
 
 #
 # Cache objects
 #
+def get_jobs_and_caches(job_ids, db):
+    """
+        Reads at once (with ``db.get_many()``) the Job and the Cache of
+        the jobs; returns two dicts job_id -> Job and job_id -> Cache,
+        only for the jobs that exist (NOT_STARTED if there is no cache).
+    """
+    job_ids = list(job_ids)
+    keys = [job2key(j) for j in job_ids] + [job2cachekey(j) for j in job_ids]
+    values = db.get_many(keys)
+    jobs = {}
+    caches = {}
+    for job_id in job_ids:
+        job = values.get(job2key(job_id), None)
+        if job is None:
+            continue
+        jobs[job_id] = job
+        cache = values.get(job2cachekey(job_id), None)
+        if cache is None:
+            cache = Cache(Cache.NOT_STARTED)
+        caches[job_id] = cache
+    return jobs, caches
+
+
 def job2cachekey(job_id):
     prefix = 'cm-cache-'
     return '%s%s' % (prefix, job_id)
@@ -116,15 +173,60 @@ def job_cache_sizeof(job_id, db):
 
 
 def set_job_cache(job_id, cache, db):
+    """ The captured output and the backtrace are written to the record
+        'cm-logs-<job_id>', so that the cache record stays small. """
     assert (isinstance(cache, Cache))
     key = job2cachekey(job_id)
+    logs_key = job2logskey(job_id)
+    indices_writing(db, job_id)
+    logs = dict((k, getattr(cache, k, None)) for k in Cache.logs_fields)
+    stored = getattr(cache, 'logs_stored', False)
+    if any(v is not None for v in logs.values()):
+        if stored and logs_key in db:
+            # only some were set again
+            for k, v in db[logs_key].items():
+                if logs[k] is None:
+                    logs[k] = v
+        db[logs_key] = logs
+        cache = copy.copy(cache)
+        for k in Cache.logs_fields:
+            setattr(cache, k, None)
+        cache.logs_stored = True
+    elif not stored and logs_key in db:
+        # the ones of a previous run
+        del db[logs_key]
     db[key] = cache
+    update_job_index(db, 'set_cache', job_id, cache)
+    update_graph_index(db, 'set_cache', job_id, cache)
 
 
 @contract(job_id=str)
 def delete_job_cache(job_id, db):
     key = job2cachekey(job_id)
+    indices_writing(db, job_id)
     del db[key]
+    logs_key = job2logskey(job_id)
+    if logs_key in db:
+        del db[logs_key]
+    update_job_index(db, 'set_cache', job_id, Cache(Cache.NOT_STARTED))
+    update_graph_index(db, 'set_cache', job_id, Cache(Cache.NOT_STARTED))
+
+
+def job2logskey(job_id):
+    prefix = 'cm-logs-'
+    return '%s%s' % (prefix, job_id)
+
+
+def get_job_logs(job_id, db):
+    """ Returns a dict with the fields ``backtrace``, ``captured_stdout``,
+        ``captured_stderr`` of the cache of the job (None if not
+        available). """
+    cache = get_job_cache(job_id, db)
+    logs_key = job2logskey(job_id)
+    if getattr(cache, 'logs_stored', False) and logs_key in db:
+        return db[logs_key]
+    # (caches written by older versions have them inline)
+    return dict((k, getattr(cache, k, None)) for k in Cache.logs_fields)
 
 
 #
@@ -151,11 +253,16 @@ def get_job_userobject(job_id, db):
     # print('loading %r ' % job_id)
     key = job2userobjectkey(job_id)
     res = db[key]
+    if isinstance(res, ResultRef):
+        res = get_blob(res.digest, db)
     # print('... done')
     return res
 
 
 def job_userobject_sizeof(job_id, db):
+    ref = get_job_result_ref(job_id, db)
+    if ref is not None:
+        return db.sizeof(digest2blobkey(ref.digest))
     key = job2userobjectkey(job_id)
     return db.sizeof(key)
 
@@ -168,14 +275,231 @@ def is_job_userobject_available(job_id, db):
 job_userobject_exists = is_job_userobject_available
 
 
-def set_job_userobject(job_id, obj, db):
+def set_job_userobject(job_id, obj, db, serializer=None):
+    """ Writes the result of the job. Returns the SHA1 of the serialized
+        result if the config switch "early_cutoff" or "dedup_results" is
+        set, else None. """
     key = job2userobjectkey(job_id)
-    db[key] = obj
+    old_ref = get_job_result_ref(job_id, db)
+
+    from compmake import get_compmake_config
+    dedup = get_compmake_config('dedup_results')
+    digest = None
+    data = None
+    if dedup or get_compmake_config('early_cutoff'):
+        data = serialize_value(key, obj, db, serializer)
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+        if data is not None and dedup and len(data) >= dedup_min_size:
+            if old_ref is not None and old_ref.digest == digest:
+                # the same result as before: nothing to write (and the
+                # job is not listed as being written in the index)
+                return digest
+            job_index_writing(db, job_id)
+            set_blob(digest, data, job_id, db)
+            db[key] = ResultRef(digest=digest, size=len(data))
+            if old_ref is not None:
+                release_blob(old_ref.digest, job_id, db)
+            update_job_index(db, 'set_result_size', job_id,
+                             db.sizeof(digest2blobkey(digest)))
+            return digest
+
+    job_index_writing(db, job_id)
+    if data is not None:
+        # (hashed above: not serialized again)
+        nbytes = set_serialized(key, data, db)
+    else:
+        if serializer is None:
+            db[key] = obj
+        else:
+            db.set(key, obj, serializer=serializer)
+        nbytes = db.sizeof(key)
+    if old_ref is not None:
+        release_blob(old_ref.digest, job_id, db)
+    update_job_index(db, 'set_result_size', job_id, nbytes)
+    return digest
+
+
+def serialize_value(key, obj, db, serializer=None, canonical=False):
+    """ Returns the bytes of the value serialized as ``db.set(key, obj,
+        serializer)`` does, before the compression; None if it cannot be
+        serialized (then the error is reported by ``db.set()``). With
+        ``canonical``, see :py:func:`serialize_canonical`. """
+    name = choose_serializer(key, serializer,
+                             getattr(db, 'serializer', None),
+                             getattr(db, 'serializers', None))
+    try:
+        if canonical:
+            return serialize_canonical(obj, name)
+        return serialize(obj, name)
+    except Exception:
+        return None
+
+
+def set_serialized(key, data, db):
+    """ Writes the value serialized by :py:func:`serialize_value`;
+        returns the size of the record. """
+    record = compress_record(data, getattr(db, 'compression', None))
+    db.set_record(key, record)
+    return len(record)
 
 
 def delete_job_userobject(job_id, db):
     key = job2userobjectkey(job_id)
+    old_ref = get_job_result_ref(job_id, db)
+    job_index_writing(db, job_id)
     del db[key]
+    if old_ref is not None:
+        release_blob(old_ref.digest, job_id, db)
+    update_job_index(db, 'set_result_size', job_id, 0)
+
+
+#
+# Content-addressed results
+#
+# If the config switch "dedup_results" is set, a result is serialized and
+# stored once as 'cm-blob-<digest>', the SHA1 of the serialized bytes;
+# 'cm-res-<job_id>' then contains a ResultRef. The record
+# 'cm-ref-<digest>' is the set of the jobs using the blob; the blob is
+# deleted with the last of them. The set and the blob are read and
+# written holding the lock file 'blobs.lock' in the DB directory, so
+# that parallel workers do not lose references or delete a blob that
+# another one has just started using.
+#
+# (The DBs written by older versions have one key
+# 'cm-ref-<digest>-<job_id>' per reference; they are converted to the
+# set the first time that the blob is used or released.)
+
+# smaller results are stored inline
+dedup_min_size = 1024
+
+# a ResultRef record is smaller than this
+result_ref_max_size = 512
+
+# written with the first blob: without it, no result is a ResultRef
+dedup_marker_key = 'cm-dedup'
+
+# the lock file in the DB directory
+blobs_lock_filename = 'blobs.lock'
+
+
+def digest2blobkey(digest):
+    prefix = 'cm-blob-'
+    return '%s%s' % (prefix, digest)
+
+
+def digest2refkey(digest):
+    prefix = 'cm-ref-'
+    return '%s%s' % (prefix, digest)
+
+
+def uses_blobs(db):
+    """ True if results were ever written in the content-addressed store
+        of the DB. """
+    # (kept on the DB object: a DB created again at the same path is new)
+    if getattr(db, 'dedup_marker_seen', False):
+        return True
+    if dedup_marker_key in db:
+        db.dedup_marker_seen = True
+        return True
+    return False
+
+
+def get_job_result_ref(job_id, db):
+    """ Returns the ResultRef if the result of the job is in the
+        content-addressed store, else None. """
+    if not uses_blobs(db):
+        return None
+    key = job2userobjectkey(job_id)
+    if not key in db:
+        return None
+    if db.sizeof(key) > result_ref_max_size:
+        # too big: not a reference
+        return None
+    ob = db[key]
+    if isinstance(ob, ResultRef):
+        return ob
+    return None
+
+
+def get_job_result_digest(job_id, db):
+    """ Returns the digest of the result of the job, or None if the result
+        is not in the content-addressed store. Jobs with the same digest
+        have the same result. """
+    ref = get_job_result_ref(job_id, db)
+    return ref.digest if ref is not None else None
+
+
+def get_blob(digest, db):
+    key = digest2blobkey(digest)
+    if not key in db:
+        msg = 'Could not find the content-addressed result %r.' % key
+        raise CompmakeBug(msg)
+    # (written by set_serialized(): one record for the serialized value)
+    return db[key]
+
+
+@contextmanager
+def blobs_lock(db):
+    """ Holds the lock of the content-addressed store of the DB. """
+    basepath = getattr(db, 'basepath', None)
+    if fcntl is None or basepath is None:  # pragma: no cover (Windows)
+        yield
+        return
+    filename = os.path.join(basepath, blobs_lock_filename)
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # also releases the lock
+
+
+def get_blob_refs(digest, db):
+    """ Returns the set of jobs using the blob. Call with the lock. """
+    ref_key = digest2refkey(digest)
+    if ref_key in db:
+        return set(db[ref_key])
+    if not digest2blobkey(digest) in db:
+        return set()
+    # written by an older version: one key per reference
+    legacy = db.keys(prefix=ref_key + '-')
+    refs = set(key[len(ref_key) + 1:] for key in legacy)
+    db[ref_key] = refs
+    for key in legacy:
+        del db[key]
+    return refs
+
+
+def set_blob(digest, data, job_id, db):
+    if not uses_blobs(db):
+        db[dedup_marker_key] = True
+        db.dedup_marker_seen = True
+    with blobs_lock(db):
+        refs = get_blob_refs(digest, db)
+        refs.add(job_id)
+        db[digest2refkey(digest)] = refs
+        key = digest2blobkey(digest)
+        if not key in db:
+            # the bytes are already serialized
+            set_serialized(key, data, db)
+
+
+def release_blob(digest, job_id, db):
+    """ Removes the reference of job_id; deletes the blob if it was the
+        last one. """
+    with blobs_lock(db):
+        refs = get_blob_refs(digest, db)
+        refs.discard(job_id)
+        ref_key = digest2refkey(digest)
+        if refs:
+            db[ref_key] = refs
+            return
+        if ref_key in db:
+            del db[ref_key]
+        key = digest2blobkey(digest)
+        if key in db:
+            del db[key]
 
 
 def job2jobargskey(job_id):
@@ -205,9 +529,34 @@ def job_args_sizeof(job_id, db):
     return db.sizeof(key)
 
 
-def set_job_args(job_id, obj, db):
+def set_job_args(job_id, obj, db, serializer=None, data=None):
+    """ If given, data are the arguments already serialized by
+        :py:func:`serialize_job_args`. """
     key = job2jobargskey(job_id)
-    db[key] = obj
+    if data is not None:
+        set_serialized(key, data, db)
+    elif serializer is None:
+        db[key] = obj
+    else:
+        db.set(key, obj, serializer=serializer)
+
+
+def serialize_job_args(job_id, obj, db, serializer=None):
+    """ Returns the arguments serialized for :py:func:`set_job_args`
+        (with the sets sorted, so that the bytes do not depend on the hash
+        seed), or None if they cannot be serialized. """
+    return serialize_value(job2jobargskey(job_id), obj, db, serializer,
+                           canonical=True)
+
+
+def job_args_digest(data):
+    """ Returns the SHA1 of the arguments serialized by
+        :py:func:`serialize_job_args`, or None. The same digest means the
+        same arguments (but equal arguments might still be serialized
+        differently, for example by other serializers than 'pickle'). """
+    if data is None:
+        return None
+    return hashlib.sha1(data).hexdigest()
 
 
 def delete_job_args(job_id, db):
@@ -253,9 +602,19 @@ def db_job_add_parent(db, job_id, parent):
 
 
 def db_job_add_parent_relation(child, parent, db):
+    if isinstance(db, BatchDB):
+        # written once at the end of the batch
+        db.add_parent_relation(child, parent)
+        return
+    db_job_add_parent_relations(child, set([parent]), db)
+
+
+def db_job_add_parent_relations(child, parents, db):
     child_comp = get_job(child, db=db)
     orig = set(child_comp.parents)
-    want = orig | set([parent])
+    want = orig | set(parents)
+    if want == orig:
+        return
     # alright, need to take care of race condition
     while True:
         # Try to write
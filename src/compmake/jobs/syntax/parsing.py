@@ -32,6 +32,7 @@ from compmake.jobs.uptodate import CacheQueryDB
 from contracts import check_isinstance, contract
 
 from .. import get_job
+from ..job_index import load_job_index
 from ...exceptions import CompmakeSyntaxError, UserError
 from ...structures import Cache
 from ...utils import expand_wildcard
@@ -99,17 +100,17 @@ def list_matching_functions(token, context, cq):
 
     function_id = token[:-2]
 
-    num_matches = 0
-    for job_id in cq.all_jobs():
+    def check(job_id):
         # command name (f.__name__)
         command_desc = get_job(job_id, db=db).command_desc
-        if function_id.lower() == command_desc.lower():
-            yield job_id
-            num_matches += 1
+        return function_id.lower() == command_desc.lower()
 
-    if num_matches == 0:
+    res = filter_jobs(cq, 'LOWER(command) = ?', (function_id.lower(),),
+                      check)
+    if not res:
         raise UserError('Could not find matches for function "%s()".' %
                         function_id)
+    return res
 
 
 def expand_job_list_token(token, context, cq):
@@ -173,17 +174,32 @@ class Operators(object):
         return list(map(token2op, tokens))
 
 
+def filter_jobs(cq, where, params, check):
+    """
+        Returns the jobs (in the order of ``cq.all_jobs()``) whose row in
+        the job index matches the SQL condition ``where``; if the index
+        is not used, the ones for which ``check(job_id)`` is true.
+    """
+    all_jobs = cq.all_jobs()
+    index = load_job_index(cq.db, all_jobs)
+    if index is None:
+        return [job_id for job_id in all_jobs if check(job_id)]
+    selected = index.job_ids(where, params)
+    return [job_id for job_id in all_jobs if job_id in selected]
+
+
 def list_jobs_with_state(state, context, cq):  # @UnusedVariable
     """ Returns a list of jobs in the given state. """
-    for job_id in cq.all_jobs():
-        if cq.get_job_cache(job_id).state == state:  # TODO
-            yield job_id
+    return filter_jobs(cq, 'state = ?', (state,),
+                       lambda job_id: cq.get_job_cache(job_id).state == state)
 
 
 def list_ready_jobs(context, cq):  # @UnusedVariable
     """ Returns a list of jobs that can be done now,
         as their dependencies are up-to-date. """
-    for job_id in cq.all_jobs():
+    all_jobs = cq.all_jobs()
+    cq.up_to_date_many(all_jobs)
+    for job_id in all_jobs:
         if cq.dependencies_up_to_date(job_id):
             yield job_id
 
@@ -191,7 +207,9 @@ def list_ready_jobs(context, cq):  # @UnusedVariable
 def list_uptodate_jobs(context, cq):  # @UnusedVariable
     """ Returns a list of jobs that are uptodate
         (DONE, and all depednencies DONE)."""
-    for job_id in cq.all_jobs():
+    all_jobs = cq.all_jobs()
+    cq.up_to_date_many(all_jobs)
+    for job_id in all_jobs:
         up, _, _ = cq.up_to_date(job_id)
         if up:
             yield job_id
@@ -202,34 +220,28 @@ def list_todo_jobs(context, cq):  # @UnusedVariable
         Returns a list of jobs that haven't been DONE.
         Note that it could be DONE but not up-to-date.
     """
-    for job_id in cq.all_jobs():
-        if cq.get_job_cache(job_id).state != Cache.DONE:
-            yield job_id
+    return filter_jobs(cq, 'state != ?', (Cache.DONE,),
+                       lambda job_id:
+                       cq.get_job_cache(job_id).state != Cache.DONE)
 
 
 def list_root_jobs(context, cq):  # @UnusedVariable
     """ Returns a list of jobs that were defined by the original process.  """
-    for job_id in cq.all_jobs():
-        job = cq.get_job(job_id)
-        if is_root_job(job):
-            yield job_id
+    return filter_jobs(cq, 'depth = 0', (),
+                       lambda job_id: is_root_job(cq.get_job(job_id)))
 
 
 def list_generated_jobs(context, cq):  # @UnusedVariable
     """ Returns a list of jobs that were generated by other jobs.  """
-    for job_id in cq.all_jobs():
-        job = cq.get_job(job_id)
-        if not is_root_job(job):
-            yield job_id
+    return filter_jobs(cq, 'depth > 0', (),
+                       lambda job_id: not is_root_job(cq.get_job(job_id)))
 
 
 def list_levelX_jobs(context, cq, X):  # @UnusedVariable
     """ Returns a list of jobs that are at level X """
-    for job_id in cq.all_jobs():
-        job = cq.get_job(job_id)
-        level = len(job.defined_by) - 1
-        if level == X:
-            yield job_id
+    return filter_jobs(cq, 'depth = ?', (X,),
+                       lambda job_id:
+                       len(cq.get_job(job_id).defined_by) - 1 == X)
 
 
 def list_level1_jobs(context, cq):
@@ -263,10 +275,8 @@ def is_dynamic_job(job):
 def list_dynamic_jobs(context, cq):  # @UnusedVariable
     """ Returns a list of jobs that are uptodate
         (DONE, and all depednencies DONE)."""
-    for job_id in cq.all_jobs():
-        job = cq.get_job(job_id)
-        if is_dynamic_job(job):
-            yield job_id
+    return filter_jobs(cq, 'dynamic = 1', (),
+                       lambda job_id: is_dynamic_job(cq.get_job(job_id)))
 
 
 def list_top_jobs(context, cq):  # @UnusedVariable
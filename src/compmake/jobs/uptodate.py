@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+from array import array
 from contextlib import contextmanager
 
+from compmake import get_compmake_config
 from compmake.exceptions import CompmakeDBError
 from contracts import check_isinstance, contract
 from contracts.utils import raise_wrapped, raise_desc
@@ -9,6 +11,7 @@ from ..exceptions import CompmakeBug
 from ..structures import Cache, Job
 from ..utils import memoized_reset
 from .dependencies import collect_dependencies
+from .graph_index import load_graph_index
 from .queries import jobs_defined
 from .storage import get_job_userobject
 
@@ -113,18 +116,39 @@ class CacheQueryDB(object):
 
     def __init__(self, db):
         self.db = db
+        self.prefetched = set()
+        # job_id -> result of up_to_date()
+        self.uptodate = {}
 
     def invalidate(self):
+        self.prefetched = set()
         self.get_job_cache.reset()
         self.get_job.reset()
         self.all_jobs.reset()
         self.job_exists.reset()
-        self.up_to_date.reset()
+        self.uptodate = {}
         self.direct_children.reset()
         self.direct_parents.reset()
         self.dependencies_up_to_date.reset()
         self.jobs_defined.reset()
 
+    def prefetch(self, job_ids):
+        """ Reads at once (see ``get_many()`` of the DB) the Job and
+            Cache records of the jobs, for the following queries. """
+        from .storage import get_jobs_and_caches
+
+        todo = [j for j in job_ids if not j in self.prefetched]
+        if len(todo) < 2:
+            return
+        self.prefetched.update(todo)
+        jobs, caches = get_jobs_and_caches(todo, self.db)
+        for job_id in todo:
+            exists = job_id in jobs
+            self.job_exists.prime((job_id,), exists)
+            if exists:
+                self.get_job.prime((job_id,), jobs[job_id])
+                self.get_job_cache.prime((job_id,), caches[job_id])
+
     @memoized_reset
     @contract(returns=Cache)
     def get_job_cache(self, job_id):
@@ -157,53 +181,171 @@ class CacheQueryDB(object):
 
         return job_exists(job_id=job_id, db=self.db)
 
-    @memoized_reset
     @contract(returns='tuple(bool, str, float)')
     def up_to_date(self, job_id):
-        with db_error_wrap("up_to_date()", job_id=job_id):
-            return self._up_to_date_actual(job_id)
-
-    @contract(returns='tuple(bool, str, float)')
-    def _up_to_date_actual(self, job_id):
-        with db_error_wrap("_up_to_date_actual()", job_id=job_id):
-            cache = self.get_job_cache(job_id)  # OK
-
-            if cache.state == Cache.NOT_STARTED:
-                return False, 'Not started', cache.timestamp
-
-            if cache.timestamp == Cache.TIMESTAMP_TO_REMAKE:
-                return False, 'Marked invalid', cache.timestamp
-
-            dependencies = self.direct_children(job_id)
+        res = self.uptodate.get(job_id, None)
+        if res is None:
+            with db_error_wrap("up_to_date()", job_id=job_id):
+                self.up_to_date_many([job_id])
+            res = self.uptodate[job_id]
+        return res
 
-            for child in dependencies:
-                child_up, _, child_timestamp = self.up_to_date(child)
+    def up_to_date_many(self, job_ids):
+        """
+            Computes :py:func:`up_to_date` for the jobs and for all the
+            ones they depend on, without recursion: the jobs are read
+            breadth first (prefetching each level at once), numbered, and
+            evaluated in one sweep in topological order, with arrays of
+            the states and timestamps.
+
+            A job is up to date if it is done, its dependencies are up to
+            date and not newer than it, and the jobs that defined it are
+            up to date. The dependencies of the jobs that are not started
+            or marked invalid are not read.
+
+            With the config switch ``early_cutoff``, a dependency newer
+            than the job does not count if its result has the same digest
+            as the one the job used.
+        """
+        early_cutoff = get_compmake_config('early_cutoff')
+        status = self.uptodate
+        # int -> job_id
+        ids = []
+        num = {}
+        # int -> dependencies (children, then definers), as lists of ints
+        deps = []
+        states = array('b')
+        timestamps = array('d')
+        # int -> the set returned by direct_children(), and the definers
+        children_sets = {}
+        definers = {}
+        # int -> hashes_dependencies of the cache
+        used_digests = {}
+        # int -> error reading the job (raised only if its state is needed)
+        errors = {}
+
+        def add(job_id):
+            num[job_id] = len(ids)
+            ids.append(job_id)
+            deps.append(())
+
+        level = []
+        for job_id in job_ids:
+            if not job_id in status and not job_id in num:
+                add(job_id)
+                level.append(job_id)
+        if not level:
+            return
+
+        while level:
+            self.prefetch(level)
+            next_level = []
+            for job_id in level:
+                i = num[job_id]
+                try:
+                    cache = self.get_job_cache(job_id)
+                except CompmakeDBError as e:
+                    errors[i] = e
+                    states.append(Cache.NOT_STARTED)
+                    timestamps.append(0.0)
+                    continue
+                states.append(cache.state)
+                timestamps.append(cache.timestamp)
+                if (cache.state == Cache.NOT_STARTED or
+                        cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+                    continue
+                children = self.direct_children(job_id)
+                defined_by = list(self.get_job(job_id).defined_by)
+                defined_by.remove('root')
+                children_sets[i] = children
+                definers[i] = defined_by
+                if early_cutoff:
+                    used_digests[i] = getattr(cache, 'hashes_dependencies',
+                                              None) or {}
+                for d in list(children) + defined_by:
+                    if not d in status and not d in num:
+                        add(d)
+                        next_level.append(d)
+                deps[i] = [num[d] for d in list(children) + defined_by
+                           if d in num]
+            level = next_level
+
+        order = topological_order(deps)
+        n = len(ids)
+        up = bytearray(n)
+
+        def get(job_id):
+            if job_id in num:
+                j = num[job_id]
+                if j in errors:
+                    raise errors[j]
+                return up[j], timestamps[j]
+            res = status[job_id]
+            return res[0], res[2]
+
+        for i in order:
+            if i in errors:
+                continue
+            job_id = ids[i]
+            timestamp = timestamps[i]
+            if states[i] == Cache.NOT_STARTED:
+                status[job_id] = False, 'Not started', timestamp
+                continue
+            if timestamp == Cache.TIMESTAMP_TO_REMAKE:
+                status[job_id] = False, 'Marked invalid', timestamp
+                continue
+
+            children = children_sets[i]
+            reason = None
+            for child in children:
+                child_up, child_timestamp = get(child)
                 if not child_up:
-                    return False, 'At least: Dep %r not up to date.' % child, cache.timestamp
-                else:
-                    if child_timestamp > cache.timestamp:
-                        return (
-                            False, 'At least: Dep %r have been updated.' % child, cache.timestamp)
-
-            # plus jobs that defined it
-            defined_by = list(self.get_job(job_id).defined_by)
-            defined_by.remove('root')
-            dependencies.update(defined_by)
-
-            for defby in defined_by:
-                defby_up, _, _ = self.up_to_date(defby)
-                if not defby_up:
-                    return False, 'Definer %r not up to date.' % defby, cache.timestamp
-                # don't check timestamp for definers
+                    reason = 'At least: Dep %r not up to date.' % child
+                    break
+                if child_timestamp > timestamp:
+                    if early_cutoff and self.same_result(child,
+                                                         used_digests[i]):
+                        continue
+                    reason = 'At least: Dep %r have been updated.' % child
+                    break
+            if reason is not None:
+                status[job_id] = False, reason, timestamp
+                continue
+
+            # From now on, the jobs that defined it are seen as
+            # dependencies by dependencies_up_to_date() and
+            # list_todo_targets().
+            children.update(definers[i])
+            for defby in definers[i]:
+                if not get(defby)[0]:
+                    reason = 'Definer %r not up to date.' % defby
+                    break
+            # don't check timestamp for definers
 
             # FIXME BUG if I start (in progress), children get updated,
             # I still finish the computation instead of starting again
-            if cache.state == Cache.FAILED:
-                return False, 'Failed', cache.timestamp
-
-            assert (cache.state == Cache.DONE)
-
-            return True, '', cache.timestamp
+            if reason is None and states[i] == Cache.FAILED:
+                reason = 'Failed'
+            if reason is not None:
+                status[job_id] = False, reason, timestamp
+                continue
+
+            assert states[i] == Cache.DONE
+            up[i] = 1
+            status[job_id] = True, '', timestamp
+
+        for job_id in job_ids:
+            if num.get(job_id, None) in errors:
+                raise errors[num[job_id]]
+
+    def same_result(self, job_id, hashes_dependencies):
+        """ True if the result of the job has the digest in
+            ``hashes_dependencies``, recorded by the job that used it. """
+        used = hashes_dependencies.get(job_id, None)
+        if used is None:
+            return False
+        cache = self.get_job_cache(job_id)
+        return getattr(cache, 'result_digest', None) == used
 
     @memoized_reset
     def direct_children(self, job_id):
@@ -229,6 +371,10 @@ class CacheQueryDB(object):
     def tree(self, jobs):
         """ More efficient version of tree()
             which is direct_children() recursively. """
+        index = load_graph_index(self.db)
+        if index is not None and all(index.exists(j) for j in jobs):
+            return list(index.closure('children', jobs))
+
         stack = []
 
         stack.extend(jobs)
@@ -254,35 +400,24 @@ class CacheQueryDB(object):
              ready: ready to do (dependencies_up_to_date)
         """
         with db_error_wrap("list_todo_targets()", jobs=jobs):
+            self.prefetch(jobs)
             for j in jobs:
                 if not self.job_exists(j):
                     raise_desc(CompmakeBug, "Job does not exist", job_id=j)
 
             todo = set()
             done = set()
-            seen = set()
-            stack = list()
-            stack.extend(jobs)
-
-            class A:
-                count = 0
-
-            def summary():
-                A.count += 1
-                if A.count % 100 != 0:
-                    return
-
-            while stack:
-                summary()
-
-                job_id = stack.pop()
-                seen.add(job_id)
-                res = self.up_to_date(job_id)
-
-                up, _, _ = res
-                if up:
-                    done.add(job_id)
-                else:
+            seen = set(jobs)
+            # breadth first: each level is evaluated in one sweep
+            level = list(jobs)
+            while level:
+                self.up_to_date_many(level)
+                next_level = []
+                for job_id in level:
+                    up, _, _ = self.up_to_date(job_id)
+                    if up:
+                        done.add(job_id)
+                        continue
                     todo.add(job_id)
                     for child in self.direct_children(job_id):
                         if not self.job_exists(child):
@@ -293,7 +428,9 @@ class CacheQueryDB(object):
                                     'Try "delete not root" to fix the DB.')
                             raise CompmakeBug(msg)
                         if not child in seen:
-                            stack.append(child)
+                            seen.add(child)
+                            next_level.append(child)
+                level = next_level
 
             todo_and_ready = set([job_id for job_id in todo
                                   if self.dependencies_up_to_date(job_id)])
@@ -333,6 +470,37 @@ class CacheQueryDB(object):
         return result
 
 
+def topological_order(deps):
+    """ Returns the nodes 0..n-1 so that each comes after its
+        dependencies (``deps[i]``: list of nodes), with an iterative
+        depth-first search. """
+    n = len(deps)
+    # 0: not visited, 1: visiting, 2: done
+    mark = bytearray(n)
+    order = []
+    for root in range(n):
+        if mark[root]:
+            continue
+        mark[root] = 1
+        stack = [(root, 0)]
+        while stack:
+            i, k = stack[-1]
+            if k < len(deps[i]):
+                stack[-1] = (i, k + 1)
+                j = deps[i][k]
+                if mark[j] == 0:
+                    mark[j] = 1
+                    stack.append((j, 0))
+                elif mark[j] == 1:
+                    msg = 'Cycle in the dependencies of the jobs.'
+                    raise CompmakeBug(msg)
+            else:
+                mark[i] = 2
+                order.append(i)
+                stack.pop()
+    return order
+
+
 @contextmanager
 def db_error_wrap(what, **args):
     try:
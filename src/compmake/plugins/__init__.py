@@ -29,6 +29,11 @@ from . import list_jobs_imp
 from . import reload_module
 from . import sanity_check
 from . import stats
+from . import storage_compact
+from . import storage_du
+from . import storage_gc
+from . import storage_layout
+from . import storage_server
 
 # Useful for debugging events
 # TODO: mail, html_status
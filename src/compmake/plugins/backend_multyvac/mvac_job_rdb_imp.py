@@ -4,6 +4,8 @@ from compmake.exceptions import CompmakeBug, HostFailed, JobFailed
 from compmake.jobs import result_dict_check
 from compmake.jobs import (get_job_args, job2cachekey, job2jobargskey, 
     job2key, job2userobjectkey)
+from compmake.jobs.graph_index import refresh_graph_index
+from compmake.jobs.job_index import refresh_job_index
 from .logging_imp import disable_logging_if_config
 from compmake.state import get_compmake_config
 from compmake.storage.filesystem import StorageFilesystem
@@ -104,6 +106,10 @@ def transfer_down(db, vol, rdb_db, job_id, new_jobs):
         remote_path = os.path.relpath(fr, rdb_db.basepath)
         #print('down %r->%r' % (remote_path, local_path))
         vol.get_file(remote_path, local_path)
+        db.record_key(key)
+    # the records were not written by set_job() / set_job_cache()
+    refresh_job_index([job_id] + list(new_jobs), db)
+    refresh_graph_index([job_id] + list(new_jobs), db)
  
  
 def get_keys_to_download(job_id, new_jobs, results=False):
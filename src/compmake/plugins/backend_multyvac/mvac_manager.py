@@ -165,7 +165,7 @@ class MVacManager(Manager):
                 # else:
                 f = parmake_job2
                 args = (job_id, self.context,
-                        self.event_queue_name, self.show_output)
+                        self.event_queue_name, self.show_output, None, None)
             else:
                 f = mvac_job
                 args = (job_id, self.context,
@@ -5,6 +5,9 @@ from compmake.constants import CompmakeConstants
 from compmake.events import publish
 from compmake.events.registrar import register_handler, remove_all_handlers
 from compmake.jobs.actions import make
+from compmake.jobs.prefetch import get_worker_prefetcher
+from compmake.jobs.shared_results import SharedResults, share_result
+from compmake.jobs.storage import indices_commit
 from compmake.exceptions import JobFailed, JobInterrupted
 from compmake.utils import setproctitle
 from contracts import check_isinstance, contract
@@ -16,10 +19,19 @@ __all__ = [
 ]
 
 
-@contract(args='tuple(str, *,  str, bool)')
+@contract(args='tuple(str, *,  str, bool, None|str, None|dict)')
 def parmake_job2(args):
     """
-    args = tuple job_id, context, queue_name, show_events
+    args = tuple job_id, context, queue_name, show_events, hint, shared
+
+    hint is the job that this worker will probably run next, to prefetch
+    (see compmake.jobs.prefetch), or None.
+
+    shared is None if the results are not handed over in shared memory
+    (see compmake.jobs.shared_results); else, the dict job_id ->
+    description of the results in shared memory that the job and the
+    hinted one use. The description of the result of this job is
+    returned in the field "shared".
         
     Returns a dictionary with fields "user_object", "new_jobs", 'delete_jobs'.
     "user_object" is set to None because we do not want to 
@@ -27,7 +39,7 @@ def parmake_job2(args):
     because it might contain a Promise. 
    
     """
-    job_id, context, event_queue_name, show_output = args  # @UnusedVariable
+    job_id, context, event_queue_name, show_output, hint, shared = args  # @UnusedVariable
     check_isinstance(job_id, six.string_types)
     check_isinstance(event_queue_name, six.string_types)
     from .pmake_manager import PmakeManager
@@ -78,7 +90,23 @@ def parmake_job2(args):
 
         publish(context, 'worker-status', job_id=job_id, status='connected')
 
-        res = make(job_id, context=context)
+        prefetcher = get_worker_prefetcher(db)
+        if prefetcher is not None:
+            # started once this job has its arguments
+            prefetcher.set_hint(hint)
+
+        if shared is not None:
+            SharedResults.set_available(shared)
+
+        try:
+            res = make(job_id, context=context)
+        finally:
+            indices_commit(db)
+            # the fsync()s of the durability 'batch', before reporting
+            db.sync()
+
+        if shared is not None:
+            res['shared'] = share_result(job_id, res['user_object'], db)
 
         publish(context, 'worker-status', job_id=job_id, status='ended')
 
@@ -5,9 +5,14 @@ import signal
 
 from .parmake_job2_imp import parmake_job2
 from .pmakesub import PmakeSub
+from compmake import get_compmake_config
 from compmake.events import broadcast_event, publish
 from compmake.exceptions import MakeHostFailed
-from compmake.jobs import Manager, parmake_job2_new_process
+from compmake.jobs import (Manager, direct_children, direct_parents,
+                           parmake_job2_new_process)
+from compmake.jobs.shared_results import (SharedSegments,
+                                          shared_memory_supported,
+                                          shared_results_supported)
 from compmake.ui import warning
 from compmake.utils import make_sure_dir_exists
 from contracts import contract
@@ -72,7 +77,22 @@ class PmakeManager(Manager):
         logs = os.path.join(storage, 'logs')
         
         #self.signal_queue = Queue()
-        
+
+        # the results handed over in shared memory (before the subs start)
+        self.shared = None
+        max_mb = get_compmake_config('shared_results')
+        if max_mb and not self.new_process:
+            if not shared_memory_supported():
+                msg = ('The results cannot be handed over in shared memory '
+                       '(config switch "shared_results") before Python 3.8.')
+                warning(msg)
+            elif not shared_results_supported(db):
+                msg = ('The results cannot be handed over in shared memory '
+                       '(config switch "shared_results") with %r.' % db)
+                warning(msg)
+            else:
+                self.shared = SharedSegments(max_bytes=max_mb * 1024 * 1024)
+
         for i in range(self.num_processes):
             name = 'parmake_sub_%02d' % i
             write_log = os.path.join(logs, '%s.log' % name)
@@ -84,6 +104,8 @@ class PmakeManager(Manager):
                                        signal_token=signal_token, 
                                        write_log=write_log)
         self.job2subname = {}
+        # name -> the job that the sub was told to prefetch
+        self.sub_hint = {}
         # all are available
         self.sub_available.update(self.subs)
 
@@ -128,7 +150,7 @@ class PmakeManager(Manager):
         publish(self.context, 'worker-status', job_id=job_id,
                 status='apply_async')
         assert len(self.sub_available) > 0
-        name = sorted(self.sub_available)[0]
+        name = self.choose_sub(job_id)
         self.sub_available.remove(name)
         assert not name in self.sub_processing
         self.sub_processing.add(name)
@@ -142,12 +164,50 @@ class PmakeManager(Manager):
 
         else:
             f = parmake_job2
+            hint = self.choose_hint(name)
+            if self.shared is None:
+                shared = None
+            else:
+                needed = direct_children(job_id, self.db)
+                if hint is not None:
+                    needed.update(direct_children(hint, self.db))
+                shared = self.shared.descriptions(needed)
             args = (job_id, self.context,
-                    self.event_queue_name, self.show_output)
+                    self.event_queue_name, self.show_output, hint, shared)
 
         async_result = sub.apply_async(f, args)
         return async_result
 
+    def next_job(self):
+        """ Prefers the jobs that the available subs were told to
+            prefetch. """
+        for name in sorted(self.sub_available):
+            hint = self.sub_hint.get(name, None)
+            if hint is not None and hint in self.ready_todo:
+                return hint
+        return Manager.next_job(self)
+
+    def choose_sub(self, job_id):
+        """ Chooses an available sub; preferably, the one that was told
+            to prefetch the job. """
+        for name, hint in self.sub_hint.items():
+            if hint == job_id and name in self.sub_available:
+                return name
+        return sorted(self.sub_available)[0]
+
+    def choose_hint(self, name):
+        """ Returns the job that the sub will probably run next (the
+            ready one with the highest priority not already hinted to
+            another sub), or None. """
+        self.sub_hint.pop(name, None)
+        hinted = set(self.sub_hint.values())
+        candidates = [j for j in self.ready_todo if not j in hinted]
+        if not candidates:
+            return None
+        hint = max(candidates, key=lambda j: self.priorities[j])
+        self.sub_hint[name] = hint
+        return hint
+
     def event_check(self):
         if not self.show_output:
             return
@@ -168,6 +228,9 @@ class PmakeManager(Manager):
         self.event_queue.close()
         del PmakeManager.queues[self.event_queue_name]
 
+        if self.shared is not None:
+            self.shared.release_all()
+
         for name in self.sub_processing:
             self.subs[name].proc.terminate()
 
@@ -206,6 +269,21 @@ class PmakeManager(Manager):
         Manager.job_succeeded(self, job_id)
         self._clear(job_id)
 
+    def check_job_finished_handle_result(self, job_id, result):
+        Manager.check_job_finished_handle_result(self, job_id, result)
+        description = result.get('shared', None)
+        if self.shared is not None and description is not None:
+            parents = direct_parents(job_id, self.db)
+            self.shared.add(job_id, description, parents)
+            self._release_shared()
+
+    def _release_shared(self):
+        """ Unlinks the results in shared memory that no job left to do
+            needs. """
+        if self.shared is not None:
+            pending = self.todo | self.ready_todo | self.processing
+            self.shared.release_unneeded(pending)
+
     def _clear(self, job_id):
         assert job_id in self.job2subname
         name = self.job2subname[job_id]
@@ -214,6 +292,7 @@ class PmakeManager(Manager):
         assert name not in self.sub_available
         self.sub_processing.remove(name)
         self.sub_available.add(name)
+        self._release_shared()
 
     def host_failed(self, job_id):
         Manager.host_failed(self, job_id)
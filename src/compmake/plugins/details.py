@@ -3,8 +3,8 @@
 import sys
 import six
 from ..jobs import (children, direct_children, direct_parents, get_job,
-                    get_job_args, get_job_cache, job_args_sizeof,
-                    job_cache_exists,
+                    get_job_args, get_job_cache, get_job_logs,
+                    job2logskey, job_args_sizeof, job_cache_exists,
                     job_cache_sizeof, job_userobject_exists,
                     job_userobject_sizeof, parents)
 from ..structures import Cache
@@ -89,6 +89,10 @@ def list_job_detail(job_id, context, cq, max_lines):
             print('-- comp: %s' % cache2.int_compute)
             print('--   GC: %s' % cache2.int_gc)
             print('-- save: %s' % cache2.int_save_results)
+            hits = getattr(cache2, 'prefetch_hits', None)
+            if hits is not None:
+                print('prefetch: %d hits, %d misses' %
+                      (hits, cache2.prefetch_misses))
 
             print(bold('Host:') + '%s' % cache2.host)
 
@@ -107,13 +111,20 @@ def list_job_detail(job_id, context, cq, max_lines):
     else:
         cache_size = 0
 
+    logs_key = job2logskey(job_id)
+    if logs_key in db:
+        logs_size = db.sizeof(logs_key)
+        print(bold('      logs size: ') + '%s' % logs_size)
+    else:
+        logs_size = 0
+
     if job_userobject_exists(job_id, db):
         userobject_size = job_userobject_sizeof(job_id, db)
         print(bold('userobject size: ') + '%s' % userobject_size)
     else:
         userobject_size = 0
 
-    total = jobargs_size + cache_size + userobject_size
+    total = jobargs_size + cache_size + logs_size + userobject_size
     print(bold('          Total: ') + '%s' % total)
 
     def display_with_prefix(buffer, prefix,  # @ReservedAssignment
@@ -131,16 +142,18 @@ def list_job_detail(job_id, context, cq, max_lines):
             out.write('%s%s\n' % (prefix, transform(line)))
 
     if cache2 is not None:
-        stdout = cache2.captured_stdout
+        # (stored separately from the cache)
+        logs = get_job_logs(job_id, db)
+        stdout = logs['captured_stdout']
         if stdout and stdout.strip():
             print("-----> captured stdout <-----")
             display_with_prefix(stdout, prefix='|', transform=lambda x: x)
 
-        stderr = cache2.captured_stderr
+        stderr = logs['captured_stderr']
         if stderr and stderr.strip():
             print("-----> captured stderr <-----")
             display_with_prefix(stderr, prefix='|', transform=lambda x: x)
 
         if cache2.state == Cache.FAILED:
             print(red(cache2.exception))
-            print(red(cache2.backtrace))
+            print(red(logs['backtrace']))
@@ -7,7 +7,7 @@ from compmake.utils.colored import compmake_colored
 
 @ui_command(section=VISUALIZATION)
 def why(non_empty_job_list, context, cq):
-    """ Shows the last line of the error """
+    """ Shows the last line of the error, or why the job is to remake. """
     lines = []
     for job_id in non_empty_job_list:
         details = details_why_one(job_id, context, cq)
@@ -58,6 +58,11 @@ def details_why_one(job_id, context, cq):  # @UnusedVariable
                 
             details = (job_id, status, one)
             return details
+
+        reason = getattr(cache, 'remake_reason', None)
+        if (cache.state == Cache.DONE and reason is not None and
+                cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+            return (job_id, 'to remake', reason)
     
     return None
     #print('%s20s: %s' %(job_id, one))  
@@ -24,6 +24,7 @@ def gantt(job_list, context, filename='gantt.html'):
     from networkx import DiGraph
     G = DiGraph()
     cq = CacheQueryDB(db)
+    cq.prefetch(job_list)
 
     for job_id in job_list:
         cache = cq.get_job_cache(job_id)
@@ -114,6 +114,8 @@ def list_jobs(context, job_list, cq, complete_names=False, all_details=False,
         print('No jobs found.')
         return
 
+    cq.prefetch(job_list)
+
     # maximum job length
 
     max_len = 100
@@ -173,7 +173,8 @@ class MultiprocessingManager(Manager):
         os.remove(tmp_filename)
         async_result = self.pool.apply_async(parmake_job2,
                                              [(job_id, self.context,
-                                               tmp_filename, False)])
+                                               tmp_filename, False, None,
+                                               None)])
         publish(self.context, 'worker-status', job_id=job_id,
                 status='apply_async_done')
         return AsyncResultWrap(job_id, async_result, tmp_filename)
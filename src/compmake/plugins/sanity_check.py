@@ -4,9 +4,10 @@ from ..jobs import (children, direct_children, direct_parents, parents,
                     parse_job_list)
 from ..ui import COMMANDS_ADVANCED, ui_command
 from compmake.exceptions import CompmakeBug
-from compmake.ui.visualization import error
+from compmake.jobs.graph_index import load_graph_index
+from compmake.ui.visualization import error, warning
 from contracts import contract
-from compmake.jobs.storage import get_job, job_exists, all_jobs
+from compmake.jobs.storage import get_job, job_exists, all_jobs, job2key
 
 
 @ui_command(section=COMMANDS_ADVANCED, alias='check-consistency')
@@ -23,6 +24,10 @@ def check_consistency(args, context, cq,
         job_list = parse_job_list(args, context=context)
 
     job_list = list(job_list)
+    # read the jobs at once (into the MemoryCache of the DB)
+    db.get_many([job2key(job_id) for job_id in job_list])
+    # the relations below are read from the graph index
+    check_graph_index(job_list, db)
     #print('Checking consistency of %d jobs.' % len(job_list))
     errors = {}
     for job_id in job_list:
@@ -45,6 +50,23 @@ def check_consistency(args, context, cq,
 
     return 0
 
+def check_graph_index(job_list, db):
+    """ Checks that the graph index agrees with the job records;
+        otherwise, it is rebuilt. """
+    index = load_graph_index(db)
+    if index is None:
+        return
+    for job_id in job_list:
+        job = get_job(job_id, db)
+        if (index.direct('children', job_id) != set(job.children) or
+                index.direct('parents', job_id) != set(job.parents)):
+            msg = ('The graph index does not agree with the record of %r; '
+                   'rebuilding it.' % job_id)
+            warning(msg)
+            index.remove()
+            return
+
+
 @contract(returns='tuple(bool, list(str))')
 def check_job(job_id, context):
     db = context.get_compmake_db()
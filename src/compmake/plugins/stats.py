@@ -4,7 +4,9 @@ from collections import defaultdict
 
 from compmake.constants import CompmakeConstants
 
-from ..jobs import get_job, get_job_cache, parse_job_list
+from ..jobs import (get_job, get_job_cache, get_jobs_and_caches,
+                    parse_job_list)
+from ..jobs.job_index import load_job_index
 from ..structures import Cache
 from ..ui import VISUALIZATION, compmake_colored, ui_command
 from ..utils import pad_to_screen
@@ -28,27 +30,69 @@ def stats(args, context, cq):
 
     job_list = list(job_list)
     CompmakeConstants.aliases['last'] = job_list
-    display_stats(job_list, context)
+    display_stats(job_list, context, cq)
 
 
-def display_stats(job_list, context):
+def display_stats(job_list, context, cq=None):
+    """ The counts are taken from the job index, if used (config
+        switch ``job_index``); otherwise, from the records of the jobs. """
     db = context.get_compmake_db()
-    states_order = [Cache.NOT_STARTED,
-                    # Cache.IN_PROGRESS,
-                    Cache.FAILED, Cache.BLOCKED, Cache.DONE]
+    index = None
+    if cq is not None:
+        index = load_job_index(db, cq.all_jobs())
+    if index is not None:
+        function2state2count = count_from_index(index, job_list)
+        total = len(job_list)
+    else:
+        function2state2count, total = count_from_db(job_list, db)
+
+    if total == 0:
+        print(pad_to_screen('No jobs found.'))
+        return
+
+    print_stats(function2state2count)
+
+
+states_order = [Cache.NOT_STARTED,
+                # Cache.IN_PROGRESS,
+                Cache.FAILED, Cache.BLOCKED, Cache.DONE]
+
+
+def count_from_index(index, job_list):
+    """ Returns function -> state -> count. """
+    res = {}
+    for function_id, state2count in index.summary(job_list).items():
+        counts = dict((state, 0) for state in states_order)
+        counts.update(state2count)
+        counts['all'] = sum(state2count.values())
+        res[function_id] = counts
+    return res
+
+
+def count_from_db(job_list, db):
+    """ Returns function -> state -> count, and the number of jobs. """
     # initialize counters to 0
     states2count = dict(list(map(lambda x: (x, 0), states_order)))
 
     function2state2count = {}
     total = 0
 
+    # read all at once
+    jobs, caches = get_jobs_and_caches(job_list, db=db)
+
     for job_id in job_list:
 
-        cache = get_job_cache(job_id, db=db)
+        if job_id in caches:
+            cache = caches[job_id]
+        else:
+            cache = get_job_cache(job_id, db=db)
         states2count[cache.state] += 1
         total += 1
 
-        function_id = get_job(job_id, db=db).command_desc
+        if job_id in jobs:
+            function_id = jobs[job_id].command_desc
+        else:
+            function_id = get_job(job_id, db=db).command_desc
         # initialize record if not present
         if not function_id in function2state2count:
             function2state2count[function_id] = \
@@ -60,11 +104,11 @@ def display_stats(job_list, context):
         if total == 100:  # XXX: use standard method
             print("Loading a large number of jobs...\r")
 
-    if total == 0:
-        print(pad_to_screen('No jobs found.'))
-        return
+    return function2state2count, total
+
 
-        # print("Found %s jobs in total." % total)
+def print_stats(function2state2count):
+    # print("Found %s jobs in total." % total)
     #
     #     for state in states_order:
     #         desc = "%30s" % Cache.state2desc[state]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from ..storage import MemoryCache, StorageSegments
+from ..ui import COMMANDS_ADVANCED, info, ui_command
+from compmake.exceptions import UserError
+
+
+@ui_command(section=COMMANDS_ADVANCED, dbchange=True)
+def compact(context):
+    """
+        Removes the old versions of the records from a DB with the
+        'segments' backend.
+
+        The live records are copied to new segments; the other
+        processes can keep reading the DB meanwhile.
+    """
+    db = context.get_compmake_db()
+    if isinstance(db, MemoryCache):
+        db = db.db
+    if not isinstance(db, StorageSegments):
+        msg = 'The DB %s does not need to be compacted.' % db
+        raise UserError(msg)
+
+    before, after = db.compact()
+    info('Compacted the DB from %.1f MB to %.1f MB.' %
+         (before / 1e6, after / 1e6))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from compmake.constants import CompmakeConstants
+
+from ..jobs import parse_job_list
+from ..jobs.disk_usage import disk_usage
+from ..ui import VISUALIZATION, ui_command
+
+
+@ui_command(section=VISUALIZATION)
+def du(args, context, cq, top=10):
+    """
+        Shows the space used in the DB, by key type, by function and by
+        defining job, and the largest results.
+
+        Usage:
+
+            du [job list] [top=10]
+
+        Without a job list, all the records of the DB are counted
+        (including the ones that "gc" would remove).
+    """
+    if not args:
+        job_list = None
+    else:
+        job_list = list(parse_job_list(args, context=context, cq=cq))
+        CompmakeConstants.aliases['last'] = job_list
+
+    db = context.get_compmake_db()
+    usage = disk_usage(db, cq.all_jobs(), job_list)
+
+    print('By key type:')
+    for kt, (n, nbytes) in sorted(usage.by_key_type.items(),
+                                  key=lambda x: -x[1][1]):
+        print('    %-10s %10s  %7d records' % (kt, format_bytes(nbytes), n))
+
+    print('By function:')
+    display_largest(usage.by_command, top, lambda x: x + '()')
+
+    print('By defining job:')
+    display_largest(usage.by_defined_by, top, lambda x: x)
+
+    print('Largest results:')
+    for nbytes, job_id in usage.results[:top]:
+        print('    %10s  %s' % (format_bytes(nbytes), job_id))
+
+    print('Total: %s' % format_bytes(usage.total))
+
+
+def display_largest(name2bytes, top, fmt):
+    ordered = sorted(name2bytes.items(), key=lambda x: (-x[1], x[0]))
+    for name, nbytes in ordered[:top]:
+        print('    %10s  %s' % (format_bytes(nbytes), fmt(name)))
+    if len(ordered) > top:
+        rest = sum(nbytes for _, nbytes in ordered[top:])
+        print('    %10s  (%d more)' % (format_bytes(rest), len(ordered) - top))
+
+
+def format_bytes(nbytes):
+    if nbytes >= 1000 * 1000:
+        return '%.1f MB' % (nbytes / (1000.0 * 1000))
+    if nbytes >= 1000:
+        return '%.1f KB' % (nbytes / 1000.0)
+    return '%d B' % nbytes
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from ..jobs.garbage import find_garbage, remove_garbage
+from ..ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, dbchange=True)
+def gc(context, dry_run=False, min_age=3600):
+    """
+        Removes from the DB what is not needed anymore.
+
+        Arguments:
+            dry_run=False    only reports what would be removed
+            min_age=3600     only removes the files older than this (s)
+
+        This is: the results, arguments and caches of the jobs that do
+        not exist anymore, the content-addressed results not used, the
+        temporary files of interrupted writes, the spool directories of
+        the SGE backend, and the results of "parmake new_process=1".
+
+        Do not run while other processes are defining jobs in the DB.
+    """
+    db = context.get_compmake_db()
+    garbage = find_garbage(db, min_age=min_age)
+
+    count = defaultdict(lambda: 0)
+    nbytes = defaultdict(lambda: 0)
+    for g in garbage:
+        count[g.category] += 1
+        nbytes[g.category] += g.nbytes
+    for category in sorted(count):
+        info('%6d %-25s %10.1f MB' % (count[category], category,
+                                      nbytes[category] / 1e6))
+
+    if dry_run:
+        total = sum(nbytes.values())
+        info('Would reclaim %.1f MB (dry run).' % (total / 1e6))
+        return
+
+    reclaimed = remove_garbage(db, garbage)
+    info('Reclaimed %.1f MB.' % (reclaimed / 1e6))
+    if hasattr(db, 'compact') and any(g.what == 'record' for g in garbage):
+        info('Use "compact" to reclaim the space of the records.')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from ..storage import MemoryCache, StorageFilesystem
+from ..ui import COMMANDS_ADVANCED, info, ui_command
+from compmake.exceptions import UserError
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='migrate-layout', dbchange=True)
+def migrate_layout(context, layout='sharded'):
+    """
+        Moves, in place, the files of the DB to another directory layout.
+
+        Arguments:
+            layout='sharded'  'sharded' (<db>/ab/cd/<key>) or 'flat'
+
+        Nothing needs to be recomputed; the move can be interrupted
+        and resumed.
+    """
+    db = context.get_compmake_db()
+    if isinstance(db, MemoryCache):
+        db = db.db
+    if not isinstance(db, StorageFilesystem):
+        msg = 'The DB %s does not have a directory layout.' % db
+        raise UserError(msg)
+
+    nmoved = db.migrate_layout(layout)
+    info('Moved %d files; the DB layout is now %r.' % (nmoved, db.layout))
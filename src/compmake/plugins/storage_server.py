@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from ..storage import MemoryCache, StorageClient, StorageServer
+from ..ui import COMMANDS_ADVANCED, info, ui_command
+from compmake.constants import DefaultsToConfig
+from compmake.exceptions import UserError
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='storage-server')
+def storage_server(context,
+                   cache=DefaultsToConfig('storage_server_cache'),
+                   max_result=DefaultsToConfig('storage_server_max_result')):
+    """
+        Serves the DB to the other compmake processes on this machine,
+        keeping the most used records in memory, until interrupted.
+
+        Arguments:
+            cache=256         size of the cache (MB)
+            max_result=...    results larger than this (bytes) are not
+                              cached
+
+        The processes opening the same DB with the config switch
+        storage_server_connect set (and their parmake workers) connect
+        to the server.
+    """
+    db = context.get_compmake_db()
+    if isinstance(db, StorageClient):
+        msg = 'A storage server is already running for this DB.'
+        raise UserError(msg)
+    if isinstance(db, MemoryCache):
+        db = db.db
+
+    server = StorageServer(db, max_bytes=int(cache * 1024 * 1024),
+                           max_result_bytes=max_result)
+    info('Serving %s on %s.' % (db.basepath, server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    info('Storage server stopped: %s' % server.store.get_stats())
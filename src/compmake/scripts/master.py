@@ -14,7 +14,7 @@ from ..config import config_populate_optparser
 from ..context import Context
 from ..exceptions import CommandFailed, CompmakeBug, MakeFailed, UserError
 from ..jobs import all_jobs
-from ..storage import StorageFilesystem
+from ..storage import open_storage
 from ..ui import interpret_commands_wrap, info
 from ..utils import setproctitle
 
@@ -232,16 +232,8 @@ def write_atomic(filename, contents):
 def load_existing_db(dirname):
     assert os.path.isdir(dirname)
     info('Loading existing jobs DB %r.' % dirname)
-    # check if it is compressed
-    files = os.listdir(dirname)
-    for one in files:
-        if '.gz' in one:
-            compress = True
-            break
-    else:
-        compress = False
-
-    db = StorageFilesystem(dirname, compress=compress)
+    # (compressed if it was created so)
+    db = open_storage(dirname, compress=None)
     context = Context(db=db)
     jobs = list(all_jobs(db=db))
     # logger.info('Found %d existing jobs.' % len(jobs))
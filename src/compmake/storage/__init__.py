@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 from .filesystem import StorageFilesystem
+from .sqlite import StorageSQLite
+from .segments import StorageSegments
 from .memorycache import MemoryCache
-
+from .batch import BatchDB
+from .server import StorageServer, server_address
+from .client import StorageClient
+from .factory import *
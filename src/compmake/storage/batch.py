@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import copy
+from collections import OrderedDict
+
+from compmake.exceptions import CompmakeBug
+
+from .serializers import key_type
+
+__all__ = [
+    'BatchDB',
+]
+
+
+class BatchDB(object):
+    """
+        Wraps a DB and keeps in memory the records that are written,
+        until :py:func:`flush` writes them all at once (in one
+        transaction for SQLite). Used by ``Context.batch_definitions()``.
+
+        Repeated writes of the same record are coalesced. The job records
+        are kept as objects; the others are serialized right away, so
+        that later changes to the objects (for example, to the arguments
+        of a job) are not seen, as with a direct write.
+
+        The parents added with :py:func:`add_parent_relation` to jobs not
+        written in the batch are added at the end, re-reading the job
+        records as ``db_job_add_parent_relation()`` does.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # key -> (object, record, serializer); the object only for jobs
+        self.pending = OrderedDict()
+        # keys deleted from the DB
+        self.deleted = set()
+        # job key -> set of parents to add
+        self.parents = {}
+
+    def __repr__(self):
+        return 'BatchDB(%r)' % self.db
+
+    def __getattr__(self, name):
+        # everything else (basepath, dumps, ...) is the DB's
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            value, data, _ = self.pending[key]
+            if data is None:
+                return value
+            return self.db.loads(data)
+        if key in self.deleted:
+            msg = 'Could not find key %r.' % key
+            raise CompmakeBug(msg)
+        value = self.db[key]
+        if key in self.parents:
+            # (do not modify the object, which can be cached)
+            value = copy.copy(value)
+            value.parents = set(value.parents) | self.parents[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, serializer=None):
+        self.deleted.discard(key)
+        if key_type(key) == 'cm-job':
+            self.pending[key] = (value, None, serializer)
+        else:
+            data = self.db.dumps(key, value, serializer)
+            self.pending[key] = (None, data, None)
+
+    def set_record(self, key, data):
+        self.set_records([(key, data)])
+
+    def set_records(self, records):
+        for key, data in records:
+            self.deleted.discard(key)
+            self.pending[key] = (None, data, None)
+
+    def __delitem__(self, key):
+        exists = not key in self.deleted and key in self.db
+        if not key in self.pending and not exists:
+            msg = 'I expected key %r to exist before deleting' % key
+            raise ValueError(msg)
+        self.pending.pop(key, None)
+        self.parents.pop(key, None)
+        if exists:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        if key in self.deleted:
+            return False
+        return key in self.db
+
+    def get_many(self, keys):
+        res = {}
+        others = []
+        for key in keys:
+            if key in self.pending or key in self.parents:
+                res[key] = self[key]
+            elif not key in self.deleted:
+                others.append(key)
+        res.update(self.db.get_many(others))
+        return res
+
+    def contains_many(self, keys):
+        keys = [k for k in keys if not k in self.deleted]
+        res = set(k for k in keys if k in self.pending)
+        res.update(self.db.contains_many([k for k in keys if not k in res]))
+        return res
+
+    def sizeof(self, key):
+        if key in self.pending:
+            value, data, serializer = self.pending[key]
+            if data is None:
+                data = self.db.dumps(key, value, serializer)
+            return len(data)
+        if key in self.deleted:
+            msg = 'Could not find key %r.' % key
+            raise CompmakeBug(msg)
+        return self.db.sizeof(key)
+
+    def keys(self, prefix=None):
+        found = set(self.db.keys(prefix=prefix)) - self.deleted
+        for key in self.pending:
+            if not prefix or key.startswith(prefix):
+                found.add(key)
+        return sorted(found)
+
+    def add_parent_relation(self, child, parent):
+        """ Adds ``parent`` to the parents of the job ``child``. """
+        from compmake.jobs.storage import job2key
+        key = job2key(child)
+        if key in self.pending:
+            self.pending[key][0].parents.add(parent)
+        else:
+            self.parents.setdefault(key, set()).add(parent)
+
+    def flush(self):
+        """ Writes everything to the DB. """
+        from compmake.jobs.graph_index import get_graph_index
+        from compmake.jobs.job_index import get_job_index
+        from compmake.jobs.storage import db_job_add_parent_relations, key2job
+        graph = get_graph_index(self.db)
+        indices = [get_job_index(self.db), graph]
+        # the jobs of the records written below
+        for index in indices:
+            if index is not None:
+                index.commit_marks()
+        for key in sorted(self.deleted):
+            if key in self.db:
+                del self.db[key]
+        records = []
+        for key, (value, data, serializer) in self.pending.items():
+            if data is None:
+                data = self.db.dumps(key, value, serializer)
+            records.append((key, data))
+        if records:
+            self.db.set_records(records)
+        for key, parents in self.parents.items():
+            db_job_add_parent_relations(key2job(key), parents, self.db)
+        # the rows of the jobs written in the batch
+        if graph is not None:
+            # (with the parents added after set_job())
+            for key, (value, data, _) in self.pending.items():
+                if data is None:
+                    graph.set_job(key2job(key), value)
+        for index in indices:
+            if index is not None:
+                index.commit()
+
+        self.pending.clear()
+        self.deleted.clear()
+        self.parents.clear()
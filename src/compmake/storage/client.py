@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+
+from compmake.exceptions import CompmakeDBError
+
+from .records import dumps_record, loads_record
+from .server import check_socket_owner, connect, recv_message, send_message
+
+__all__ = [
+    'StorageClient',
+]
+
+
+class StorageClient(object):
+    """
+        A DB served by a :py:class:`StorageServer` (command
+        ``storage-server``) on the Unix socket ``address``.
+
+        The values are serialized here, with the settings of the DB of
+        the server, so the server only moves records. The connection is
+        opened again in each process (after a fork, or when the client
+        is sent to a worker).
+
+        There is no ``cache_token()``: the server keeps the cache, so
+        the client is not wrapped in a :py:class:`MemoryCache`.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.pid = None
+        info = self._call('info')
+        self.basepath = info['basepath']
+        self.serializer = info['serializer']
+        self.serializers = info['serializers']
+        self.compression = info['compression']
+
+    def __repr__(self):
+        return 'StorageClient(%r)' % self.address
+
+    def __getstate__(self):
+        # the socket cannot be pickled (nor shared across processes)
+        d = dict(self.__dict__)
+        d['sock'] = None
+        d['pid'] = None
+        return d
+
+    def _get_socket(self):
+        if self.sock is None or self.pid != os.getpid():
+            check_socket_owner(self.address)
+            try:
+                self.sock = connect(self.address)
+            except socket.error as e:
+                msg = ('Cannot connect to the storage server at %r: %s' %
+                       (self.address, e))
+                raise CompmakeDBError(msg)
+            self.pid = os.getpid()
+        return self.sock
+
+    def _call(self, method, *args):
+        sock = self._get_socket()
+        try:
+            send_message(sock, (method, args))
+            res = recv_message(sock)
+        except socket.error as e:
+            self.sock = None
+            msg = 'Error talking to the storage server: %s' % e
+            raise CompmakeDBError(msg)
+        if res is None:
+            self.sock = None
+            msg = 'The storage server at %r closed the connection.' % (
+                self.address)
+            raise CompmakeDBError(msg)
+        status, value = res
+        if status == 'error':
+            raise value
+        return value
+
+    def reopen_after_fork(self):
+        # Never reuse the socket of the parent process.
+        self.sock = None
+
+    def get_stats(self):
+        """ Returns the counters of the cache of the server. """
+        return self._call('stats')
+
+    def dumps(self, key, value, serializer=None):
+        """ Returns the record (serialized and compressed) that
+            ``set(key, value, serializer)`` would write. """
+        return dumps_record(key, value, serializer, self.serializer,
+                            self.serializers, self.compression)
+
+    def loads(self, data):
+        """ Inverse of :py:func:`dumps`. """
+        return loads_record(data)
+
+    def get_record(self, key):
+        return self._call('get_record', key)
+
+    def get_records(self, keys):
+        return self._call('get_records', list(keys))
+
+    def __getitem__(self, key):
+        return self.loads(self.get_record(key))
+
+    def get_many(self, keys):
+        """ Returns a dict with the values of the keys that exist. """
+        records = self.get_records(keys)
+        return dict((key, self.loads(data)) for key, data in records.items())
+
+    def __setitem__(self, key, value):  # @ReservedAssignment
+        self.set(key, value)
+
+    def set(self, key, value, serializer=None):
+        self.set_record(key, self.dumps(key, value, serializer))
+
+    def set_record(self, key, data):
+        self.set_records([(key, data)])
+
+    def set_records(self, records):
+        self._call('set_records', list(records))
+
+    def __delitem__(self, key):
+        self._call('delete', key)
+
+    def __contains__(self, key):
+        return self._call('contains', key)
+
+    def contains_many(self, keys):
+        return self._call('contains_many', list(keys))
+
+    def keys(self, prefix=None):
+        return self._call('keys', prefix)
+
+    def sizeof(self, key):
+        return self._call('sizeof', key)
+
+    def record_key(self, key):
+        self._call('record_key', key)
+
+    def sync(self, force=True):
+        """ The fsync()s are done by the server. """
+        self._call('sync', force)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    Compression of the records in the DB.
+
+    A compressed record starts with a header saying which codec was used::
+
+        b'\\x00CMC' <1 byte: length of the name> <name> <payload>
+
+    Records that do not start with the header are not compressed, except
+    for the gzip streams written by older versions (``.pickle.gz`` files),
+    which are recognized by their magic number.
+
+    The codec is chosen with the config switch ``compression``:
+
+    - ``auto``: the fastest codec available (lz4, then zstd, then zlib);
+    - a codec name, optionally with a level: ``zstd:19``, ``zlib:9``,
+      ``lzma``, ``lz4``, ``none``.
+
+    Records smaller than ``compression_threshold`` bytes are not
+    compressed, nor are the ones that compression would not make smaller.
+"""
+import gzip
+import io
+import zlib
+
+from compmake.exceptions import UserError
+
+__all__ = [
+    'register_codec',
+    'compress_data',
+    'decompress_data',
+    'choose_codec',
+]
+
+header_magic = b'\x00CMC'
+gzip_magic = b'\x1f\x8b'
+
+
+class Codec(object):
+
+    def __init__(self, name, compress, decompress, default_level):
+        self.name = name
+        self.compress = compress  # (data, level) -> data
+        self.decompress = decompress
+        self.default_level = default_level
+        self.header = bytes(header_magic + bytearray([len(name)]) +
+                            name.encode('ascii'))
+
+
+# name -> Codec
+codecs = {}
+# name -> package that must be installed
+codecs_missing = {}
+# used by 'auto', in order of preference
+fast_codecs = ['lz4', 'zstd', 'zlib']
+
+
+def register_codec(name, compress, decompress, default_level=None):
+    """ Registers a codec; ``compress(data, level)`` returns bytes. """
+    if len(name) > 255:
+        raise ValueError('Name too long: %r' % name)
+    codecs[name] = Codec(name, compress, decompress, default_level)
+    codecs_missing.pop(name, None)
+
+
+def get_codec(name):
+    if not name in codecs:
+        if name in codecs_missing:
+            msg = ('The compression codec %r needs the package %r to be '
+                   'installed.' % (name, codecs_missing[name]))
+        else:
+            msg = ('Unknown compression codec %r; known: %s.' %
+                   (name, ", ".join(sorted(codecs))))
+        raise UserError(msg)
+    return codecs[name]
+
+
+def parse_codec(spec, _cache={}):
+    """ Parses 'zstd:19' into ('zstd', 19); resolves 'auto'. """
+    if not spec in _cache:
+        if spec == 'auto':
+            name = [x for x in fast_codecs if x in codecs][0]
+            level = None
+        elif ':' in spec:
+            name, level = spec.split(':', 1)
+            try:
+                level = int(level)
+            except ValueError:
+                msg = 'Invalid compression level in %r.' % spec
+                raise UserError(msg)
+        else:
+            name, level = spec, None
+        codec = get_codec(name)
+        if level is None:
+            level = codec.default_level
+        _cache[spec] = (name, level)
+    return _cache[spec]
+
+
+def choose_codec(size, spec=None):
+    """
+        Returns the codec spec (e.g. 'zstd:3') to use for a record of
+        ``size`` bytes, given the spec for the DB (None: the config
+        switch ``compression``).
+    """
+    from compmake import get_compmake_config
+    if size < get_compmake_config('compression_threshold'):
+        return 'none'
+    if spec is None:
+        spec = get_compmake_config('compression')
+    return spec
+
+
+def compress_data(data, spec):
+    """ Compresses the data with the codec given by ``spec``; returns
+        the data unchanged if it does not get smaller. """
+    name, level = parse_codec(spec)
+    if name == 'none':
+        return data
+    codec = codecs[name]
+    compressed = codec.header + codec.compress(data, level)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress_data(data):
+    """ Inverse of :py:func:`compress_data`; also reads gzip streams. """
+    if data[:4] == header_magic:
+        n = bytearray(data[4:5])[0]
+        name = data[5:5 + n].decode('ascii')
+        return get_codec(name).decompress(data[5 + n:])
+    if data[:2] == gzip_magic:
+        with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+            return f.read()
+    return data
+
+
+register_codec('none', lambda data, level: data, lambda data: data)
+
+register_codec('zlib', lambda data, level: zlib.compress(data, level),
+               zlib.decompress, default_level=1)
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    codecs_missing['lzma'] = 'backports.lzma'
+else:
+    register_codec('lzma',
+                   lambda data, level: lzma.compress(data, preset=level),
+                   lzma.decompress, default_level=6)
+
+try:
+    import zstandard
+except ImportError:
+    codecs_missing['zstd'] = 'zstandard'
+else:
+    def zstd_compress(data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def zstd_decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    register_codec('zstd', zstd_compress, zstd_decompress, default_level=3)
+
+try:
+    import lz4.frame
+except ImportError:
+    codecs_missing['lz4'] = 'lz4'
+else:
+    def lz4_compress(data, level):
+        return lz4.frame.compress(data, compression_level=level)
+
+    register_codec('lz4', lz4_compress, lz4.frame.decompress,
+                   default_level=0)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+    How much the backends do to have the records on disk when a write
+    returns (config switch ``durability``):
+
+    - ``none``: nothing; the OS writes the data when it wants. A crash
+      of the machine (not of compmake) can lose or truncate the last
+      records.
+
+    - ``batch``: the files written are fsync()ed together, at the end
+      of each job and of each iteration of the job manager, and at
+      most every ``durability_interval`` ms while writing. A crash can
+      lose the records of the last interval.
+
+    - ``strict``: each record is on disk before the write returns.
+"""
+import errno
+import time
+
+from compmake.exceptions import UserError
+from compmake.utils.safe_write import fsync_dir, fsync_file
+
+__all__ = [
+    'durability_levels',
+    'check_durability',
+    'SyncQueue',
+]
+
+durability_levels = ['none', 'batch', 'strict']
+
+
+def check_durability(durability):
+    """ Returns the level to use: ``durability``, or the config switch
+        if None. """
+    if durability is None:
+        from compmake import get_compmake_config
+        durability = get_compmake_config('durability')
+    if not durability in durability_levels:
+        msg = ('Unknown durability %r; known: %s.' %
+               (durability, ", ".join(durability_levels)))
+        raise UserError(msg)
+    return durability
+
+
+class SyncQueue(object):
+    """ The files and the directories written in ``batch`` mode, which
+        will be fsync()ed together by :py:func:`flush`. """
+
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+        self.last = time.time()
+        # number of fsync() done
+        self.nsyncs = 0
+
+    def add_file(self, filename):
+        self.files.add(filename)
+
+    def add_dir(self, dirname):
+        self.dirs.add(dirname)
+
+    def due(self):
+        """ True if the last flush was more than ``durability_interval``
+            ms ago. """
+        from compmake import get_compmake_config
+        interval = get_compmake_config('durability_interval') / 1000.0
+        return time.time() - self.last >= interval
+
+    def flush(self, force=True):
+        """ Performs the fsync()s; if not ``force``, only if due. """
+        if not force and not self.due():
+            return
+        # first the content, then the directory entries
+        for filename in sorted(self.files):
+            try:
+                fsync_file(filename)
+            except OSError as e:
+                # it was replaced or deleted after being written
+                if e.errno != errno.ENOENT:
+                    raise
+            self.nsyncs += 1
+        for dirname in sorted(self.dirs):
+            fsync_dir(dirname)
+            self.nsyncs += 1
+        self.files.clear()
+        self.dirs.clear()
+        self.last = time.time()
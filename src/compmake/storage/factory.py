@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.exceptions import CompmakeDBError, UserError
+
+from .client import StorageClient
+from .filesystem import StorageFilesystem
+from .segments import StorageSegments
+from .server import server_address
+from .sqlite import StorageSQLite
+
+__all__ = [
+    'storage_backends',
+    'detect_storage_backend',
+    'open_storage',
+    'connect_storage_server',
+]
+
+# name -> class
+storage_backends = {
+    'filesystem': StorageFilesystem,
+    'sqlite': StorageSQLite,
+    'segments': StorageSegments,
+}
+
+
+def detect_storage_backend(dirname):
+    """ Returns the name of the backend used by an existing DB
+        directory, or None if it cannot be decided. """
+    if not os.path.isdir(dirname):
+        return None
+    if os.path.exists(os.path.join(dirname, StorageSQLite.db_filename)):
+        return 'sqlite'
+    if os.path.isdir(os.path.join(dirname, StorageSegments.dirname)):
+        return 'segments'
+    if os.path.exists(os.path.join(dirname, StorageFilesystem.layout_marker)):
+        return 'filesystem'
+    # an old DB without the marker: stop at the first record
+    for one in iter_dir(dirname):
+        if '.pickle' in one:
+            return 'filesystem'
+    return None
+
+
+def iter_dir(dirname):
+    """ Yields the names in the directory, reading it lazily if
+        possible (os.scandir()). """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        for name in os.listdir(dirname):
+            yield name
+        return
+    it = scandir(dirname)
+    try:
+        for entry in it:
+            yield entry.name
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+
+
+def open_storage(dirname, backend=None, compress=True):
+    """
+        Opens (or creates) the DB in the given directory.
+
+        If ``backend`` is None, the backend of an existing DB is
+        detected; for a new DB the config switch ``db_backend`` is used.
+
+        ``compress=None`` keeps the choice made when creating the DB.
+
+        If a storage server (command ``storage-server``) is running for
+        the DB, a client of the server is returned instead (config switch
+        ``storage_server_connect``).
+    """
+    from compmake import get_compmake_config
+    if get_compmake_config('storage_server_connect'):
+        client = connect_storage_server(dirname)
+        if client is not None:
+            return client
+
+    if backend is None:
+        backend = detect_storage_backend(dirname)
+    if backend is None:
+        backend = get_compmake_config('db_backend')
+
+    if not backend in storage_backends:
+        msg = ('Unknown DB backend %r; known: %s.' %
+               (backend, ", ".join(sorted(storage_backends))))
+        raise UserError(msg)
+
+    return storage_backends[backend](dirname, compress=compress)
+
+
+def connect_storage_server(dirname):
+    """ Returns a :py:class:`StorageClient` if a storage server is
+        running for the DB in the directory, otherwise None. """
+    if not os.path.isdir(dirname):
+        return None
+    try:
+        address = server_address(dirname)
+        if not os.path.exists(address):
+            return None
+        return StorageClient(address)
+    except CompmakeDBError:
+        # the socket was left by a server that is not running, or it
+        # belongs to another user
+        return None
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import errno
+import hashlib
 import os
 import stat
 import traceback
@@ -6,10 +8,15 @@ from glob import glob
 from os.path import basename
 
 from compmake import logger
-from compmake.exceptions import CompmakeBug, SerializationError
-from compmake.utils import (find_pickling_error, safe_pickle_dump,
-                            safe_pickle_load)
-from compmake.utils.safe_write import write_data_to_file
+from compmake.exceptions import CompmakeBug, UserError
+from compmake.utils.safe_write import (fsync_dir, safe_write,
+                                       write_data_to_file)
+
+from .durability import SyncQueue, check_durability
+from .key_manifest import KeyManifest
+from .parallel_io import io_map
+from .records import decompress_record, dumps_record, loads_record
+from .serializers import deserialize
 
 if True:
     track_time = lambda x: x
@@ -20,57 +27,191 @@ else:
 
 trace_queries = False
 
+# matches the directories of the sharded layout
+shard_glob = '[0-9a-f]' * 2
+
 __all__ = [
     'StorageFilesystem',
 ]
 
 
 class StorageFilesystem(object):
-
-    def __init__(self, basepath, compress=False):
+    """
+        Stores each record in its own pickle file.
+
+        Two directory layouts are supported:
+
+        - ``flat``: ``<basepath>/<key>.pickle.gz``
+        - ``sharded``: ``<basepath>/ab/cd/<key>.pickle.gz``, where ``abcd``
+          are the first digits of the SHA1 of the key. This keeps the
+          directories small for DBs with millions of records.
+
+        The layout of an existing DB is recorded in the file
+        ``.compmake-layout``; for a new DB it is given by the ``layout``
+        argument or by the config switch ``db_layout``.
+
+        A sharded DB also reads the records it finds in the flat layout,
+        so that an old DB can be used right away; use ``migrate_layout()``
+        (command ``migrate_layout``) to move the files.
+
+        The list of keys is kept in the manifest ``.compmake-keys`` (see
+        :py:class:`KeyManifest`), so that ``keys()`` does not need to list
+        the directories. It is rebuilt if it is missing.
+
+        The records are written with the serializer ``serializer``, or the
+        one given for their key type in ``serializers`` (see
+        :py:mod:`compmake.storage.serializers`), and then compressed if
+        ``compress`` is True (see :py:mod:`compmake.storage.compression`;
+        ``compression`` overrides the config switch ``compression``).
+        Each record says how it was written, so ``compress`` only affects
+        the new records, and the file extension (``.pickle.gz`` or
+        ``.pickle``) is fixed when the DB is created. If ``compress`` is
+        None, it is True for the DBs that were created with it.
+
+        ``durability`` ('none', 'batch', 'strict'; default: the config
+        switch ``durability``) says when the files are fsync()ed (see
+        :py:mod:`compmake.storage.durability`).
+    """
+
+    layouts = ['flat', 'sharded']
+    extensions = ['.pickle.gz', '.pickle']
+    layout_marker = '.compmake-layout'
+    manifest_filename = '.compmake-keys'
+
+    def __init__(self, basepath, compress=False, layout=None,
+                 serializer=None, serializers=None, compression=None,
+                 durability=None):
         self.basepath = os.path.realpath(basepath)
         self.checked_existence = False
-        if compress:
-            self.file_extension = '.pickle.gz'
-            others = list(self.keys0('.pickle'))
+        self.durability = check_durability(durability)
+        self.sync_queue = SyncQueue()
+        self.serializer = serializer
+        self.serializers = serializers
+
+        # the layout and the extension of an existing DB are in the marker
+        marker_layout, marker_extension = self._read_layout_marker()
+        self.layout = self._choose_layout(marker_layout or layout)
+
+        if KeyManifest.available():
+            filename = os.path.join(self.basepath, self.manifest_filename)
+            self.manifest = KeyManifest(filename)
         else:
-            self.file_extension = '.pickle'
-            others = list(self.keys0('.pickle.gz'))
-        if others:
-            msg = 'Extension is %s but found %s files with other extension.' % (self.file_extension, len(others))
-            raise Exception(msg)
+            self.manifest = None
 
+        if marker_extension is not None:
+            self.file_extension = marker_extension
+        else:
+            self.file_extension = self._detect_extension(compress)
+
+        if compress is None:
+            compress = self.file_extension == '.pickle.gz'
+        if compress:
+            self.compression = compression
+        else:
+            self.compression = 'none'
 
+        # whether we need to look for records in the flat layout
+        self.flat_leftovers = (self.layout == 'sharded' and
+                               bool(glob(self._flat_pattern())))
 
         # create a bunch of files that contain shortcuts
         create_scripts(self.basepath)
+        self._write_layout_marker()
+
+        if self.manifest is not None and not self.manifest.exists():
+            self.manifest.rebuild(self.keys0)
+
+    def _detect_extension(self, compress):
+        """ Used for new DBs and DBs created by older versions. """
+        if compress or compress is None:
+            extension, other = '.pickle.gz', '.pickle'
+        else:
+            extension, other = '.pickle', '.pickle.gz'
+        if list(self.keys0(extension)):
+            return extension
+        if list(self.keys0(other)):
+            return other
+        return extension
+
+    def _choose_layout(self, layout):
+        if layout is None:
+            from compmake import get_compmake_config
+            layout = get_compmake_config('db_layout')
+
+        if not layout in self.layouts:
+            msg = ('Unknown DB layout %r; known: %s.' %
+                   (layout, ", ".join(self.layouts)))
+            raise UserError(msg)
+        return layout
+
+    def _read_layout_marker(self):
+        """ Returns layout, extension (None if not known). """
+        marker = os.path.join(self.basepath, self.layout_marker)
+        if not os.path.exists(marker):
+            return None, None
+        with open(marker) as f:
+            lines = f.read().split()
+        layout = lines[0]
+        extension = lines[1] if len(lines) > 1 else None
+        if not extension in self.extensions + [None]:
+            msg = 'Invalid extension %r in %s.' % (extension, marker)
+            raise CompmakeBug(msg)
+        return layout, extension
+
+    def _write_layout_marker(self):
+        marker = os.path.join(self.basepath, self.layout_marker)
+        s = self.layout + '\n' + self.file_extension + '\n'
+        if os.path.exists(marker):
+            with open(marker) as f:
+                if f.read() == s:
+                    return
+        write_data_to_file(s.encode('utf-8'), marker, quiet=True)
 
     def __repr__(self):
-        return "FilesystemDB(%r;%s)" % (self.basepath, self.file_extension)
+        return "FilesystemDB(%r;%s;%s)" % (self.basepath, self.file_extension,
+                                           self.layout)
 
     @track_time
     def sizeof(self, key):
-        filename = self.filename_for_key(key)
+        filename = self.filename_for_reading(key)
         statinfo = os.stat(filename)
         return statinfo.st_size
 
-    @track_time
-    def __getitem__(self, key):
-        if trace_queries:
-            logger.debug('R %s' % str(key))
-
-        self.check_existence()
-
-        filename = self.filename_for_key(key)
-
-        if not os.path.exists(filename):
-            msg = 'Could not find key %r.' % key
-            msg += '\n file: %s' % filename
-            raise CompmakeBug(msg)
+    def cache_token(self, key):
+        """ Returns a value that changes when the record is rewritten
+            (also by other processes), or None if it does not exist;
+            used by :py:class:`MemoryCache`. """
+        try:
+            st = os.stat(self.filename_for_reading(key))
+        except OSError:
+            return None
+        # (every write creates a new file, which is then renamed)
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        return st.st_ino, mtime, st.st_size
+
+    def cache_tokens(self, keys):
+        """ Returns a dict key -> (cache_token(key), size) for the keys
+            that exist; the files are stat()ed in parallel. """
+        tokens = io_map(self.cache_token, keys)
+        return dict((k, (t, t[2])) for k, t in zip(keys, tokens)
+                    if t is not None)
+
+    def _read(self, key):
+        """ Returns the record, or None if it does not exist. """
+        filename = self.filename_for_reading(key)
+        try:
+            with open(filename, 'rb') as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
 
+    def _loads_key(self, key, data):
         try:
-            return safe_pickle_load(filename)
+            return self.loads(data)
         except Exception as e:
+            filename = self.filename_for_reading(key)
             msg = ("Could not unpickle data for key %r. \n file: %s" %
                    (key, filename))
             logger.error(msg)
@@ -78,6 +219,62 @@ class StorageFilesystem(object):
             msg += "\n" + traceback.format_exc()
             raise CompmakeBug(msg)
 
+    def get_record(self, key):
+        """ Returns the record for the key, as written by set_record(). """
+        if trace_queries:
+            logger.debug('R %s' % str(key))
+
+        self.check_existence()
+        data = self._read(key)
+        if data is None:
+            msg = 'Could not find key %r.' % key
+            msg += '\n file: %s' % self.filename_for_reading(key)
+            raise CompmakeBug(msg)
+        return data
+
+    def get_records(self, keys):
+        """ Returns a dict with the records of the keys that exist; the
+            files are read in parallel. """
+        if trace_queries:
+            logger.debug('R* %d keys' % len(keys))
+
+        keys = list(keys)
+        return dict((k, data) for k, data in zip(keys, io_map(self._read, keys))
+                    if data is not None)
+
+    def get_many(self, keys):
+        """ Returns a dict with the values of the keys that exist.
+            The files are read and decompressed in parallel. """
+        keys = list(keys)
+
+        def read(key):
+            data = self._read(key)
+            if data is None:
+                return None
+            return decompress_record(data)
+
+        res = {}
+        for key, data in zip(keys, io_map(read, keys)):
+            if data is None:
+                continue
+            try:
+                res[key] = deserialize(data)
+            except Exception:
+                # same error as db[key]
+                self._loads_key(key, data)
+        return res
+
+    def contains_many(self, keys):
+        """ Returns the set of the keys that exist. """
+        keys = list(keys)
+        exists = io_map(lambda k: os.path.exists(self.filename_for_reading(k)),
+                        keys)
+        return set(k for k, e in zip(keys, exists) if e)
+
+    @track_time
+    def __getitem__(self, key):
+        return self._loads_key(key, self.get_record(key))
+
     def check_existence(self):
         if not self.checked_existence:
             self.checked_existence = True
@@ -85,43 +282,89 @@ class StorageFilesystem(object):
                 # logger.info('Creating filesystem db %r' % self.basepath)
                 os.makedirs(self.basepath)
 
-    @track_time
     def __setitem__(self, key, value):  # @ReservedAssignment
+        self.set(key, value)
+
+    @track_time
+    def set(self, key, value, serializer=None):
+        """ Same as ``db[key] = value``, optionally choosing the
+            serializer for this record. """
+        self.set_record(key, self.dumps(key, value, serializer))
+
+    def dumps(self, key, value, serializer=None):
+        """ Returns the record (serialized and compressed) that
+            ``set(key, value, serializer)`` would write. """
+        return dumps_record(key, value, serializer, self.serializer,
+                            self.serializers, self.compression)
+
+    def loads(self, data):
+        """ Inverse of :py:func:`dumps`. """
+        return loads_record(data)
+
+    def set_record(self, key, data):
+        """ Writes a record returned by :py:func:`dumps`. """
+        self.set_records([(key, data)])
+
+    def _write_record(self, key, data):
         if trace_queries:
             logger.debug('W %s' % str(key))
 
         self.check_existence()
 
         filename = self.filename_for_key(key)
-
-        try:
-            safe_pickle_dump(value, filename)
-            assert os.path.exists(filename)
-        except KeyboardInterrupt:
-            raise
-        except BaseException as e:
-            msg = ('Cannot set key %s: cannot pickle object '
-                   'of class %s: %s' % (key, value.__class__.__name__, e))
-            logger.error(msg)
-            logger.exception(e)
-            emsg = find_pickling_error(value)
-            logger.error(emsg)
-            raise SerializationError(msg + '\n' + emsg)
+        is_new = self.manifest is not None and not os.path.exists(filename)
+        if is_new:
+            # (listed by keys() even if we die before add())
+            self.manifest.adding(key)
+        strict = self.durability == 'strict'
+        with safe_write(filename, compress=False, fsync=strict) as f:
+            f.write(data)
+        assert os.path.exists(filename)
+        if self.durability == 'batch':
+            self.sync_queue.add_file(filename)
+            self.sync_queue.add_dir(os.path.dirname(filename))
+
+        if is_new:
+            self.manifest.add(key)
+
+    def set_records(self, records):
+        """ Writes the (key, record) pairs. """
+        for key, data in records:
+            self._write_record(key, data)
+        self.sync(force=False)
+
+    def sync(self, force=True):
+        """ Performs the pending fsync()s of the ``batch`` durability (if
+            not ``force``, only if ``durability_interval`` has passed). """
+        self.sync_queue.flush(force=force)
 
     @track_time
     def __delitem__(self, key):
-        filename = self.filename_for_key(key)
+        filename = self.filename_for_reading(key)
         if not os.path.exists(filename):
             msg = 'I expected path %s to exist before deleting' % filename
             raise ValueError(msg)
         os.remove(filename)
+        if self.flat_leftovers:
+            # there might be an older copy in the flat layout
+            flat = self.filename_for_key(key, layout='flat')
+            if os.path.exists(flat):
+                os.remove(flat)
+        if self.manifest is not None:
+            self.manifest.remove(key)
+        dirname = os.path.dirname(filename)
+        if self.durability == 'strict':
+            fsync_dir(dirname)
+        elif self.durability == 'batch':
+            self.sync_queue.add_dir(dirname)
+            self.sync(force=False)
 
     @track_time
     def __contains__(self, key):
         if trace_queries:
             logger.debug('? %s' % str(key))
 
-        filename = self.filename_for_key(key)
+        filename = self.filename_for_reading(key)
         ex = os.path.exists(filename)
 
         # logger.debug('? %s %s %s' % (str(key), filename, ex))
@@ -131,18 +374,98 @@ class StorageFilesystem(object):
     def keys0(self, extension=None):
         if extension is None:
             extension = self.file_extension
-        filename = self.filename_for_key('*', extension)
-        for x in glob(filename):
-            # b = splitext(basename(x))[0]
-            b = basename(x.replace(extension, ''))
-            key = self.basename2key(b)
-            yield key
+        patterns = [self._flat_pattern(extension)]
+        if self.layout == 'sharded':
+            patterns.append(os.path.join(self.basepath, shard_glob,
+                                         shard_glob, '*' + extension))
+        for pattern in patterns:
+            for x in glob(pattern):
+                b = basename(x)[:-len(extension)]
+                key = self.basename2key(b)
+                yield key
 
     @track_time
-    def keys(self):
-        # slow process
-        found = sorted(list(self.keys0()))
-        return found
+    def keys(self, prefix=None):
+        """ Returns the sorted list of keys, optionally only the ones
+            starting with ``prefix``. """
+        if self.manifest is None:
+            # slow process
+            # (a key can be in both layouts while migrating)
+            found = set(self.keys0())
+        else:
+            found = self.manifest.keys(exists=self._record_exists)
+            if found is None:
+                self.manifest.rebuild(self.keys0)
+                found = self.manifest.keys(exists=self._record_exists)
+        if prefix:
+            found = [k for k in found if k.startswith(prefix)]
+        return sorted(found)
+
+    def _record_exists(self, key):
+        return os.path.exists(self.filename_for_reading(key))
+
+    def record_key(self, key):
+        """ Adds to the manifest a key whose file was written directly
+            to ``filename_for_key(key)`` rather than with ``db[key] = ...``.
+        """
+        if self.manifest is not None:
+            self.manifest.add(key)
+
+    def _flat_pattern(self, extension=None):
+        if extension is None:
+            extension = self.file_extension
+        return os.path.join(self.basepath, '*' + extension)
+
+    def migrate_layout(self, layout):
+        """
+            Moves the files of the DB, in place, to the given layout.
+            Returns the number of files moved.
+
+            The move is safe to interrupt: the intermediate states are
+            read as a sharded DB with leftovers in the flat layout.
+        """
+        if not layout in self.layouts:
+            msg = ('Unknown DB layout %r; known: %s.' %
+                   (layout, ", ".join(self.layouts)))
+            raise UserError(msg)
+
+        keys = self.keys()
+        # while moving, read both layouts
+        self.layout = 'sharded'
+        self.flat_leftovers = True
+        self._write_layout_marker()
+
+        other_layout = 'flat' if layout == 'sharded' else 'sharded'
+        nmoved = 0
+        for key in keys:
+            src = self.filename_for_reading(key)
+            dst = self.filename_for_key(key, layout=layout)
+            if src != dst:
+                dirname = os.path.dirname(dst)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                os.rename(src, dst)
+                nmoved += 1
+            # an older copy might be left in the other layout
+            other = self.filename_for_key(key, layout=other_layout)
+            if os.path.exists(other):
+                os.remove(other)
+
+        if layout == 'flat':
+            self._remove_empty_shards()
+
+        self.layout = layout
+        self.flat_leftovers = False
+        self._write_layout_marker()
+        return nmoved
+
+    def _remove_empty_shards(self):
+        for x in glob(os.path.join(self.basepath, shard_glob, shard_glob)):
+            if os.path.isdir(x) and not os.listdir(x):
+                os.rmdir(x)
+        for x in glob(os.path.join(self.basepath, shard_glob)):
+            if os.path.isdir(x) and not os.listdir(x):
+                os.rmdir(x)
 
     def reopen_after_fork(self):
         pass
@@ -165,12 +488,28 @@ class StorageFilesystem(object):
             key = key.replace(replacement, char)
         return key
 
-    def filename_for_key(self, key, extension=None):
+    def filename_for_key(self, key, extension=None, layout=None):
         """ Returns the pickle storage filename corresponding to the job id """
         if extension is None:
             extension = self.file_extension
+        if layout is None:
+            layout = self.layout
         f = self.key2basename(key) + extension
-        return os.path.join(self.basepath, f)
+        if layout == 'sharded':
+            h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            return os.path.join(self.basepath, h[:2], h[2:4], f)
+        else:
+            return os.path.join(self.basepath, f)
+
+    def filename_for_reading(self, key):
+        """ Returns the filename where the record is found, falling back
+            to the flat layout for old records in a sharded DB. """
+        filename = self.filename_for_key(key)
+        if self.flat_leftovers and not os.path.exists(filename):
+            flat = self.filename_for_key(key, layout='flat')
+            if os.path.exists(flat):
+                return flat
+        return filename
 
 
 def chmod_plus_x(filename):
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+__all__ = [
+    'KeyManifest',
+]
+
+
+class KeyManifest(object):
+    """
+        An append-only file that lists the keys of a DB.
+
+        Each line is either ``+key`` or ``-key``. Writers append one line,
+        holding a shared lock on ``<filename>.lock``. Before creating a
+        new record, a writer appends ``?key``, and ``+key`` once the
+        record is in place: if the writer dies in between, the key is
+        "uncertain", and :py:meth:`keys` asks whether the record exists. Readers keep the set
+        of keys in memory and only read the lines appended since the
+        last read. When the log becomes much longer than the set of keys,
+        it is compacted, holding an exclusive lock, and atomically
+        replaced. A reader that sees a new inode reads the file again
+        from the start.
+
+        Writers never create the file: if it is missing, its owner
+        rebuilds it with :py:meth:`rebuild`.
+    """
+
+    # compact when there are more than compact_ratio lines per key
+    compact_ratio = 2
+    compact_min_lines = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lockname = filename + '.lock'
+        self._forget()
+
+    def _forget(self):
+        self.index = None  # set of keys
+        self.uncertain = set()  # keys being written (or interrupted)
+        self.pos = 0  # bytes read so far
+        self.ino = None  # inode of the file read
+        self.nlines = 0  # lines read so far
+
+    def __getstate__(self):
+        # the index can be large: other processes read it again
+        d = dict(self.__dict__)
+        d.update(index=None, uncertain=set(), pos=0, ino=None, nlines=0)
+        return d
+
+    @staticmethod
+    def available():
+        """ The manifest needs fcntl locks. """
+        return fcntl is not None
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    @contextmanager
+    def _lock(self, operation):
+        fd = os.open(self.lockname, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)  # also releases the lock
+
+    def _append(self, line):
+        with self._lock(fcntl.LOCK_SH):
+            try:
+                fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # the key will be found by rebuild()
+                    return
+                raise
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+    def adding(self, key):
+        """ Called before writing a new record, followed by
+            :py:meth:`add` once it is in place. """
+        self._append('?%s\n' % key)
+
+    def add(self, key):
+        self._append('+%s\n' % key)
+        if self.index is not None:
+            self.index.add(key)
+        self.uncertain.discard(key)
+
+    def remove(self, key):
+        self._append('-%s\n' % key)
+        if self.index is not None:
+            self.index.discard(key)
+        self.uncertain.discard(key)
+
+    def keys(self, exists=None):
+        """ Returns the set of keys, or None if the file does not exist.
+            Do not modify the set returned.
+
+            ``exists(key)`` says whether the record of an uncertain key
+            exists; if not given, they are not listed. """
+        try:
+            self._refresh()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                self._forget()
+                return None
+            raise
+
+        if (self.nlines > self.compact_min_lines and
+                    self.nlines > self.compact_ratio * len(self.index)):
+            self.compact(exists)
+        if exists is None or not self.uncertain:
+            return self.index
+        found = [k for k in self.uncertain if exists(k)]
+        if not found:
+            return self.index
+        return self.index | set(found)
+
+    def _refresh(self):
+        with open(self.filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if (self.index is None or st.st_ino != self.ino or
+                        st.st_size < self.pos):
+                self.index = set()
+                self.uncertain = set()
+                self.pos = 0
+                self.nlines = 0
+                self.ino = st.st_ino
+            if st.st_size == self.pos:
+                return
+            f.seek(self.pos)
+            data = f.read()
+        # ignore a line that is still being written
+        end = data.rfind(b'\n') + 1
+        self._apply(data[:end])
+        self.pos += end
+
+    def _apply(self, data):
+        index = self.index
+        uncertain = self.uncertain
+        for line in data.decode('utf-8').split('\n'):
+            if not line:
+                continue
+            self.nlines += 1
+            key = line[1:]
+            if line[0] == '+':
+                index.add(key)
+                uncertain.discard(key)
+            elif line[0] == '?':
+                if not key in index:
+                    uncertain.add(key)
+            else:
+                index.discard(key)
+                uncertain.discard(key)
+
+    def compact(self, exists=None):
+        """ Rewrites the file with one line per key. The uncertain keys
+            whose record exists (see :py:meth:`keys`) become keys; the
+            others are kept as uncertain. """
+        with self._lock(fcntl.LOCK_EX):
+            self._forget()
+            self._refresh()
+            uncertain = self.uncertain
+            if exists is not None:
+                found = set(k for k in uncertain if exists(k))
+                self.index.update(found)
+                uncertain = uncertain - found
+            self._write(self.index, uncertain)
+
+    def rebuild(self, list_keys):
+        """ Rewrites the file using the keys returned by ``list_keys()``,
+            which is called while holding the exclusive lock. """
+        with self._lock(fcntl.LOCK_EX):
+            self._write(set(list_keys()))
+
+    def _write(self, keys, uncertain=()):
+        keys = sorted(keys)
+        uncertain = sorted(uncertain)
+        data = ''.join(['+%s\n' % k for k in keys] +
+                       ['?%s\n' % k for k in uncertain]).encode('utf-8')
+        tmp = '%s.tmp.%s' % (self.filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self.filename)
+        self.index = set(keys)
+        self.uncertain = set(uncertain)
+        self.pos = len(data)
+        self.ino = os.stat(self.filename).st_ino
+        self.nlines = len(keys) + len(uncertain)
@@ -1,55 +1,268 @@
 # -*- coding: utf-8 -*-
-import sys
+from collections import OrderedDict
+
+from .parallel_io import io_map
+from .records import decompress_record
+from .serializers import deserialize, key_type
 
 __all__ = [
     'MemoryCache',
 ]
 
 
-# noinspection PyArgumentList
 class MemoryCache(object):
+    """
+        Wraps a DB and keeps the most recently used records in memory,
+        up to ``max_bytes`` (estimated from the size of the records in
+        the DB); the least recently used are evicted first.
+
+        Records are admitted by key type: ``cm-job`` and ``cm-cache``
+        always, ``cm-res`` if smaller than ``max_result_bytes``; the
+        others (arguments, blobs, ...) are never cached.
+
+        If the DB has ``get_record()``, the serialized records are kept
+        (decompressed) and every read returns a new object: a job that
+        modifies an object that it has read does not change what the
+        other jobs read. Otherwise (the records of the storage server)
+        the values are kept as they are.
+
+        Writes and deletes go through the cache. The records written by
+        other processes are noticed using the ``cache_token(key)`` of
+        the DB (see the backends): a cached value is used only if the
+        token has not changed since it was read.
+
+        The counters ``hits``, ``misses``, ``evictions`` are
+        reported by :py:func:`get_stats`.
+    """
+
+    always_cached = ['cm-job', 'cm-cache']
+    cached_if_small = ['cm-res']
 
-    def __init__(self, db, cache_values=True):
-        self.data = {}
+    def __init__(self, db, cache_values=True, max_bytes=64 * 1024 * 1024,
+                 max_result_bytes=64 * 1024):
         self.db = db
         self.cache_values = cache_values
-        self.keys_to_cache = ':job:'
-        
-    def __getitem__(self, key):
-        if key in self.data:
-            return self.data[key]
-        ob = self.db.__getitem__(key)
-        if self.should_cache(key):
-            self.data[key] = ob
-        return ob 
-    
+        self.max_bytes = max_bytes
+        self.max_result_bytes = max_result_bytes
+        self.cache_records = hasattr(db, 'get_record')
+        self._reset()
+
+    def _reset(self):
+        # key -> (token, value or record, nbytes); in LRU order
+        # (oldest first)
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return 'MemoryCache(%r)' % self.db
+
+    def __getstate__(self):
+        # do not send the cached values to the workers
+        d = dict(self.__dict__)
+        d['data'] = OrderedDict()
+        d['nbytes'] = 0
+        return d
+
+    def __getattr__(self, name):
+        # everything else (basepath, filename_for_key, ...) is the DB's
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def get_stats(self):
+        """ Returns a dict with the counters and the memory used. """
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.data),
+                    nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+    def _token(self, key):
+        f = getattr(self.db, 'cache_token', None)
+        if f is None:
+            return 0
+        return f(key)
+
+    def _lookup(self, key):
+        """ Returns the cached (token, value, nbytes), if still valid. """
+        if not key in self.data:
+            return None
+        return self.lookup(key, self._token(key))
+
+    def lookup(self, key, token):
+        """ Returns the cached (token, value, nbytes) if the token of the
+            key in the DB, read by the caller, is still ``token``. """
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return None
+        if token != entry[0]:
+            self.nbytes -= entry[2]
+            return None
+        self.data[key] = entry  # most recently used
+        return entry
+
     def should_cache(self, key):
-        if not self.cache_values:
+        if not self.cache_values or self.max_bytes <= 0:
             return False
-        return self.keys_to_cache in key
-        
+        kt = key_type(key)
+        return kt in self.always_cached or kt in self.cached_if_small
+
+    def _value(self, entry):
+        if self.cache_records:
+            return deserialize(entry[1])
+        return entry[1]
+
+    def _loads(self, key, data):
+        try:
+            return deserialize(data)
+        except Exception:
+            # the error of the DB, with the key and the file
+            return self.db.__getitem__(key)
+
+    def __getitem__(self, key):
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return self._value(entry)
+
+        if not self.should_cache(key):
+            return self.db.__getitem__(key)
+        self.misses += 1
+
+        # read the token first: a concurrent write invalidates the value
+        token = self._token(key)
+        if self.cache_records:
+            record = self.db.get_record(key)
+            nbytes = len(record)
+            data = decompress_record(record)
+            ob = self._loads(key, data)
+        else:
+            nbytes = self.db.sizeof(key)
+            ob = data = self.db.__getitem__(key)
+        if token is None:
+            return ob
+        self.add(key, token, data, nbytes)
+        return ob
+
+    def add(self, key, token, data, nbytes):
+        """ Caches the value or the record, unless it is a result larger
+            than max_result_bytes (nbytes: the size in the DB). """
+        if (key_type(key) in self.cached_if_small and
+                    nbytes > self.max_result_bytes):
+            return
+        if self.cache_records:
+            nbytes = len(data)
+        self.data[key] = (token, data, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+
+    def _tokens(self, keys):
+        """ Returns a dict key -> (token, size or None) for the keys that
+            exist (the backends do this in bulk). """
+        f = getattr(self.db, 'cache_tokens', None)
+        if f is not None:
+            return f(keys)
+        res = {}
+        for key in keys:
+            token = self._token(key)
+            if token is not None:
+                res[key] = (token, None)
+        return res
+
+    def get_many(self, keys):
+        """ Returns a dict with the values of the keys that exist; the
+            ones not cached are read all at once from the DB. """
+        keys = list(keys)
+        tokens = self._tokens(keys)
+        res = {}
+        missing = []
+        for key in keys:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                if key in tokens and tokens[key][0] == entry[0]:
+                    self.data[key] = entry  # most recently used
+                    self.hits += 1
+                    res[key] = self._value(entry)
+                    continue
+                self.nbytes -= entry[2]
+            if self.should_cache(key):
+                self.misses += 1
+            missing.append(key)
+
+        if not missing:
+            return res
+        if self.cache_records:
+            records = self.db.get_records(missing)
+            found = list(records)
+            datas = io_map(decompress_record, [records[k] for k in found])
+            values = dict(zip(found, datas))
+        else:
+            values = self.db.get_many(missing)
+        for key, data in values.items():
+            if self.cache_records:
+                res[key] = self._loads(key, data)
+            else:
+                res[key] = data
+            if not key in tokens or not self.should_cache(key):
+                continue
+            token, nbytes = tokens[key]
+            if self.cache_records:
+                nbytes = len(records[key])
+            elif nbytes is None:
+                nbytes = self.db.sizeof(key)
+            self.add(key, token, data, nbytes)
+        return res
+
+    def contains_many(self, keys):
+        return self.db.contains_many(keys)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.data:
+            _, (_, _, nbytes) = self.data.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self.data:
+            _, _, nbytes = self.data.pop(key)
+            self.nbytes -= nbytes
+
     def __setitem__(self, key, value):
-        # TODO: check value
-        if self.should_cache(key):
-            self.data[key] = value
-        self.db[key] = value
-            
+        self.set(key, value)
+
+    def set(self, key, value, serializer=None):
+        self.invalidate(key)
+        self.db.set(key, value, serializer=serializer)
+
+    def set_record(self, key, data):
+        self.invalidate(key)
+        self.db.set_record(key, data)
+
+    def set_records(self, records):
+        for key, _ in records:
+            self.invalidate(key)
+        self.db.set_records(records)
+
     def __delitem__(self, key):
-        if key in self.data:
-            self.data.__delitem__(key)
+        self.invalidate(key)
         self.db.__delitem__(key)
-        
+
     def __contains__(self, key):
-        if key in self.data:
+        if self._lookup(key) is not None:
             return True
-        else:
-            return self.db.__contains__(key)
-  
+        return self.db.__contains__(key)
+
     def sizeof(self, key):
-        # XXX: not recursive
-        return sys.getsizeof(key)
-    
-    def keys(self):
-        return self.db.keys() 
-    
+        return self.db.sizeof(key)
+
+    def keys(self, prefix=None):
+        return self.db.keys(prefix=prefix)
+
+    def record_key(self, key):
+        self.invalidate(key)
+        self.db.record_key(key)
 
+    def reopen_after_fork(self):
+        self._reset()
+        self.db.reopen_after_fork()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    A pool of threads for the reads of ``get_many()``.
+
+    Reading files and decompressing (zlib, gzip, zstd, lz4) release the
+    GIL, so a few threads turn the latency of many small reads (for
+    example on NFS) into throughput.
+"""
+import os
+from multiprocessing.pool import ThreadPool
+
+__all__ = [
+    'io_map',
+]
+
+# below this, the overhead of the pool is not worth it
+io_map_min_size = 8
+
+
+class IOPool(object):
+    pool = None
+    pid = None
+    nthreads = None
+
+
+def get_io_pool():
+    """ Returns the pool, or None if the config switch ``db_threads``
+        is 1 or less. The pool is created again after a fork. """
+    from compmake import get_compmake_config
+    nthreads = get_compmake_config('db_threads')
+    if nthreads <= 1:
+        return None
+    if (IOPool.pool is None or IOPool.pid != os.getpid() or
+                IOPool.nthreads != nthreads):
+        # (the threads of the parent do not exist after a fork)
+        IOPool.pool = ThreadPool(nthreads)
+        IOPool.pid = os.getpid()
+        IOPool.nthreads = nthreads
+    return IOPool.pool
+
+
+def io_map(f, elements):
+    """ Returns ``list(map(f, elements))``, computed by the pool if
+        there are enough elements. """
+    elements = list(elements)
+    if len(elements) >= io_map_min_size:
+        pool = get_io_pool()
+        if pool is not None:
+            return pool.map(f, elements)
+    return list(map(f, elements))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+    The records stored by the backends: the value serialized (see
+    serializers.py) and then possibly compressed (see compression.py).
+"""
+from compmake import logger
+from compmake.exceptions import SerializationError
+from compmake.utils import find_pickling_error
+
+from .compression import choose_codec, compress_data, decompress_data
+from .serializers import (choose_serializer, deserialize, get_serializer,
+                          serialize)
+
+__all__ = [
+    'compress_record',
+    'dumps_record',
+    'loads_record',
+    'decompress_record',
+]
+
+
+def dumps_record(key, value, serializer=None, default=None, by_key_type=None,
+                 compression=None):
+    """
+        Returns the record for the value. The arguments are the ones of
+        :py:func:`choose_serializer` and :py:func:`choose_codec`.
+
+        :raise: SerializationError
+    """
+    serializer = choose_serializer(key, serializer, default, by_key_type)
+    get_serializer(serializer)  # raises UserError if not available
+    try:
+        data = serialize(value, serializer)
+        return compress_record(data, compression)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        msg = ('Cannot set key %s: cannot serialize (%s) object '
+               'of class %s: %s' % (key, serializer,
+                                    value.__class__.__name__, e))
+        logger.error(msg)
+        logger.exception(e)
+        emsg = find_pickling_error(value)
+        logger.error(emsg)
+        raise SerializationError(msg + '\n' + emsg)
+
+
+def compress_record(data, compression=None):
+    """ Returns the record for the serialized value ``data``. """
+    return compress_data(data, choose_codec(len(data), compression))
+
+
+def decompress_record(data):
+    """ Returns the serialized value; this releases the GIL. """
+    return decompress_data(bytes(data))
+
+
+def loads_record(data):
+    """ Inverse of :py:func:`dumps_record`. """
+    return deserialize(decompress_record(data))
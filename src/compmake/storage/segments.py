@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import struct
+import traceback
+import zlib
+from contextlib import contextmanager
+
+from compmake import logger
+from compmake.exceptions import CompmakeBug, UserError
+from compmake.utils.safe_write import fsync_dir, fsync_file
+
+from .durability import SyncQueue, check_durability
+from .filesystem import create_scripts
+from .parallel_io import io_map
+from .records import decompress_record, dumps_record, loads_record
+from .serializers import deserialize, pickle, pickle_protocol
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+__all__ = [
+    'StorageSegments',
+]
+
+trace_queries = False
+
+# crc32, flags, key length, record length; the crc covers the rest
+entry_header = struct.Struct('!IBHI')
+FLAG_PUT = 0
+FLAG_DELETE = 1
+
+
+def encode_entry(key, flags, data):
+    key = key.encode('utf-8')
+    rest = entry_header.pack(0, flags, len(key), len(data))[4:] + key + data
+    crc = zlib.crc32(rest) & 0xffffffff
+    return struct.pack('!I', crc) + rest
+
+
+def scan_entries(f, position):
+    """ Yields (key, flags, offset of the record, length, end) for the
+        entries starting at ``position``, until the end of the file or
+        the first incomplete (or corrupted) entry. """
+    f.seek(position)
+    while True:
+        header = f.read(entry_header.size)
+        if len(header) < entry_header.size:
+            return
+        crc, flags, klen, dlen = entry_header.unpack(header)
+        body = f.read(klen + dlen)
+        if len(body) < klen + dlen:
+            return
+        if zlib.crc32(header[4:] + body) & 0xffffffff != crc:
+            return
+        key = body[:klen].decode('utf-8')
+        start = position + entry_header.size + klen
+        position = start + dlen
+        yield key, flags, start, dlen, position
+
+
+class StorageSegments(object):
+    """
+        Appends the records to segment files
+        (``<basepath>/segments/000001.seg``, ...), so that writing a
+        small record (a job, a cache) is a sequential append instead of
+        the creation of a file.
+
+        An index key -> (segment, offset, length) is kept in memory; it is
+        built when the DB is opened, from the hint files of the full
+        segments (``000001.hint``) and by reading the last one. The
+        records appended by other processes are read before each
+        operation (one ``stat()``). Writes are serialized with a lock
+        (``flock()`` on ``segments/lock``), and each entry has a CRC, so
+        that an incomplete entry is never read.
+
+        The old versions of the records stay in the segments until
+        :py:func:`compact` (command ``compact``) rewrites the live
+        records and removes the old segments.
+
+        The serializers, the compression and the durability are chosen
+        as for :py:class:`StorageFilesystem`.
+    """
+
+    dirname = 'segments'
+    max_segment_bytes = 64 * 1024 * 1024
+
+    def __init__(self, basepath, compress=False, serializer=None,
+                 serializers=None, compression=None, durability=None):
+        if fcntl is None:
+            msg = 'The segments backend needs fcntl locks.'
+            raise UserError(msg)
+        self.basepath = os.path.realpath(basepath)
+        if compress or compress is None:
+            self.compression = compression
+        else:
+            self.compression = 'none'
+        self.serializer = serializer
+        self.serializers = serializers
+        self.durability = check_durability(durability)
+        self.sync_queue = SyncQueue()
+        self.segdir = os.path.join(self.basepath, StorageSegments.dirname)
+        if not os.path.exists(self.segdir):
+            os.makedirs(self.segdir)
+        self.lockname = os.path.join(self.segdir, 'lock')
+        self.files = {}
+        self.pid = os.getpid()
+        self._load()
+
+        # create a bunch of files that contain shortcuts
+        create_scripts(self.basepath)
+
+    def __repr__(self):
+        return "SegmentsDB(%r)" % self.segdir
+
+    def __getstate__(self):
+        # the open files cannot be pickled (nor shared across processes)
+        d = dict(self.__dict__)
+        d['files'] = {}
+        return d
+
+    def reopen_after_fork(self):
+        self._close_files()
+        self.pid = os.getpid()
+
+    def _close_files(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def segment_filename(self, n, ext='.seg'):
+        return os.path.join(self.segdir, '%06d%s' % (n, ext))
+
+    def segment_numbers(self):
+        res = []
+        for fn in os.listdir(self.segdir):
+            base, ext = os.path.splitext(fn)
+            if ext == '.seg' and base.isdigit():
+                res.append(int(base))
+        return sorted(res)
+
+    def _apply(self, n, key, flags, start, dlen):
+        if flags == FLAG_DELETE:
+            self.index.pop(key, None)
+        else:
+            self.index[key] = (n, start, dlen)
+
+    def _load(self):
+        """ Builds the index from scratch; returns the size of the last
+            segment. """
+        self._close_files()
+        # key -> (segment, offset, length)
+        self.index = {}
+        numbers = self.segment_numbers()
+        for n in numbers[:-1]:
+            for key, flags, start, dlen in self._segment_entries(n):
+                self._apply(n, key, flags, start, dlen)
+        # the last segment is read by _refresh()
+        self.segment = numbers[-1] if numbers else 1
+        self.position = 0
+        return self._refresh()
+
+    def _segment_entries(self, n):
+        """ Returns the entries of a full segment, from its hint file
+            (which is written if missing). """
+        hint = self.segment_filename(n, '.hint')
+        try:
+            with open(hint, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+        try:
+            with open(self.segment_filename(n), 'rb') as f:
+                entries = [(key, flags, start, dlen) for
+                           key, flags, start, dlen, _ in scan_entries(f, 0)]
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:  # removed by compact()
+                return []
+            raise
+        self._write_hint(n, entries)
+        return entries
+
+    def _write_hint(self, n, entries):
+        hint = self.segment_filename(n, '.hint')
+        tmp = hint + '.tmp-%s' % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(entries, f, pickle_protocol)
+        os.rename(tmp, hint)
+
+    def _refresh(self):
+        """ Reads the entries appended since the last call (also by other
+            processes); returns the size of the last segment. """
+        if self.pid != os.getpid():
+            self.reopen_after_fork()
+        while True:
+            filename = self.segment_filename(self.segment)
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                # Not created yet, or removed by compact() in another
+                # process: then the index is read again from the newer
+                # segments (and we never append to an old number).
+                numbers = self.segment_numbers()
+                if numbers and numbers[-1] > self.segment:
+                    return self._load()
+                size = 0
+            if size > self.position:
+                with open(filename, 'rb') as f:
+                    for key, flags, start, dlen, end in \
+                            scan_entries(f, self.position):
+                        self._apply(self.segment, key, flags, start, dlen)
+                        self.position = end
+            if not os.path.exists(self.segment_filename(self.segment + 1)):
+                return size
+            self.segment += 1
+            self.position = 0
+
+    @contextmanager
+    def _write_lock(self):
+        with open(self.lockname, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, entries):
+        """ Appends the (key, flags, data) entries; call with the lock. """
+        size = self._refresh()
+        filename = self.segment_filename(self.segment)
+        if size > self.position:
+            # an incomplete entry written by a process that crashed
+            with open(filename, 'ab') as f:
+                f.truncate(self.position)
+        if self.position >= self.max_segment_bytes:
+            self._write_hint(self.segment, self._segment_entries_scan())
+            self.segment += 1
+            self.position = 0
+            filename = self.segment_filename(self.segment)
+
+        chunks = []
+        position = self.position
+        applied = []
+        for key, flags, data in entries:
+            chunk = encode_entry(key, flags, data)
+            start = position + entry_header.size + len(key.encode('utf-8'))
+            applied.append((key, flags, start, len(data)))
+            chunks.append(chunk)
+            position += len(chunk)
+        with open(filename, 'ab') as f:
+            f.write(b''.join(chunks))
+            if self.durability == 'strict':
+                f.flush()
+                os.fsync(f.fileno())
+        if self.position == 0:  # a new segment
+            if self.durability == 'strict':
+                fsync_dir(self.segdir)
+            elif self.durability == 'batch':
+                self.sync_queue.add_dir(self.segdir)
+        if self.durability == 'batch':
+            self.sync_queue.add_file(filename)
+        for key, flags, start, dlen in applied:
+            self._apply(self.segment, key, flags, start, dlen)
+        self.position = position
+        self.sync(force=False)
+
+    def sync(self, force=True):
+        """ Performs the pending fsync()s of the ``batch`` durability (if
+            not ``force``, only if ``durability_interval`` has passed). """
+        self.sync_queue.flush(force=force)
+
+    def _segment_entries_scan(self):
+        with open(self.segment_filename(self.segment), 'rb') as f:
+            return [(key, flags, start, dlen) for key, flags, start, dlen, _
+                    in scan_entries(f, 0)]
+
+    def _get_file(self, n):
+        if not n in self.files:
+            self.files[n] = open(self.segment_filename(n), 'rb')
+        return self.files[n]
+
+    def _read(self, key, refresh=True):
+        """ Returns the record, or None if it does not exist. """
+        if refresh:
+            self._refresh()
+        for _ in range(2):
+            if not key in self.index:
+                return None
+            n, start, dlen = self.index[key]
+            try:
+                f = self._get_file(n)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # the segment was removed by compact() in another process
+                self._load()
+                continue
+            f.seek(start)
+            return f.read(dlen)
+        msg = 'Could not read key %r from %s.' % (key, self.segdir)
+        raise CompmakeBug(msg)
+
+    def dumps(self, key, value, serializer=None):
+        """ Returns the record (serialized and compressed) that
+            ``set(key, value, serializer)`` would write. """
+        return dumps_record(key, value, serializer, self.serializer,
+                            self.serializers, self.compression)
+
+    def loads(self, data):
+        """ Inverse of :py:func:`dumps`. """
+        return loads_record(data)
+
+    def _loads_key(self, key, data):
+        try:
+            return self.loads(data)
+        except Exception as e:
+            msg = ("Could not unpickle data for key %r. \n db: %s" %
+                   (key, self.segdir))
+            logger.error(msg)
+            logger.exception(e)
+            msg += "\n" + traceback.format_exc()
+            raise CompmakeBug(msg)
+
+    def get_record(self, key):
+        """ Returns the record for the key, as written by set_record(). """
+        if trace_queries:
+            logger.debug('R %s' % str(key))
+
+        data = self._read(key)
+        if data is None:
+            msg = 'Could not find key %r.' % key
+            msg += '\n db: %s' % self.segdir
+            raise CompmakeBug(msg)
+        return data
+
+    def get_records(self, keys):
+        """ Returns a dict with the records of the keys that exist, read
+            in the order in which they are in the segments. """
+        if trace_queries:
+            logger.debug('R* %d keys' % len(keys))
+
+        self._refresh()
+        found = sorted((self.index[k], k) for k in keys if k in self.index)
+        res = {}
+        for _, key in found:
+            data = self._read(key, refresh=False)
+            if data is not None:
+                res[key] = data
+        return res
+
+    def get_many(self, keys):
+        """ Returns a dict with the values of the keys that exist.
+            The records are decompressed in parallel. """
+        records = list(self.get_records(keys).items())
+        datas = io_map(decompress_record, [data for _, data in records])
+        res = {}
+        for (key, _), data in zip(records, datas):
+            try:
+                res[key] = deserialize(data)
+            except Exception:
+                # same error as db[key]
+                self._loads_key(key, data)
+        return res
+
+    def contains_many(self, keys):
+        """ Returns the set of the keys that exist. """
+        self._refresh()
+        return set(k for k in keys if k in self.index)
+
+    def cache_token(self, key):
+        """ Used by :py:class:`MemoryCache`: the position of the record,
+            which changes when it is written again. """
+        self._refresh()
+        entry = self.index.get(key, None)
+        return entry[:2] if entry is not None else None
+
+    def cache_tokens(self, keys):
+        """ Returns a dict key -> (cache_token(key), size) for the keys
+            that exist. """
+        self._refresh()
+        return dict((k, (self.index[k][:2], self.index[k][2]))
+                    for k in keys if k in self.index)
+
+    def sizeof(self, key):
+        self._refresh()
+        if not key in self.index:
+            msg = 'Could not find key %r.' % key
+            raise CompmakeBug(msg)
+        return self.index[key][2]
+
+    def __getitem__(self, key):
+        return self._loads_key(key, self.get_record(key))
+
+    def __setitem__(self, key, value):  # @ReservedAssignment
+        self.set(key, value)
+
+    def set(self, key, value, serializer=None):
+        """ Same as ``db[key] = value``, optionally choosing the
+            serializer for this record. """
+        self.set_record(key, self.dumps(key, value, serializer))
+
+    def set_record(self, key, data):
+        """ Writes a record returned by :py:func:`dumps`. """
+        self.set_records([(key, data)])
+
+    def set_records(self, records):
+        """ Appends the (key, record) pairs with one write. """
+        if trace_queries:
+            for key, _ in records:
+                logger.debug('W %s' % str(key))
+
+        with self._write_lock():
+            self._append([(key, FLAG_PUT, data) for key, data in records])
+
+    def __delitem__(self, key):
+        with self._write_lock():
+            self._refresh()
+            if not key in self.index:
+                msg = 'I expected key %r to exist before deleting' % key
+                raise ValueError(msg)
+            self._append([(key, FLAG_DELETE, b'')])
+
+    def __contains__(self, key):
+        if trace_queries:
+            logger.debug('? %s' % str(key))
+
+        self._refresh()
+        return key in self.index
+
+    def keys(self, prefix=None):
+        """ Returns the sorted list of keys, optionally only the ones
+            starting with ``prefix``. """
+        self._refresh()
+        return sorted(k for k in self.index
+                      if not prefix or k.startswith(prefix))
+
+    def disk_usage(self):
+        """ Returns the total size of the segments. """
+        return sum(os.path.getsize(self.segment_filename(n))
+                   for n in self.segment_numbers())
+
+    def compact(self):
+        """
+            Writes the live records to new segments and removes the old
+            ones. Returns the size of the segments before and after.
+
+            The writers wait for the end; the readers in other processes
+            notice the new segments as usual.
+        """
+        with self._write_lock():
+            self._refresh()
+            before = self.disk_usage()
+            old = self.segment_numbers()
+            n = (old[-1] if old else 0) + 1
+            out = open(self.segment_filename(n), 'ab')
+            entries = []
+            position = 0
+            for key in sorted(self.index):
+                if position >= self.max_segment_bytes:
+                    out.close()
+                    self._write_hint(n, entries)
+                    n += 1
+                    out = open(self.segment_filename(n), 'ab')
+                    entries = []
+                    position = 0
+                data = self._read(key, refresh=False)
+                chunk = encode_entry(key, FLAG_PUT, data)
+                start = position + len(chunk) - len(data)
+                entries.append((key, FLAG_PUT, start, len(data)))
+                out.write(chunk)
+                position += len(chunk)
+            # (no hint for the last one: the next writes are appended)
+            out.close()
+            if self.durability != 'none':
+                # the new segments must be on disk before removing the old
+                for m in range(old[-1] + 1 if old else 1, n + 1):
+                    fsync_file(self.segment_filename(m))
+                fsync_dir(self.segdir)
+            self._close_files()
+            for m in old:
+                os.remove(self.segment_filename(m))
+                # (the hints of the new segments are read by _load())
+                hint = self.segment_filename(m, '.hint')
+                if os.path.exists(hint):
+                    os.remove(hint)
+            self._load()
+            after = self.disk_usage()
+        return before, after
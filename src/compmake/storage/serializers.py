@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    Serializers for the records in the DB.
+
+    Each record starts with a header saying which serializer wrote it::
+
+        b'\\x00CMS' <1 byte: length of the name> <name> <payload>
+
+    so that a DB can contain records written with different serializers.
+    Records without the header are plain pickles (older DBs).
+
+    The serializer for a record is chosen, in order:
+
+    - per job, with ``comp(..., serializer='dill')`` (results and args);
+    - per key type (``cm-job``, ``cm-cache``, ``cm-args``, ``cm-res``),
+      with the ``serializers`` argument of the DB or the config switch
+      ``serializers`` (for example ``cm-job:msgpack,cm-cache:msgpack``);
+    - per DB, with the ``serializer`` argument of the DB or the config
+      switch ``serializer``.
+"""
+import io
+import re
+import sys
+
+from compmake.exceptions import UserError
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+__all__ = [
+    'register_serializer',
+    'get_serializer',
+    'serialize',
+    'serialize_canonical',
+    'deserialize',
+    'choose_serializer',
+    'key_type',
+]
+
+header_magic = b'\x00CMS'
+
+# protocol 5 (out-of-band buffers) if available
+pickle_protocol = min(5, pickle.HIGHEST_PROTOCOL)
+
+
+class Serializer(object):
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.header = bytes(header_magic + bytearray([len(name)]) +
+                            name.encode('ascii'))
+
+
+# name -> Serializer
+serializers = {}
+# name -> package that must be installed
+serializers_missing = {}
+
+
+def register_serializer(name, dumps, loads):
+    """ Registers a serializer; ``dumps`` returns bytes. """
+    if len(name) > 255:
+        raise ValueError('Name too long: %r' % name)
+    serializers[name] = Serializer(name, dumps, loads)
+    serializers_missing.pop(name, None)
+
+
+def get_serializer(name):
+    if not name in serializers:
+        if name in serializers_missing:
+            msg = ('The serializer %r needs the package %r to be installed.'
+                   % (name, serializers_missing[name]))
+        else:
+            msg = ('Unknown serializer %r; known: %s.' %
+                   (name, ", ".join(sorted(serializers))))
+        raise UserError(msg)
+    return serializers[name]
+
+
+def serialize(value, name):
+    """ Returns the bytes (header included) representing ``value``. """
+    s = get_serializer(name)
+    return s.header + s.dumps(value)
+
+
+def serialize_canonical(value, name):
+    """
+        As :py:func:`serialize`, but equal values give the same bytes
+        also if they contain sets: with 'pickle', the elements of the sets
+        and frozensets are written sorted, so that the bytes do not depend
+        on the hash seed. (The other serializers are used as they are.)
+    """
+    data = serialize(value, name)
+    if name != 'pickle' or CanonicalPickler is None:
+        return data
+    s = get_serializer(name)
+    payload = data[len(s.header):]
+    if not set_opcodes_re.search(payload):
+        # (no set: the opcodes are there if there is one)
+        return data
+    f = io.BytesIO()
+    CanonicalPickler(f, pickle_protocol).dump(value)
+    return s.header + f.getvalue()
+
+
+def _canonical_order(items):
+    try:
+        return sorted(items)
+    except TypeError:
+        # not comparable: as they are
+        return list(items)
+
+
+if sys.version_info[0] >= 3:
+    import re
+
+    # EMPTY_SET and FROZENSET (protocol >= 4)
+    set_opcodes_re = re.compile(b'[\x8f\x91]')
+
+    class CanonicalPickler(pickle._Pickler):
+        """ The pure-Python pickler, writing the elements of the sets
+            sorted. """
+        dispatch = dict(pickle._Pickler.dispatch)
+
+        def save_set(self, obj):
+            write = self.write
+            if self.proto < 4:
+                self.save_reduce(set, (_canonical_order(obj),), obj=obj)
+                return
+            write(pickle.EMPTY_SET)
+            self.memoize(obj)
+            items = _canonical_order(obj)
+            for i in range(0, len(items), self._BATCHSIZE):
+                write(pickle.MARK)
+                for item in items[i:i + self._BATCHSIZE]:
+                    self.save(item)
+                write(pickle.ADDITEMS)
+
+        dispatch[set] = save_set
+
+        def save_frozenset(self, obj):
+            write = self.write
+            if self.proto < 4:
+                self.save_reduce(frozenset, (_canonical_order(obj),),
+                                 obj=obj)
+                return
+            write(pickle.MARK)
+            for item in _canonical_order(obj):
+                self.save(item)
+            if id(obj) in self.memo:
+                # recursive: as in pickle._Pickler.save_frozenset()
+                write(pickle.POP_MARK + self.get(self.memo[id(obj)][0]))
+                return
+            write(pickle.FROZENSET)
+            self.memoize(obj)
+
+        dispatch[frozenset] = save_frozenset
+else:  # pragma: no cover
+    # (cPickle writes the sets with __reduce__(), in their order)
+    CanonicalPickler = None
+
+
+def deserialize(data):
+    """ Inverse of :py:func:`serialize`; also reads plain pickles. """
+    if data[:4] != header_magic:
+        return pickle.loads(data)
+    n = bytearray(data[4:5])[0]
+    name = data[5:5 + n].decode('ascii')
+    return get_serializer(name).loads(data[5 + n:])
+
+
+def key_type(key):
+    """ Returns the type of a key: 'cm-res' for 'cm-res-<job_id>'. """
+    if not key.startswith('cm-'):
+        return None
+    i = key.find('-', 3)
+    if i == -1:
+        return None
+    return key[:i]
+
+
+def choose_serializer(key, serializer=None, default=None, by_key_type=None):
+    """
+        Returns the name of the serializer to use for the key.
+
+        :param serializer: given for this record (per job)
+        :param by_key_type: dict key type -> name (per DB); if None,
+                            the config switch ``serializers`` is used.
+        :param default: for the DB; if None, the config switch
+                        ``serializer`` is used.
+    """
+    if serializer is not None:
+        return serializer
+    from compmake import get_compmake_config
+    if by_key_type is None:
+        by_key_type = parse_serializers(get_compmake_config('serializers'))
+    kt = key_type(key)
+    if kt in by_key_type:
+        return by_key_type[kt]
+    if default is not None:
+        return default
+    return get_compmake_config('serializer')
+
+
+def parse_serializers(s, _cache={}):
+    """ Parses 'cm-job:msgpack,cm-cache:msgpack' into a dict. """
+    if not s in _cache:
+        res = {}
+        for token in s.split(','):
+            token = token.strip()
+            if not token:
+                continue
+            if not ':' in token:
+                msg = ('Invalid serializers specification %r: expected '
+                       '"<key type>:<serializer>".' % s)
+                raise UserError(msg)
+            kt, name = token.split(':', 1)
+            res[kt.strip()] = name.strip()
+        _cache[s] = res
+    return _cache[s]
+
+
+register_serializer('pickle',
+                    lambda ob: pickle.dumps(ob, pickle_protocol),
+                    pickle.loads)
+
+try:
+    import cloudpickle
+except ImportError:
+    serializers_missing['cloudpickle'] = 'cloudpickle'
+else:
+    # cloudpickle writes plain pickles
+    register_serializer('cloudpickle',
+                        lambda ob: cloudpickle.dumps(ob, pickle_protocol),
+                        pickle.loads)
+
+try:
+    import dill
+except ImportError:
+    serializers_missing['dill'] = 'dill'
+else:
+    register_serializer('dill',
+                        lambda ob: dill.dumps(ob, pickle_protocol),
+                        dill.loads)
+
+try:
+    import msgpack
+except ImportError:
+    serializers_missing['msgpack'] = 'msgpack'
+else:
+    # Tuples and sets are encoded as extension types, so that they survive
+    # the round trip; the instances of Job, Cache and IntervalTimer as the
+    # pair (class, __dict__). Everything else is pickled inside.
+    msgpack_ext_pickle = 42
+    msgpack_ext_tuple = 43
+    msgpack_ext_set = 44
+    msgpack_ext_object = 45
+
+    def msgpack_classes(_cache={}):
+        if not _cache:
+            from compmake.structures import Cache, IntervalTimer, Job
+            for c in [Cache, IntervalTimer, Job]:
+                _cache[c.__name__] = c
+        return _cache
+
+    def msgpack_default(ob):
+        t = type(ob)
+        if t is tuple:
+            return msgpack.ExtType(msgpack_ext_tuple, msgpack_dumps(list(ob)))
+        if t is set:
+            return msgpack.ExtType(msgpack_ext_set, msgpack_dumps(list(ob)))
+        classes = msgpack_classes()
+        if classes.get(t.__name__, None) is t:
+            data = msgpack_dumps([t.__name__, ob.__dict__])
+            return msgpack.ExtType(msgpack_ext_object, data)
+        return msgpack.ExtType(msgpack_ext_pickle,
+                               pickle.dumps(ob, pickle_protocol))
+
+    def msgpack_ext_hook(code, data):
+        if code == msgpack_ext_pickle:
+            return pickle.loads(data)
+        if code == msgpack_ext_tuple:
+            return tuple(msgpack_loads(data))
+        if code == msgpack_ext_set:
+            return set(msgpack_loads(data))
+        if code == msgpack_ext_object:
+            name, d = msgpack_loads(data)
+            ob = object.__new__(msgpack_classes()[name])
+            ob.__dict__.update(d)
+            return ob
+        return msgpack.ExtType(code, data)
+
+    def msgpack_dumps(ob):
+        return msgpack.packb(ob, use_bin_type=True, strict_types=True,
+                             default=msgpack_default)
+
+    def msgpack_loads(data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False,
+                               ext_hook=msgpack_ext_hook)
+
+    register_serializer('msgpack', msgpack_dumps, msgpack_loads)
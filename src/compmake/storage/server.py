@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+    A server that shares one DB among the compmake processes of a machine
+    (for example, the workers of ``parmake``), keeping the most used
+    records in memory. See the command ``storage-server`` and
+    :py:class:`StorageClient`.
+
+    The server speaks over a Unix socket in the DB directory (see
+    :py:func:`server_address`), created with mode 0600; the clients
+    connect only to a socket of their own user. The messages are pickles
+    preceded by their length; the server only sees records (serialized
+    values, see records.py), which the clients encode and decode.
+"""
+import errno
+import hashlib
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+from six.moves import socketserver
+
+from compmake.exceptions import CompmakeBug, CompmakeDBError
+
+from .memorycache import MemoryCache
+from .serializers import pickle, pickle_protocol
+
+__all__ = [
+    'StorageServer',
+    'check_socket_owner',
+    'server_address',
+]
+
+header = struct.Struct('!Q')
+
+# the socket, in the DB directory
+socket_filename = 'storage-server.sock'
+
+# the limit of the length of the path of a Unix socket is about 100 bytes
+max_socket_path = 100
+
+
+def server_address(basepath):
+    """ Returns the path of the socket of the server for the DB: in the
+        DB directory or, if that path is too long for a socket, in a
+        directory of the temp directory that only this user can use. """
+    basepath = os.path.realpath(basepath)
+    address = os.path.join(basepath, socket_filename)
+    if len(address.encode('utf-8')) <= max_socket_path:
+        return address
+    digest = hashlib.sha1(basepath.encode('utf-8')).hexdigest()
+    return os.path.join(private_socket_dir(), '%s.sock' % digest[:16])
+
+
+def private_socket_dir():
+    """ Returns the directory ``compmake-<uid>`` in the temp directory,
+        creating it with mode 0700; raises CompmakeDBError if it is
+        not ours or if the other users can use it. """
+    uid = os.getuid()
+    dirname = os.path.join(tempfile.gettempdir(), 'compmake-%d' % uid)
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(dirname)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or
+            st.st_mode & 0o077):
+        msg = ('Not using %r for the storage server: it must be a '
+               'directory of this user with mode 0700.' % dirname)
+        raise CompmakeDBError(msg)
+    return dirname
+
+
+def check_socket_owner(address):
+    """ Raises CompmakeDBError if the socket was not created by this user
+        (the replies of the server are unpickled). """
+    try:
+        st = os.lstat(address)
+    except OSError as e:
+        msg = 'Cannot connect to the storage server at %r: %s' % (address, e)
+        raise CompmakeDBError(msg)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        msg = ('Not connecting to the storage server at %r: the socket '
+               'does not belong to this user.' % address)
+        raise CompmakeDBError(msg)
+
+
+def send_message(sock, ob):
+    data = pickle.dumps(ob, pickle_protocol)
+    sock.sendall(header.pack(len(data)))
+    sock.sendall(data)
+
+
+def recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if k == 0:
+            return None
+        got += k
+    return bytes(buf)
+
+
+def recv_message(sock):
+    """ Returns the message, or None if the connection was closed. """
+    h = recv_exactly(sock, header.size)
+    if h is None:
+        return None
+    data = recv_exactly(sock, header.unpack(h)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+class RecordStore(object):
+    """ The records of a DB, with the interface of a DB (so that they
+        can be kept in a :py:class:`MemoryCache`). """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, key):
+        return self.db.get_record(key)
+
+    def set(self, key, data, serializer=None):  # @UnusedVariable
+        self.db.set_record(key, data)
+
+    def set_records(self, records):
+        self.db.set_records(records)
+
+    def __delitem__(self, key):
+        del self.db[key]
+
+    def __contains__(self, key):
+        return key in self.db
+
+    def get_many(self, keys):
+        return self.db.get_records(keys)
+
+    def contains_many(self, keys):
+        return self.db.contains_many(keys)
+
+    def keys(self, prefix=None):
+        return self.db.keys(prefix=prefix)
+
+    def sizeof(self, key):
+        return self.db.sizeof(key)
+
+    def cache_token(self, key):
+        return self.db.cache_token(key)
+
+    def cache_tokens(self, keys):
+        return self.db.cache_tokens(keys)
+
+    def record_key(self, key):
+        self.db.record_key(key)
+
+
+class StorageServer(object):
+    """
+        Serves the DB ``db`` (a backend) on the Unix socket ``address``
+        (by default, :py:func:`server_address`), keeping in memory up to
+        ``max_bytes`` of records (the results only up to
+        ``max_result_bytes`` each).
+
+        Each connection is served by a thread; the requests wait for each
+        other only to update the cache and to use the DB.
+    """
+
+    methods = ['info', 'get_record', 'get_records', 'set_records',
+               'delete', 'contains', 'contains_many', 'keys', 'sizeof',
+               'record_key', 'sync', 'stats']
+
+    def __init__(self, db, address=None, max_bytes=256 * 1024 * 1024,
+                 max_result_bytes=16 * 1024 * 1024):
+        self.db = db
+        if address is None:
+            address = server_address(db.basepath)
+        self.address = address
+        self.store = MemoryCache(RecordStore(db), max_bytes=max_bytes,
+                                 max_result_bytes=max_result_bytes)
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.server = None
+
+    def bind(self):
+        if os.path.exists(self.address):
+            # left by a server that was killed
+            os.unlink(self.address)
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    msg = recv_message(self.request)
+                    if msg is None:
+                        break
+                    send_message(self.request, server.process(*msg))
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        old = os.umask(0o077)  # only for this user
+        try:
+            self.server = Server(self.address, Handler)
+        finally:
+            os.umask(old)
+
+    def serve_forever(self):
+        if self.server is None:
+            self.bind()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def start(self):
+        """ Serves in a thread; returns the thread. """
+        self.bind()
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def process(self, method, args):
+        """ Returns ('ok', result) or ('error', exception). """
+        if not method in StorageServer.methods:
+            return 'error', CompmakeBug('Unknown method %r.' % method)
+        try:
+            return 'ok', getattr(self, 'do_' + method)(*args)
+        except Exception as e:
+            try:
+                pickle.dumps(e, pickle_protocol)
+            except Exception:
+                e = CompmakeBug('%s: %s' % (type(e).__name__, e))
+            return 'error', e
+
+    # self.lock protects the cache, self.db_lock the DB: a request
+    # served from the cache does not wait for the reads of the others.
+
+    def do_info(self):
+        db = self.db
+        return dict(basepath=db.basepath, serializer=db.serializer,
+                    serializers=db.serializers, compression=db.compression,
+                    pid=os.getpid())
+
+    def do_get_record(self, key):
+        store = self.store
+        with self.db_lock:
+            token = store._token(key)
+        with self.lock:
+            entry = store.lookup(key, token)
+            if entry is not None:
+                store.hits += 1
+                return entry[1]
+        with self.db_lock:
+            data = store.db[key]
+        with self.lock:
+            store.misses += 1
+            if token is not None and store.should_cache(key):
+                store.add(key, token, data, len(data))
+        return data
+
+    def do_get_records(self, keys):
+        store = self.store
+        with self.db_lock:
+            tokens = store._tokens(keys)
+        res = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                entry = None
+                if key in tokens:
+                    entry = store.lookup(key, tokens[key][0])
+                if entry is not None:
+                    store.hits += 1
+                    res[key] = entry[1]
+                else:
+                    missing.append(key)
+        if not missing:
+            return res
+        with self.db_lock:
+            found = store.db.get_many(missing)
+        with self.lock:
+            for key, data in found.items():
+                res[key] = data
+                store.misses += 1
+                if key in tokens and store.should_cache(key):
+                    store.add(key, tokens[key][0], data, len(data))
+        return res
+
+    def do_set_records(self, records):
+        with self.lock:
+            for key, _ in records:
+                self.store.invalidate(key)
+        with self.db_lock:
+            self.store.db.set_records(records)
+        # (read meanwhile: the new token does not match)
+
+    def do_delete(self, key):
+        with self.lock:
+            self.store.invalidate(key)
+        with self.db_lock:
+            del self.store.db[key]
+
+    def do_contains(self, key):
+        with self.db_lock:
+            return key in self.store.db
+
+    def do_contains_many(self, keys):
+        with self.db_lock:
+            return self.store.db.contains_many(keys)
+
+    def do_keys(self, prefix):
+        with self.db_lock:
+            return self.store.db.keys(prefix=prefix)
+
+    def do_sizeof(self, key):
+        with self.db_lock:
+            return self.store.db.sizeof(key)
+
+    def do_record_key(self, key):
+        with self.lock:
+            self.store.invalidate(key)
+        with self.db_lock:
+            self.store.db.record_key(key)
+
+    def do_sync(self, force):
+        with self.db_lock:
+            self.db.sync(force=force)
+
+    def do_stats(self):
+        with self.lock:
+            return self.store.get_stats()
+
+
+def connect(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except Exception:
+        sock.close()
+        raise
+    return sock
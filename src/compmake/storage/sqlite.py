@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import traceback
+
+from compmake import logger
+from compmake.exceptions import CompmakeBug
+
+from .durability import SyncQueue, check_durability
+from .filesystem import create_scripts
+from .parallel_io import io_map
+from .records import decompress_record, dumps_record, loads_record
+from .serializers import deserialize
+
+__all__ = [
+    'StorageSQLite',
+]
+
+trace_queries = False
+
+# SQLITE_MAX_VARIABLE_NUMBER is 999 in older versions
+max_query_variables = 900
+
+
+class StorageSQLite(object):
+    """
+        Stores all the records in a single SQLite database
+        (``<basepath>/compmake.sqlite``) in WAL mode.
+
+        Keys are the primary key of the table, so that prefix queries
+        (``keys(prefix='cm-job-')``) are answered by a range scan on the
+        index rather than by listing a directory.
+
+        The serializers and the compression are chosen as for
+        :py:class:`StorageFilesystem`.
+
+        Every record has a ``version``: the number of the transaction
+        that wrote it, taken from a counter in the table
+        ``compmake_version`` that is never decremented; it is the
+        ``cache_token()`` of the record, and it can be compared across
+        connections and processes.
+
+        The commits are not fsync()ed (``synchronous=NORMAL``, which in
+        WAL mode keeps the DB consistent). With the ``batch`` durability
+        the WAL is fsync()ed by :py:func:`sync`; ``strict`` uses
+        ``synchronous=FULL``.
+    """
+
+    db_filename = 'compmake.sqlite'
+    # durability -> PRAGMA synchronous
+    synchronous = {'none': 'NORMAL', 'batch': 'NORMAL', 'strict': 'FULL'}
+
+    def __init__(self, basepath, compress=False, serializer=None,
+                 serializers=None, compression=None, durability=None):
+        self.basepath = os.path.realpath(basepath)
+        self.durability = check_durability(durability)
+        self.sync_queue = SyncQueue()
+        if compress or compress is None:
+            self.compression = compression
+        else:
+            self.compression = 'none'
+        self.serializer = serializer
+        self.serializers = serializers
+        self.filename = os.path.join(self.basepath, StorageSQLite.db_filename)
+        self.conn = None
+        self.pid = None
+
+        if not os.path.exists(self.basepath):
+            os.makedirs(self.basepath)
+        # create the table
+        self._get_connection()
+
+        # create a bunch of files that contain shortcuts
+        create_scripts(self.basepath)
+
+    def __repr__(self):
+        return "SQLiteDB(%r)" % self.filename
+
+    def __getstate__(self):
+        # the connection cannot be pickled (nor shared across processes)
+        d = dict(self.__dict__)
+        d['conn'] = None
+        d['pid'] = None
+        return d
+
+    def _get_connection(self):
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=%s' %
+                         StorageSQLite.synchronous[self.durability])
+            conn.execute('CREATE TABLE IF NOT EXISTS compmake '
+                         '(key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                         'version INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS compmake_version '
+                         '(version INTEGER NOT NULL)')
+            conn.execute('INSERT INTO compmake_version SELECT 0 WHERE NOT '
+                         'EXISTS (SELECT 1 FROM compmake_version)')
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def reopen_after_fork(self):
+        # Never reuse a connection created by the parent process.
+        self.conn = None
+        self._get_connection()
+
+    def dumps(self, key, value, serializer=None):
+        """ Returns the record (serialized and compressed) that
+            ``set(key, value, serializer)`` would write. """
+        return dumps_record(key, value, serializer, self.serializer,
+                            self.serializers, self.compression)
+
+    def loads(self, data):
+        """ Inverse of :py:func:`dumps`. """
+        return loads_record(data)
+
+    def _loads_key(self, key, data):
+        try:
+            return self.loads(data)
+        except Exception as e:
+            msg = ("Could not unpickle data for key %r. \n db: %s" %
+                   (key, self.filename))
+            logger.error(msg)
+            logger.exception(e)
+            msg += "\n" + traceback.format_exc()
+            raise CompmakeBug(msg)
+
+    def _select_many(self, what, keys):
+        """ Yields the rows of ``SELECT <what> ... WHERE key IN keys``. """
+        c = self._get_connection()
+        keys = list(keys)
+        for i in range(0, len(keys), max_query_variables):
+            chunk = keys[i:i + max_query_variables]
+            q = ('SELECT %s FROM compmake WHERE key IN (%s)' %
+                 (what, ','.join(['?'] * len(chunk))))
+            for row in c.execute(q, chunk):
+                yield row
+
+    def get_record(self, key):
+        """ Returns the record for the key, as written by set_record(). """
+        if trace_queries:
+            logger.debug('R %s' % str(key))
+
+        c = self._get_connection()
+        row = c.execute('SELECT value FROM compmake WHERE key=?',
+                        (key,)).fetchone()
+        if row is None:
+            msg = 'Could not find key %r.' % key
+            msg += '\n db: %s' % self.filename
+            raise CompmakeBug(msg)
+        return bytes(row[0])
+
+    def get_records(self, keys):
+        """ Returns a dict with the records of the keys that exist. """
+        if trace_queries:
+            logger.debug('R* %d keys' % len(keys))
+
+        rows = self._select_many('key, value', keys)
+        return dict((key, bytes(value)) for key, value in rows)
+
+    def get_many(self, keys):
+        """ Returns a dict with the values of the keys that exist.
+            The records are decompressed in parallel. """
+        records = list(self.get_records(keys).items())
+        datas = io_map(decompress_record, [data for _, data in records])
+        res = {}
+        for (key, _), data in zip(records, datas):
+            try:
+                res[key] = deserialize(data)
+            except Exception:
+                # same error as db[key]
+                self._loads_key(key, data)
+        return res
+
+    def contains_many(self, keys):
+        """ Returns the set of the keys that exist. """
+        return set(row[0] for row in self._select_many('key', keys))
+
+    def cache_tokens(self, keys):
+        """ Returns a dict key -> (cache_token(key), size) for the keys
+            that exist. """
+        rows = self._select_many('key, version, length(value)', keys)
+        return dict((key, (version, size)) for key, version, size in rows)
+
+    def sizeof(self, key):
+        c = self._get_connection()
+        row = c.execute('SELECT length(value) FROM compmake WHERE key=?',
+                        (key,)).fetchone()
+        if row is None:
+            msg = 'Could not find key %r.' % key
+            raise CompmakeBug(msg)
+        return row[0]
+
+    def cache_token(self, key):
+        """ Returns the version of the record, which changes when it is
+            rewritten (also by other processes), or None if it does not
+            exist; used by :py:class:`MemoryCache`. """
+        c = self._get_connection()
+        row = c.execute('SELECT version FROM compmake WHERE key=?',
+                        (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __getitem__(self, key):
+        return self._loads_key(key, self.get_record(key))
+
+    def __setitem__(self, key, value):  # @ReservedAssignment
+        self.set(key, value)
+
+    def set(self, key, value, serializer=None):
+        """ Same as ``db[key] = value``, optionally choosing the
+            serializer for this record. """
+        self.set_record(key, self.dumps(key, value, serializer))
+
+    def set_record(self, key, data):
+        """ Writes a record returned by :py:func:`dumps`. """
+        self.set_records([(key, data)])
+
+    def set_records(self, records):
+        """ Writes the (key, record) pairs in one transaction. """
+        if trace_queries:
+            for key, _ in records:
+                logger.debug('W %s' % str(key))
+
+        c = self._get_connection()
+        with c:  # commits, or rolls back on errors
+            c.execute('BEGIN')
+            # (takes the write lock, so that the version is not shared
+            # with another transaction)
+            c.execute('UPDATE compmake_version SET version = version + 1')
+            version = c.execute('SELECT version FROM '
+                                'compmake_version').fetchone()[0]
+            rows = [(key, sqlite3.Binary(data), version)
+                    for key, data in records]
+            c.executemany('INSERT OR REPLACE INTO compmake '
+                          '(key, value, version) VALUES (?, ?, ?)', rows)
+        if self.durability == 'batch':
+            self.sync_queue.add_file(self.filename + '-wal')
+            self.sync(force=False)
+
+    def sync(self, force=True):
+        """ Performs the pending fsync()s of the ``batch`` durability (if
+            not ``force``, only if ``durability_interval`` has passed). """
+        self.sync_queue.flush(force=force)
+
+    def __delitem__(self, key):
+        c = self._get_connection()
+        cur = c.execute('DELETE FROM compmake WHERE key=?', (key,))
+        if cur.rowcount == 0:
+            msg = 'I expected key %r to exist before deleting' % key
+            raise ValueError(msg)
+        if self.durability == 'batch':
+            self.sync_queue.add_file(self.filename + '-wal')
+            self.sync(force=False)
+
+    def __contains__(self, key):
+        if trace_queries:
+            logger.debug('? %s' % str(key))
+
+        c = self._get_connection()
+        row = c.execute('SELECT 1 FROM compmake WHERE key=?',
+                        (key,)).fetchone()
+        return row is not None
+
+    def keys(self, prefix=None):
+        """ Returns the sorted list of keys, optionally only the ones
+            starting with ``prefix`` (uses the primary key index). """
+        c = self._get_connection()
+        if not prefix:
+            rows = c.execute('SELECT key FROM compmake ORDER BY key')
+        else:
+            # all the strings starting with prefix are in [prefix, upper)
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            rows = c.execute('SELECT key FROM compmake WHERE key >= ? AND '
+                             'key < ? ORDER BY key', (prefix, upper))
+        return [row[0] for row in rows]
@@ -69,6 +69,7 @@ __all__ = [
     'Promise',
     'Job',
     'Cache',
+    'ResultRef',
     'execute_with_context'
 ]
 
@@ -87,7 +88,11 @@ class Job(object):
     @contract(defined_by='list[>=1](str)', children=set)
     def __init__(self, job_id, children, command_desc,
                  needs_context=False,
-                 defined_by=None):
+                 defined_by=None,
+                 serializer=None,
+                 lazy_deps=False,
+                 fingerprint=None,
+                 args_digest=None):
         """
 
             needs_context: new facility for dynamic jobs
@@ -95,6 +100,16 @@ class Job(object):
                         This is the stack of jobs. 'root' is the first.
 
             children: the direct dependencies
+
+            serializer: serializer for the result and the arguments
+                        (None: the one of the DB)
+
+            lazy_deps: load the dependencies only when they are used
+
+            fingerprint: of the code of the function
+                         (see compmake.jobs.fingerprint)
+
+            args_digest: of the serialized (command, args, kwargs)
         """
         self.job_id = job_id
         self.children = set(children)
@@ -107,10 +122,26 @@ class Job(object):
         # str -> set(str), where the key is one
         # of the direct children
         self.dynamic_children = {}
+        self.serializer = serializer
+        self.lazy_deps = lazy_deps
+        self.fingerprint = fingerprint
+        self.args_digest = args_digest
 
         self.pickle_main_context = pickle_main_context_save()
 
 
+class ResultRef(object):
+    """ Stored in place of the result of a job when the result is in the
+        content-addressed store (see compmake.jobs.storage). """
+
+    def __init__(self, digest, size):
+        self.digest = digest  # SHA1 of the serialized result
+        self.size = size  # bytes, serialized
+
+    def __repr__(self):
+        return 'ResultRef(%s;%s)' % (self.digest, self.size)
+
+
 def same_computation(jobargs1, jobargs2):
     """ Returns boolean, string tuple """
     cmd1, args1, kwargs1 = jobargs1
@@ -161,14 +192,16 @@ class IntervalTimer(object):
 
     def __init__(self):
         import time
-        self.c0 = time.clock()
+        from compmake.utils.time_track import cpu_clock
+        self.c0 = cpu_clock()
         self.t0 = time.time()
         self.stopped = False
 
     def stop(self):
         self.stopped = True
         import time
-        self.c1 = time.clock()
+        from compmake.utils.time_track import cpu_clock
+        self.c1 = cpu_clock()
         self.t1 = time.time()
 
     def get_walltime_used(self):
@@ -208,6 +241,9 @@ class Cache(object):
                       DONE,
                       BLOCKED]
 
+    # stored in 'cm-logs-<job_id>'
+    logs_fields = ['backtrace', 'captured_stdout', 'captured_stderr']
+
     state2desc = {
         NOT_STARTED: 'todo',
         BLOCKED: 'blocked',
@@ -222,16 +258,25 @@ class Cache(object):
         # time end
         self.timestamp = 0.0
 
-        # Hash for dependencies when this was computed
+        # Hash for dependencies when this was computed:
+        # job_id -> result_digest of the dependency (see early_cutoff)
         self.hashes_dependencies = {}
+        # SHA1 of the serialized result, or None
+        self.result_digest = None
+        # why it was marked to remake, if it was not the user
+        self.remake_reason = None
 
         self.jobs_defined = set()
 
         # in case of failure
         self.exception = None  # a short string
+        # These are stored separately (see set_job_cache()), and are None
+        # when the cache is read from the DB; use get_job_logs().
         self.backtrace = None  # a long string
         self.captured_stdout = None
         self.captured_stderr = None
+        # whether they are in the record 'cm-logs-<job_id>'
+        self.logs_stored = False
 
         # total
         self.cputime_used = None
@@ -246,6 +291,11 @@ class Cache(object):
         self.int_save_results = None
         self.int_gc = None
 
+        # arguments and results found already loaded by the parmake
+        # worker (see jobs/prefetch.py); None if not prefetching
+        self.prefetch_hits = None
+        self.prefetch_misses = None
+
     def __repr__(self):
         return ('Cache(%s;%s;cpu:%s;wall:%s)' %
                 (Cache.state2desc[self.state],
@@ -5,8 +5,11 @@ from .. import CompmakeConstants, get_compmake_config, get_compmake_status
 from ..events import publish
 from ..exceptions import CommandFailed, UserError
 from ..jobs import (CacheQueryDB, all_jobs, collect_dependencies, get_job, 
-    job_exists, parse_job_list, set_job, set_job_args)
-from ..jobs.storage import get_job_args
+    job_args_exists, job_cache_exists, job_exists, parse_job_list, set_job,
+    set_job_args)
+from ..jobs.storage import (get_job_args, indices_commit, job_args_digest,
+                             serialize_job_args)
+from ..storage.serializers import get_serializer
 from ..structures import Job, Promise, same_computation
 from ..utils import interpret_strings_like, try_pickling
 from .helpers import UIState, get_commands
@@ -14,7 +17,8 @@ from .visualization import warning
 from compmake.constants import DefaultsToConfig
 from compmake.context import Context
 from compmake.exceptions import CompmakeBug
-from compmake.jobs.actions import clean_cache_relations
+from compmake.jobs.actions import clean_cache_relations, mark_to_remake
+from compmake.jobs.fingerprint import code_fingerprint
 from compmake.jobs.storage import db_job_add_parent_relation
 from contracts import (
     check_isinstance, contract, describe_type, describe_value, raise_wrapped)
@@ -97,6 +101,12 @@ def clean_other_jobs(context):
     #                ' Previous: %d' % len(defined_now))
 
     from compmake.ui import info
+
+    counts = context.pop_definition_counts()
+    if counts:
+        info('Defined %d jobs: %d new, %d changed, %d unchanged.' %
+             (sum(counts.values()), counts.get('new', 0),
+              counts.get('changed', 0), counts.get('unchanged', 0)))
     
     todelete = set()
     
@@ -176,6 +186,10 @@ def comp_(context, command_, *args, **kwargs):
         If not given, command_.__name__ is used.
 
         :arg:needs_context: if this is a dynamic job
+        :arg:serializer: serializer for the result and the arguments
+        (see compmake.storage.serializers)
+        :arg:lazy_deps: if True, the results of the dependencies are
+        loaded only when the job uses them (see compmake.jobs.lazy_deps)
 
         Raises UserError if command is not pickable.
     """
@@ -226,6 +240,9 @@ def comp_(context, command_, *args, **kwargs):
 
     args = list(args)  # args is a non iterable tuple
 
+    # The stored definition of the job, read only once and reused below.
+    old_job = None
+
     # Get job id from arguments
     if CompmakeConstants.job_id_key in kwargs:
         # make sure that command does not have itself a job_id key
@@ -280,7 +297,8 @@ def comp_(context, command_, *args, **kwargs):
                 # ok, you gave us a job_id, but we still need to check whether
                 # it is the same job
                 stack = context.currently_executing
-                defined_by = get_job(job_id, db=db).defined_by
+                old_job = get_job(job_id, db=db)
+                defined_by = old_job.defined_by
                 if defined_by == stack:
                     # this is the same job-redefining
                     pass
@@ -290,6 +308,7 @@ def comp_(context, command_, *args, **kwargs):
                         n = '%s-%d' % (job_id, i)
                         if not job_exists(n, db=db):
                             job_id = n
+                            old_job = None
                             break
                         
                     if False:
@@ -312,6 +331,18 @@ def comp_(context, command_, *args, **kwargs):
     else:
         needs_context = False
 
+    if CompmakeConstants.serializer_key in kwargs:
+        serializer = kwargs.pop(CompmakeConstants.serializer_key)
+        # raises UserError if not available
+        get_serializer(serializer)
+    else:
+        serializer = None
+
+    if CompmakeConstants.lazy_deps_key in kwargs:
+        lazy_deps = bool(kwargs.pop(CompmakeConstants.lazy_deps_key))
+    else:
+        lazy_deps = False
+
     if CompmakeConstants.extra_dep_key in kwargs:
         extra_dep = kwargs[CompmakeConstants.extra_dep_key]
         del kwargs[CompmakeConstants.extra_dep_key]
@@ -343,6 +374,15 @@ def comp_(context, command_, *args, **kwargs):
 
     all_args = (command, args, kwargs)
 
+    if get_compmake_config('code_fingerprints'):
+        fingerprint = code_fingerprint(command)
+    else:
+        fingerprint = None
+
+    check_params = get_compmake_config('check_params')
+    args_data = serialize_job_args(job_id, all_args, db, serializer)
+    args_digest = job_args_digest(args_data)
+
     assert len(context.currently_executing) >= 1
     assert context.currently_executing[0] == 'root'
     
@@ -350,16 +390,21 @@ def comp_(context, command_, *args, **kwargs):
             children=children,
             command_desc=command_desc,
             needs_context=needs_context,
-            defined_by=context.currently_executing)
+            defined_by=context.currently_executing,
+            serializer=serializer,
+            lazy_deps=lazy_deps,
+            fingerprint=fingerprint,
+            args_digest=args_digest)
     
     # Need to inherit the pickle
     if context.currently_executing[-1] != 'root':
         parent_job = get_job(context.currently_executing[-1], db)
         c.pickle_main_context = parent_job.pickle_main_context
 
-    if job_exists(job_id, db):
+    if old_job is None and job_exists(job_id, db):
         old_job = get_job(job_id, db)
 
+    if old_job is not None:
         if old_job.defined_by != c.defined_by:
             warning('Redefinition of %s: ' % job_id)
             warning(' cur defined_by: %s' % c.defined_by)
@@ -383,6 +428,16 @@ def comp_(context, command_, *args, **kwargs):
                     if not j in c.children:
                         c.children.add(j)
 
+        old_fingerprint = getattr(old_job, 'fingerprint', None)
+        if (fingerprint is not None and old_fingerprint is not None and
+                fingerprint != old_fingerprint and
+                job_cache_exists(job_id, db)):
+            reason = ('function %r changed (code fingerprint %s -> %s)' %
+                      (command_desc, old_fingerprint[:8], fingerprint[:8]))
+            mark_to_remake(job_id, db, reason=reason)
+            publish(context, 'job-redefined', job_id=job_id,
+                    reason=reason + '\n')
+
         if old_job.parents != c.parents:
             # warning('Redefinition of %s: ' % job_id)
             #  warning(' cur parents: %s' % (c.parents))
@@ -400,7 +455,17 @@ def comp_(context, command_, *args, **kwargs):
     for child in children:
         db_job_add_parent_relation(child=child, parent=job_id, db=db)
 
-    if get_compmake_config('check_params') and job_exists(job_id, db):
+    if old_job is not None:
+        stored_digest = getattr(old_job, 'args_digest', None)
+        args_exist = job_args_exists(job_id, db)
+    else:
+        stored_digest = None
+        args_exist = False
+
+    if (check_params and old_job is not None and
+            (args_digest is None or args_digest != stored_digest)):
+        # (if the digests are the same, we do not need the old arguments)
+
         # OK, this is going to be black magic.
         # We want to load the previous job definition,
         # however, by unpickling(), it will start
@@ -425,16 +490,35 @@ def comp_(context, command_, *args, **kwargs):
 #             if job_cache_exists(job_id, db):
 #                 delete_job_cache(job_id, db)
             publish(context, 'job-redefined', job_id=job_id, reason=reason)
+        elif (args_digest is not None and stored_digest is not None and
+              args_exist):
+            # Equal arguments serialized differently (for example, by
+            # other serializers than 'pickle'): keep the stored arguments
+            # and their digest, so that neither record is written again.
+            args_digest = c.args_digest = stored_digest
+
+    # Unchanged records are not written again, so that re-running the
+    # same script does (almost) no writes.
+    # (clean_targets() and mark_to_remake() above only touch the cache of
+    # this job and the records of its relatives, so old_job is still valid.)
+    if old_job is not None:
+        args_changed = (args_digest is None or
+                        args_digest != stored_digest or
+                        not args_exist)
+        job_changed = old_job.__dict__ != c.__dict__
+        if args_changed or job_changed:
+            context.count_job_definition('changed')
         else:
-            # print('ok, same job')
-            pass
-            # XXX TODO clean the cache
-            #             else:
-            #                 publish(context, 'job-already-defined',
-            # job_id=job_id)
-
-    set_job_args(job_id, all_args, db=db)
-    set_job(job_id, c, db=db)
+            context.count_job_definition('unchanged')
+    else:
+        args_changed = job_changed = True
+        context.count_job_definition('new')
+
+    if args_changed:
+        set_job_args(job_id, all_args, db=db, serializer=serializer,
+                     data=args_data)
+    if job_changed:
+        set_job(job_id, c, db=db)
     publish(context, 'job-defined', job_id=job_id)
 
     return Promise(job_id)
@@ -596,6 +680,8 @@ def interpret_single_command(commands_line, context, cq):
             msg = 'Required argument %r not given.' % x
             raise UserError(msg)
 
+    # (the changes of the definitions, if any)
+    indices_commit(cq.db)
     try:
         res = function(**kwargs)
         if (res is not None) and (res != 0):
@@ -603,6 +689,7 @@ def interpret_single_command(commands_line, context, cq):
             raise CommandFailed(msg)
         return None
     finally:
+        indices_commit(cq.db)
         if dbchange:
             cq.invalidate()
 
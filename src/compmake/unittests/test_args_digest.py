@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+from nose.tools import istest
+
+from compmake import Context, set_compmake_config
+from compmake.jobs import get_job, get_job_args
+from compmake.jobs.storage import job2jobargskey, job2key
+
+from .compmake_test import CompmakeTest
+
+
+class Loaded(object):
+    """ Counts how many times it is pickled and unpickled. """
+    count = 0
+    dumped = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __getstate__(self):
+        Loaded.dumped += 1
+        return self.__dict__
+
+    def __setstate__(self, state):
+        Loaded.count += 1
+        self.__dict__.update(state)
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def f(x, y):
+    return y
+
+
+define_frozenset = """
+import sys
+from compmake import Context, set_compmake_config
+from compmake.storage import StorageFilesystem
+from compmake.unittests.test_args_digest import f
+if __name__ == '__main__':
+    set_compmake_config('check_params', %r)
+    cc = Context(db=StorageFilesystem(sys.argv[1], compress=True))
+    cc.comp(f, frozenset(str(i) for i in range(50)), 1, job_id='x')
+    sys.stdout.write(repr(sorted(cc.pop_definition_counts().items())))
+"""
+
+
+@istest
+class TestArgsDigest(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('check_params', True)
+        Loaded.count = 0
+        Loaded.dumped = 0
+
+    def tearDown(self):
+        set_compmake_config('check_params', False)
+        CompmakeTest.tearDown(self)
+
+    def define(self, y):
+        self.cc = Context(db=self.db)
+        self.comp(f, Loaded(1), y, job_id='x')
+
+    def testSame(self):
+        self.define(1)
+        self.assert_cmd_success('make')
+        self.assertEqual(len(get_job('x', self.db).args_digest), 40)
+        count = Loaded.count
+        self.define(1)
+        # the old arguments were not loaded
+        self.assertEqual(Loaded.count, count)
+        self.assertJobsEqual('done', ['x'])
+
+    def testChanged(self):
+        self.define(1)
+        self.assert_cmd_success('make')
+        count = Loaded.count
+        self.define(2)
+        self.assertEqual(Loaded.count, count + 1)
+        self.assertJobsEqual('done', [])
+
+    def testSerializedOnce(self):
+        self.define(1)
+        self.assertEqual(Loaded.dumped, 1)
+        self.assertEqual(get_job_args('x', self.db)[1][0], Loaded(1))
+
+    def define_in_process(self, hashseed, check_params=True):
+        """ Defines a job with a frozenset argument in a new process. """
+        env = dict(os.environ, PYTHONHASHSEED=str(hashseed))
+        script = os.path.join(self.root0, 'define.py')
+        with open(script, 'w') as f:
+            f.write(define_frozenset % check_params)
+        return subprocess.check_output([sys.executable, script, self.root],
+                                       env=env)
+
+    def testFrozensetHashSeed(self):
+        self.check_frozenset_hashseed(check_params=True)
+
+    def testFrozensetHashSeedNoCheck(self):
+        self.check_frozenset_hashseed(check_params=False)
+
+    def check_frozenset_hashseed(self, check_params):
+        # the pickles of the frozenset differ with the hash seed
+        self.assertEqual(self.define_in_process(1, check_params),
+                         b"[('new', 1)]")
+        keys = [job2key('x'), job2jobargskey('x')]
+        before = self.db.cache_tokens(keys)
+        for hashseed in [2, 3]:
+            self.assertEqual(self.define_in_process(hashseed, check_params),
+                             b"[('unchanged', 1)]")
+            self.assertEqual(self.db.cache_tokens(keys), before)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake import Promise
+from compmake.context import Context
+from compmake.jobs import get_job, get_job_args, get_job_userobject
+from compmake.storage import StorageFilesystem, StorageSQLite
+
+from .compmake_test import CompmakeTest
+
+
+def f(*args):
+    return sum(args)
+
+
+def g(values):
+    return list(values)
+
+
+def define(context):
+    a = context.comp(f, 1, job_id='a')
+    b = context.comp(f, a, 2, job_id='b')
+    context.comp(f, a, b)
+    context.comp(f, a, b)
+    values = [a]
+    context.comp(g, values, job_id='g')
+    # must not be seen by the job already defined
+    values.append(b)
+
+
+def generate(context, n):
+    res = [context.comp(f, i, job_id='gen%d' % i) for i in range(n)]
+    return context.comp(f, *res, job_id='gen-sum')
+
+
+@istest
+class TestBatchDefinitions(CompmakeTest):
+
+    def assertSameDB(self, db1, db2):
+        self.assertEqual(db1.keys(), db2.keys())
+        for key in db1.keys(prefix='cm-job-'):
+            job_id = key[len('cm-job-'):]
+            self.assertEqual(get_job(job_id, db1).__dict__,
+                             get_job(job_id, db2).__dict__)
+            # (promises do not define __eq__)
+            self.assertEqual(repr(get_job_args(job_id, db1)),
+                             repr(get_job_args(job_id, db2)))
+
+    def testSameState(self):
+        with self.cc.batch_definitions():
+            define(self.cc)
+            # nothing written yet
+            self.assertEqual(self.db.keys(prefix='cm-job-'), [])
+        self.assertEqual(len(self.db.keys(prefix='cm-job-')), 5)
+
+        db2 = StorageFilesystem(os.path.join(self.root0, 'nobatch'))
+        define(Context(db=db2))
+        self.assertSameDB(self.db, db2)
+
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_userobject('g', self.db), [1])
+        self.assertEqual(get_job_userobject('f-2', self.db), 4)
+
+    def testSQLite(self):
+        db = StorageSQLite(os.path.join(self.root0, 'batch-sqlite'))
+        cc = Context(db=db)
+        with cc.batch_definitions():
+            define(cc)
+        db2 = StorageSQLite(os.path.join(self.root0, 'nobatch-sqlite'))
+        define(Context(db=db2))
+        self.assertSameDB(db, db2)
+
+    def testRedefinition(self):
+        define(self.cc)
+        cc = Context(db=self.db)
+        with cc.batch_definitions():
+            define(cc)
+        self.assertEqual(get_job('a', self.db).parents,
+                         set(['b', 'f', 'f-2', 'g']))
+        self.assertEqual(get_job('b', self.db).parents, set(['f', 'f-2']))
+
+        # parents added to a job not defined in the batch
+        with cc.batch_definitions():
+            cc.comp(f, Promise('b'), job_id='h')
+            db = cc.get_compmake_db()
+            self.assertTrue('h' in get_job('b', db).parents)
+            self.assertFalse('h' in get_job('b', self.db).parents)
+        self.assertEqual(get_job('b', self.db).parents,
+                         set(['f', 'f-2', 'h']))
+
+    def testDynamic(self):
+        self.comp(generate, 3, job_id='generate', needs_context=True)
+        self.assert_cmd_success('make recurse=1')
+        self.assertJobsEqual('done', ['generate', 'gen0', 'gen1', 'gen2',
+                                      'gen-sum'])
+        self.assertEqual(get_job('gen1', self.db).parents, set(['gen-sum']))
+        self.assertEqual(get_job_userobject('gen-sum', self.db), 3)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake.jobs import (get_job_cache, get_job_logs, job2cachekey,
+                           job2logskey, set_job_cache)
+from compmake.structures import Cache
+
+from .compmake_test import CompmakeTest
+
+
+class Switch(object):
+    fail = True
+
+
+def verbose(x):
+    print('line\n' * 10000)
+    if Switch.fail:
+        raise ValueError('failed %s' % x)
+    return x
+
+
+@istest
+class TestCacheLogs(CompmakeTest):
+
+    def testSplit(self):
+        db = self.db
+        self.comp(verbose, 1)
+        Switch.fail = True
+        self.assert_cmd_fail('make')
+
+        cache = get_job_cache('verbose', db)
+        self.assertEqual(cache.state, Cache.FAILED)
+        self.assertTrue('failed 1' in cache.exception)
+        # the output is not in the cache record
+        self.assertEqual(cache.captured_stdout, None)
+        self.assertTrue(db.sizeof(job2cachekey('verbose')) < 10000)
+        self.assertTrue(db.sizeof(job2logskey('verbose')) > 0)
+        logs = get_job_logs('verbose', db)
+        self.assertTrue('line' in str(logs['captured_stdout']))
+        self.assertTrue('ValueError' in logs['backtrace'])
+        self.assert_cmd_success('details verbose; why verbose')
+
+        # rewriting the cache keeps them
+        set_job_cache('verbose', cache, db)
+        self.assertEqual(get_job_logs('verbose', db), logs)
+
+        Switch.fail = False
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_cache('verbose', db).state, Cache.DONE)
+        self.assertFalse(job2logskey('verbose') in db)
+        self.assertEqual(get_job_logs('verbose', db)['backtrace'], None)
+
+    def testOldCache(self):
+        self.comp(verbose, 2)
+        # as written by older versions
+        cache = Cache(Cache.FAILED)
+        cache.exception = 'e'
+        cache.backtrace = 'bt'
+        del cache.logs_stored
+        self.db[job2cachekey('verbose')] = cache
+        self.assertEqual(get_job_logs('verbose', self.db)['backtrace'], 'bt')
+        self.assert_cmd_success('details verbose')
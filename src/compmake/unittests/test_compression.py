@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import get_job_userobject
+from compmake.storage import StorageFilesystem
+from compmake.storage.compression import (codecs, compress_data,
+                                          decompress_data, header_magic)
+from compmake.utils import safe_pickle_dump
+
+from .compmake_test import CompmakeTest
+
+
+def big_result():
+    return ['compmake %d' % (i % 10) for i in range(10000)]
+
+
+def read_raw(db, key):
+    with open(db.filename_for_key(key), 'rb') as f:
+        return f.read()
+
+
+@istest
+class TestCompression(CompmakeTest):
+
+    def tearDown(self):
+        set_compmake_config('compression', 'auto')
+        CompmakeTest.tearDown(self)
+
+    def testRoundTrip(self):
+        data = b'abc' * 1000
+        for name in codecs:
+            c = compress_data(data, name)
+            if name != 'none':
+                self.assertTrue(c.startswith(header_magic), name)
+            self.assertEqual(decompress_data(c), data)
+
+    def testAdaptive(self):
+        db = self.db
+        # small records are not compressed
+        db['small'] = 1
+        self.assertFalse(read_raw(db, 'small').startswith(header_magic))
+        # nor the ones that do not get smaller
+        x = os.urandom(10000)
+        db['random'] = x
+        self.assertFalse(read_raw(db, 'random').startswith(header_magic))
+        self.assertEqual(db['random'], x)
+        # large ones are
+        db['large'] = big_result()
+        self.assertTrue(read_raw(db, 'large').startswith(header_magic))
+        self.assertEqual(db['large'], big_result())
+
+    def testMixedCodecs(self):
+        self.comp(big_result, job_id='a')
+        self.assert_cmd_success('make')
+        set_compmake_config('compression', 'zlib:9')
+        self.comp(big_result, job_id='b')
+        self.assert_cmd_success('make')
+        self.assertTrue(b'zlib' in read_raw(self.db, 'cm-res-b')[:10])
+        # a record written by older versions
+        safe_pickle_dump(big_result(), self.db.filename_for_key('c'))
+        self.assertTrue(read_raw(self.db, 'c').startswith(b'\x1f\x8b'))
+
+        # opening the DB as uncompressed is allowed now
+        db2 = StorageFilesystem(self.root, compress=False)
+        self.assertEqual(db2.file_extension, '.pickle.gz')
+        for x in ['a', 'b']:
+            self.assertEqual(get_job_userobject(x, db2), big_result())
+        self.assertEqual(db2['c'], big_result())
+        db2['d'] = big_result()
+        self.assertFalse(read_raw(db2, 'd').startswith(header_magic))
+        self.assertEqual(self.db['d'], big_result())
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from shutil import rmtree
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import (get_job_result_digest, get_job_userobject,
+                           job_userobject_sizeof)
+from compmake.jobs.job_index import get_job_index
+from compmake.jobs.storage import (indices_commit, set_job_userobject,
+                                   uses_blobs)
+from compmake.storage import StorageFilesystem
+from compmake.storage.records import decompress_record
+
+from .compmake_test import CompmakeTest
+
+
+def big(x):
+    return [x % 2] * 1000
+
+
+def small(x):
+    return x % 2
+
+
+@istest
+class TestDedup(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('dedup_results', True)
+
+    def tearDown(self):
+        set_compmake_config('dedup_results', False)
+        CompmakeTest.tearDown(self)
+
+    def blobs(self):
+        return self.db.keys(prefix='cm-blob-')
+
+    def testDedup(self):
+        for i in range(4):
+            self.comp(big, i, job_id='big%d' % i)
+        self.comp(small, 1, job_id='small')
+        self.assert_cmd_success('make')
+
+        # [0]*1000 and [1]*1000
+        self.assertEqual(len(self.blobs()), 2)
+        d0 = get_job_result_digest('big0', self.db)
+        self.assertEqual(d0, get_job_result_digest('big2', self.db))
+        self.assertNotEqual(d0, get_job_result_digest('big1', self.db))
+        # the record is the serialized result, not serialized again
+        data = decompress_record(self.db.get_record('cm-blob-%s' % d0))
+        self.assertEqual(hashlib.sha1(data).hexdigest(), d0)
+        # small results are stored inline
+        self.assertEqual(get_job_result_digest('small', self.db), None)
+        for i in range(4):
+            self.assertEqual(get_job_userobject('big%d' % i, self.db), big(i))
+        self.assertEqual(get_job_userobject('small', self.db), 1)
+        self.assertTrue(job_userobject_sizeof('big0', self.db) > 0)
+
+        # the blob is deleted with the last reference
+        self.assert_cmd_success('delete big0')
+        self.assertEqual(len(self.blobs()), 2)
+        self.assert_cmd_success('delete big2')
+        self.assertEqual(len(self.blobs()), 1)
+        self.assert_cmd_success('delete big1 big3')
+        self.assertEqual(self.blobs(), [])
+        self.assertEqual(self.db.keys(prefix='cm-ref-'), [])
+
+    def testParmake(self):
+        for i in range(4):
+            self.comp(big, i, job_id='big%d' % i)
+        self.assert_cmd_success('parmake n=2')
+        self.assertEqual(len(self.blobs()), 2)
+        # one set of references for each blob
+        d0 = get_job_result_digest('big0', self.db)
+        self.assertEqual(len(self.db.keys(prefix='cm-ref-')), 2)
+        self.assertEqual(self.db['cm-ref-%s' % d0], set(['big0', 'big2']))
+        self.assertEqual(get_job_userobject('big3', self.db), big(3))
+
+    def testSwitchOff(self):
+        self.comp(big, 0, job_id='big0')
+        self.assert_cmd_success('make')
+        self.assertEqual(len(self.blobs()), 1)
+        set_compmake_config('dedup_results', False)
+        # the old blob is released when the result is written inline
+        self.assert_cmd_success('remake big0')
+        self.assertEqual(self.blobs(), [])
+        self.assertEqual(get_job_userobject('big0', self.db), big(0))
+
+    def testLegacyRefs(self):
+        for i in [0, 2]:
+            self.comp(big, i, job_id='big%d' % i)
+        self.assert_cmd_success('make')
+        # one key per reference, as written by older versions
+        d0 = get_job_result_digest('big0', self.db)
+        del self.db['cm-ref-%s' % d0]
+        for job_id in ['big0', 'big2']:
+            self.db['cm-ref-%s-%s' % (d0, job_id)] = True
+        self.assert_cmd_success('delete big0')
+        self.assertEqual(self.db.keys(prefix='cm-ref-'), ['cm-ref-%s' % d0])
+        self.assertEqual(len(self.blobs()), 1)
+        self.assert_cmd_success('delete big2')
+        self.assertEqual(self.blobs(), [])
+
+    def testDBCreatedAgain(self):
+        self.comp(big, 0, job_id='big0')
+        self.assert_cmd_success('make')
+        self.assertTrue(uses_blobs(self.db))
+        rmtree(self.root)
+        self.db = StorageFilesystem(self.root, compress=True)
+        self.assertFalse(uses_blobs(self.db))
+
+    def testSameResult(self):
+        self.comp(big, 0, job_id='big0')
+        self.assert_cmd_success('make')
+        index = get_job_index(self.db)
+        indices_commit(self.db)
+        set_job_userobject('big0', big(0), self.db)
+        # nothing written: the row is not in 'inflight'
+        self.assertEqual(index.marked, set())
+        self.assertEqual(len(self.blobs()), 1)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import job2userobjectkey, job_userobject_sizeof
+from compmake.jobs.disk_usage import disk_usage
+from compmake.jobs.uptodate import CacheQueryDB
+
+from .compmake_test import CompmakeTest
+
+
+def big(x):
+    return [x % 2] * 10000
+
+
+def small(x):
+    return x
+
+
+def gen(context):
+    context.comp(small, 1)
+
+
+@istest
+class TestDiskUsage(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('dedup_results', True)
+        for i in range(3):
+            self.comp(big, i, job_id='big%d' % i)
+        self.cc.comp_dynamic(gen)
+        self.assert_cmd_success('make recurse=1')
+
+    def tearDown(self):
+        set_compmake_config('dedup_results', False)
+        CompmakeTest.tearDown(self)
+
+    def usage(self, job_ids=None):
+        return disk_usage(self.db, CacheQueryDB(self.db).all_jobs(), job_ids)
+
+    def testAll(self):
+        usage = self.usage()
+        nbytes = sum(self.db.sizeof(k) for k in self.db.keys())
+        self.assertEqual(usage.total, nbytes)
+        self.assertEqual(sum(b for _, b in usage.by_key_type.values()),
+                         nbytes)
+        # big0 and big2 share the same result
+        self.assertEqual(usage.by_key_type['cm-blob'][0], 2)
+        self.assertEqual(usage.by_key_type['cm-job'][0], 5)
+        self.assertEqual(sorted(usage.by_command), ['big', 'gen', 'small'])
+        self.assertEqual(sorted(usage.by_defined_by), ['gen', 'root'])
+        self.assertTrue(usage.by_command['big'] > usage.by_command['small'])
+        self.assertEqual(usage.results[0][0],
+                         max(job_userobject_sizeof('big%d' % i, self.db)
+                             for i in range(3)))
+        self.assertEqual(set(j for _, j in usage.results[:3]),
+                         set(['big0', 'big1', 'big2']))
+        self.assert_cmd_success('du; du top=1; du big0 big1')
+
+    def testSelected(self):
+        usage = self.usage(['big1', 'gen-small'])
+        self.assertEqual(usage.by_key_type['cm-blob'][0], 1)
+        self.assertEqual(sorted(usage.by_defined_by), ['gen', 'root'])
+        self.assertEqual(len(usage.results), 2)
+        self.assertTrue(job2userobjectkey('gen-small') in self.db)
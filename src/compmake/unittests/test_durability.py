@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.context import Context
+from compmake.exceptions import UserError
+from compmake.storage import StorageFilesystem, StorageSegments, StorageSQLite
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return x
+
+
+@istest
+class TestDurability(CompmakeTest):
+
+    def check_db(self, db):
+        set_compmake_config('durability_interval', 1000 * 1000)
+        db['cm-job-a'] = 1
+        db['cm-job-b'] = 2
+        del db['cm-job-b']
+        if db.durability == 'batch':
+            pending = db.sync_queue.files | db.sync_queue.dirs
+            self.assertTrue(pending)
+            db.sync()
+            self.assertTrue(db.sync_queue.nsyncs > 0)
+        self.assertFalse(db.sync_queue.files | db.sync_queue.dirs)
+        self.assertEqual(db['cm-job-a'], 1)
+        # due right away
+        set_compmake_config('durability_interval', 0)
+        db['cm-job-c'] = 3
+        self.assertFalse(db.sync_queue.files | db.sync_queue.dirs)
+        set_compmake_config('durability_interval', 1000)
+
+    def testBackends(self):
+        for durability in ['none', 'batch', 'strict']:
+            for backend in [StorageFilesystem, StorageSQLite,
+                            StorageSegments]:
+                root = os.path.join(self.root0, '%s-%s' % (durability,
+                                                          backend.__name__))
+                self.check_db(backend(root, durability=durability))
+
+    def testUnknown(self):
+        self.assertRaises(UserError, StorageFilesystem,
+                          os.path.join(self.root0, 'x'), durability='always')
+
+    def testMake(self):
+        set_compmake_config('durability', 'batch')
+        try:
+            db = StorageFilesystem(os.path.join(self.root0, 'batch'))
+            self.cc = Context(db=db)
+            for i in range(4):
+                self.comp(f, i)
+            self.assert_cmd_success('make')
+            self.assertJobsEqual('done', ['f', 'f-2', 'f-3', 'f-4'])
+            self.assertFalse(db.sync_queue.files)
+        finally:
+            set_compmake_config('durability', 'none')
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import get_job_cache
+
+from .compmake_test import CompmakeTest
+
+
+class Counts(object):
+    value = 1
+    runs = {}
+
+
+def source():
+    return [Counts.value] * 10
+
+
+def use(x, name):
+    Counts.runs[name] = Counts.runs.get(name, 0) + 1
+    return sum(x) if isinstance(x, list) else x
+
+
+def pair(x, y, name):
+    Counts.runs[name] = Counts.runs.get(name, 0) + 1
+    return [x, y]
+
+
+class Pickled(object):
+    """ Counts how many times it is serialized. """
+    dumps = 0
+
+    def __getstate__(self):
+        Pickled.dumps += 1
+        return {}
+
+
+def make_pickled():
+    return Pickled()
+
+
+@istest
+class TestEarlyCutoff(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('early_cutoff', True)
+        Counts.value = 1
+        Counts.runs = {}
+        a = self.comp(source, job_id='a')
+        b = self.comp(use, a, 'b', job_id='b')
+        self.comp(use, b, 'c', job_id='c')
+        self.b = b
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 1, 'c': 1})
+
+    def tearDown(self):
+        set_compmake_config('early_cutoff', False)
+        CompmakeTest.tearDown(self)
+
+    def testDigests(self):
+        a = get_job_cache('a', self.db)
+        b = get_job_cache('b', self.db)
+        self.assertEqual(len(a.result_digest), 40)
+        self.assertEqual(b.hashes_dependencies, {'a': a.result_digest})
+
+    def testSameResult(self):
+        self.assert_cmd_success('remake a')
+        self.assertJobsEqual('uptodate', ['a', 'b', 'c'])
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 1, 'c': 1})
+
+    def testSameMake(self):
+        # b and c are skipped once a is remade
+        self.assert_cmd_success('invalidate a')
+        self.assertJobsEqual('uptodate', [])
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 1, 'c': 1})
+        self.assertJobsEqual('uptodate', ['a', 'b', 'c'])
+
+    def testDifferentResult(self):
+        Counts.value = 2
+        self.assert_cmd_success('remake a')
+        self.assertJobsEqual('uptodate', ['a'])
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 2, 'c': 2})
+
+    def testCutoffAfterOneLevel(self):
+        # b is remade with the same result: c is not
+        self.assert_cmd_success('remake b')
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 2, 'c': 1})
+
+    def testDisabled(self):
+        set_compmake_config('early_cutoff', False)
+        self.assert_cmd_success('remake a')
+        self.assertJobsEqual('uptodate', ['a'])
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs, {'b': 2, 'c': 2})
+
+    def testChain(self):
+        prev = self.comp(use, 'c', 'd0', job_id='d0')
+        for i in range(1, 50):
+            prev = self.comp(use, prev, 'd%d' % i, job_id='d%d' % i)
+        self.assert_cmd_success('make')
+        self.assert_cmd_success('invalidate a')
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs['d49'], 1)
+        self.assertEqual(len(self.get_jobs('uptodate')), 53)
+
+    def testSerializedOnce(self):
+        Pickled.dumps = 0
+        self.comp(make_pickled, job_id='p')
+        self.assert_cmd_success('make p')
+        self.assertEqual(Pickled.dumps, 1)
+
+    def testNoDigest(self):
+        # x is made with the switch off: its results have no digest
+        set_compmake_config('early_cutoff', False)
+        x = self.comp(source, job_id='x')
+        self.assert_cmd_success('make x')
+        set_compmake_config('early_cutoff', True)
+        self.comp(pair, x, self.b, 'e', job_id='e')
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_cache('e', self.db).hashes_dependencies,
+                         {'b': get_job_cache('b', self.db).result_digest})
+
+        set_compmake_config('early_cutoff', False)
+        Counts.value = 2
+        self.assert_cmd_success('remake x')
+        set_compmake_config('early_cutoff', True)
+        self.assert_cmd_success('make')
+        self.assertEqual(Counts.runs['e'], 2)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import six
+from nose.tools import istest
+
+from compmake import Context, set_compmake_config
+from compmake.jobs import get_job, get_job_cache
+from compmake.jobs.fingerprint import code_fingerprint, fingerprints
+from compmake.plugins.details_why import details_why_one
+
+from .compmake_test import CompmakeTest
+
+
+def define(source, name='f'):
+    namespace = {}
+    exec(source, namespace)
+    return namespace[name]
+
+
+helper1 = """
+def helper(x):
+    return x + 1
+"""
+
+helper2 = """
+def helper(x):
+    return x + 2
+"""
+
+f1 = """
+
+def f(x):
+    ''' Docstring. '''
+    return helper(x) * 2
+"""
+
+f2 = """
+def f(x):
+    ''' Another docstring. '''
+    return helper(x) * 2
+"""
+
+f3 = """
+def f(x):
+    return helper(x) * 3
+"""
+
+recursive = """
+def f(x):
+    return f(x - 1) if x else helper(x)
+"""
+
+mutual1 = """
+def f(x):
+    return g(x - 1) if x else 0
+
+def g(x):
+    return f(x - 1) if x else 1
+"""
+
+mutual2 = """
+def f(x):
+    return g(x - 1) if x else 0
+
+def g(x):
+    return f(x - 1) if x else 2
+"""
+
+
+def g1(x):
+    return x
+
+
+def g2(x):
+    return x + 1
+
+
+def h(x):
+    return x
+
+
+@istest
+class TestFingerprint(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('code_fingerprints', True)
+
+    def tearDown(self):
+        set_compmake_config('code_fingerprints', False)
+        CompmakeTest.tearDown(self)
+
+    def testFunctions(self):
+        a = code_fingerprint(define(helper1 + f1))
+        self.assertEqual(len(a), 40)
+        # not the docstring and the line numbers
+        self.assertEqual(a, code_fingerprint(define(helper1 + f2)))
+        self.assertNotEqual(a, code_fingerprint(define(helper1 + f3)))
+        # the functions called
+        self.assertNotEqual(a, code_fingerprint(define(helper2 + f1)))
+        self.assertEqual(code_fingerprint(len), None)
+
+    def testRecursive(self):
+        f = define(helper1 + recursive)
+        a = code_fingerprint(f)
+        self.assertTrue(f in fingerprints)
+        self.assertNotEqual(a, code_fingerprint(define(helper2 + recursive)))
+
+    def testMutual(self):
+        f = define(mutual1)
+        a = code_fingerprint(f)
+        self.assertTrue(f in fingerprints)
+        self.assertTrue(six.get_function_globals(f)['g'] in fingerprints)
+        # the same, whichever function is seen first
+        g = define(mutual1, 'g')
+        b = code_fingerprint(g)
+        self.assertEqual(a, code_fingerprint(six.get_function_globals(g)['f']))
+        self.assertNotEqual(a, b)
+        self.assertNotEqual(a, code_fingerprint(define(mutual2)))
+
+    def testRedefined(self):
+        self.comp(g1, 1, job_id='x')
+        self.comp(h, 1, job_id='y')
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job('x', self.db).fingerprint,
+                         code_fingerprint(g1))
+
+        # (new sessions)
+        self.cc = Context(db=self.db)
+        self.comp(g1, 1, job_id='x')
+        self.comp(h, 1, job_id='y')
+        self.assertJobsEqual('uptodate', ['x', 'y'])
+
+        self.cc = Context(db=self.db)
+        self.comp(g2, 1, job_id='x')
+        self.comp(h, 1, job_id='y')
+        self.assertJobsEqual('uptodate', ['y'])
+        reason = get_job_cache('x', self.db).remake_reason
+        self.assertTrue('function' in reason, reason)
+        _, status, why = details_why_one('x', self.cc, None)
+        self.assertEqual((status, why), ('to remake', reason))
+        self.assert_cmd_success('make')
+        self.assertJobsEqual('uptodate', ['x', 'y'])
+        self.assertEqual(details_why_one('x', self.cc, None), None)
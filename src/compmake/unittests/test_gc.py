@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake.jobs.garbage import find_garbage
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return x
+
+
+@istest
+class TestGC(CompmakeTest):
+
+    def mySetUp(self):
+        for i in range(3):
+            self.comp(f, i)
+        self.assert_cmd_success('make')
+
+    def testRecords(self):
+        db = self.db
+        # as left by a job that was deleted
+        db['cm-res-gone'] = 'x' * 1000
+        db['cm-args-gone'] = 1
+        db['cm-cache-gone'] = 1
+        db['cm-ref-%s' % ('0' * 40)] = set(['gone'])
+        db['cm-ref-%s-gone' % ('2' * 40)] = True  # older format
+        db['cm-blob-%s' % ('0' * 40)] = b'y' * 1000
+        db['cm-blob-%s' % ('1' * 40)] = b'z' * 1000
+
+        garbage = find_garbage(db)
+        self.assertEqual(len(garbage), 7)
+        self.assertTrue(all(g.nbytes > 0 for g in garbage))
+        self.assert_cmd_success('gc dry_run=1')
+        self.assertTrue('cm-res-gone' in db)
+        self.assert_cmd_success('gc')
+        self.assertEqual(find_garbage(db), [])
+        self.assertFalse('cm-res-gone' in db)
+        self.assertJobsEqual('done', ['f', 'f-2', 'f-3'])
+        self.assert_cmd_success('make; check-consistency')
+
+    def testFiles(self):
+        tmp = os.path.join(self.db.basepath, 'cm-job-f.pickle.gz.tmp.1234')
+        spool = os.path.join(self.db.basepath, 'sge', '2020-01-01')
+        results = os.path.join(self.db.basepath, 'parmake_job2_new_process')
+        for d in [spool, results]:
+            os.makedirs(d)
+        old = os.path.join(results, 'f.results.pickle')
+        for fn in [tmp, os.path.join(spool, 'job.sh'), old]:
+            with open(fn, 'wb') as fo:
+                fo.write(b'data')
+
+        # too recent
+        self.assertEqual(find_garbage(self.db), [])
+        garbage = find_garbage(self.db, min_age=0)
+        self.assertEqual(sorted(g.what for g in garbage),
+                         ['dir', 'file', 'file'])
+        self.assert_cmd_success('gc min_age=0')
+        for fn in [tmp, spool, old]:
+            self.assertFalse(os.path.exists(fn))
+        self.assertTrue(os.path.exists(results))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import CacheQueryDB, get_jobs_and_caches
+from compmake.storage import (BatchDB, MemoryCache, StorageFilesystem,
+                              StorageSegments, StorageSQLite)
+from compmake.structures import Cache
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return x
+
+
+@istest
+class TestGetMany(CompmakeTest):
+
+    def check_db(self, db):
+        keys = ['cm-job-%d' % i for i in range(20)]
+        for i, k in enumerate(keys):
+            db[k] = {'i': i}
+        query = keys + ['cm-job-missing']
+        for threads in [8, 1]:
+            set_compmake_config('db_threads', threads)
+            values = db.get_many(query)
+            self.assertEqual(sorted(values), sorted(keys))
+            for i, k in enumerate(keys):
+                self.assertEqual(values[k], {'i': i})
+            self.assertEqual(db.contains_many(query), set(keys))
+        set_compmake_config('db_threads', 8)
+        self.assertEqual(db.get_many([]), {})
+
+    def testFilesystem(self):
+        self.check_db(StorageFilesystem(os.path.join(self.root0, 'fs'),
+                                        compress=True))
+
+    def testSQLite(self):
+        self.check_db(StorageSQLite(os.path.join(self.root0, 'sqlite')))
+
+    def testSegments(self):
+        self.check_db(StorageSegments(os.path.join(self.root0, 'segments')))
+
+    def testMemoryCache(self):
+        db = MemoryCache(StorageFilesystem(os.path.join(self.root0, 'mc')))
+        self.check_db(db)
+        self.assertTrue(db.hits > 0)
+        self.assertEqual(len(db.data), 20)
+
+    def testBatch(self):
+        raw = StorageFilesystem(os.path.join(self.root0, 'batch'))
+        raw['cm-job-x'] = 1
+        db = BatchDB(raw)
+        self.check_db(db)
+        del db['cm-job-x']
+        self.assertEqual(db.get_many(['cm-job-x', 'cm-job-1']),
+                         {'cm-job-1': {'i': 1}})
+
+    def testPrefetch(self):
+        for i in range(10):
+            self.comp(f, i)
+        self.assert_cmd_success('make f f-2')
+        job_ids = ['f'] + ['f-%d' % i for i in range(2, 11)]
+        jobs, caches = get_jobs_and_caches(job_ids + ['none'], self.db)
+        self.assertEqual(sorted(jobs), sorted(job_ids))
+        self.assertEqual(caches['f'].state, Cache.DONE)
+        self.assertEqual(caches['f-3'].state, Cache.NOT_STARTED)
+
+        cq = CacheQueryDB(self.db)
+        cq.prefetch(job_ids + ['none'])
+        self.assertEqual(cq.get_job('f-3').job_id, 'f-3')
+        self.assertFalse(cq.job_exists('none'))
+        self.assertEqual(cq.get_job_cache('f-2').state, Cache.DONE)
+        self.assert_cmd_success('ls; stats; make; check-consistency')
+        self.assertJobsEqual('done', job_ids)
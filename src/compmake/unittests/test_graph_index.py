@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import (all_jobs, children, definition_closure, get_job,
+                           direct_children, direct_parents, parents, set_job)
+from compmake.jobs.graph_index import (GraphIndex, get_graph_index,
+                                      load_graph_index)
+from compmake.jobs.storage import indices_commit
+
+from .compmake_test import CompmakeTest
+
+
+def f(*args):
+    return len(args)
+
+
+def gen(context):
+    a = context.comp(f)
+    context.comp(f, a)
+
+
+@istest
+class TestGraphIndex(CompmakeTest):
+
+    def mySetUp(self):
+        a = self.comp(f, job_id='a')
+        b = self.comp(f, a, job_id='b')
+        c = self.comp(f, a, b, job_id='c')
+        d = self.cc.comp_dynamic(gen, job_id='d')
+        self.comp(f, c, d, job_id='e')
+        self.assert_cmd_success('make recurse=1')
+
+    def answers(self):
+        res = {}
+        for job_id in sorted(all_jobs(self.db)):
+            res[job_id] = (direct_children(job_id, self.db),
+                           direct_parents(job_id, self.db),
+                           children(job_id, self.db),
+                           parents(job_id, self.db),
+                           definition_closure([job_id], self.db))
+        return res
+
+    def without_index(self):
+        set_compmake_config('graph_index', False)
+        try:
+            return self.answers()
+        finally:
+            set_compmake_config('graph_index', True)
+
+    def testSameAnswers(self):
+        with_index = self.answers()
+        self.assertEqual(with_index, self.without_index())
+        self.assertEqual(with_index['a'][3], set(['b', 'c', 'e']))
+        self.assertEqual(with_index['d'][4], set(['d-f', 'd-f-2']))
+
+    def testUpdated(self):
+        self.assert_cmd_success('clean d')
+        self.assertEqual(self.answers(), self.without_index())
+        self.assertEqual(definition_closure(['d'], self.db), set())
+        self.assert_cmd_success('make recurse=1')
+        self.assertEqual(self.answers(), self.without_index())
+        job = get_job('a', self.db)
+        job.parents.add('x')
+        set_job('a', job, self.db)
+        self.assertEqual(direct_parents('a', self.db), set(['b', 'c', 'x']))
+
+    def testPersisted(self):
+        index = GraphIndex(self.db.basepath)
+        read = []
+        index.add_from_db = lambda db, job_ids: read.extend(job_ids)
+        index.sync(self.db)
+        # the rows are read from the file, not from the records
+        self.assertEqual(read, [])
+        self.assertEqual(index.direct('children', 'c'), set(['a', 'b']))
+        self.assertEqual(index.closure('children', ['e']),
+                         set(['a', 'b', 'c', 'd']))
+
+    def testOtherProcess(self):
+        index = load_graph_index(self.db)
+        other = GraphIndex(self.db.basepath)
+        other.sync(self.db)
+        other.set_job('a', get_job('b', self.db))
+        other.commit()
+        self.assertEqual(index.direct('children', 'a'), set())
+        # read once per command
+        load_graph_index(self.db)
+        self.assertEqual(index.direct('children', 'a'), set())
+        indices_commit(self.db)
+        load_graph_index(self.db)
+        self.assertEqual(index.direct('children', 'a'), set(['a']))
+
+    def testDeepChain(self):
+        with self.cc.batch_definitions():
+            prev = self.comp(f, job_id='chain0')
+            for i in range(1, 3000):
+                prev = self.comp(f, prev, job_id='chain%d' % i)
+        self.assertEqual(len(parents('chain0', self.db)), 2999)
+        set_compmake_config('graph_index', False)
+        try:
+            self.assertEqual(len(children('chain2999', self.db)), 2999)
+        finally:
+            set_compmake_config('graph_index', True)
+
+    def testWrittenWithoutIndex(self):
+        self.assertEqual(direct_parents('a', self.db), set(['b', 'c']))
+        set_compmake_config('graph_index', False)
+        try:
+            job = get_job('a', self.db)
+            job.parents.add('x')
+            set_job('a', job, self.db)
+        finally:
+            set_compmake_config('graph_index', True)
+        self.assertEqual(direct_parents('a', self.db), set(['b', 'c', 'x']))
+        # also for a new process
+        index = GraphIndex(self.db.basepath)
+        index.sync(self.db)
+        self.assertEqual(index.direct('parents', 'a'), set(['b', 'c', 'x']))
+
+    def testInterrupted(self):
+        index = get_graph_index(self.db)
+        # the process dies after writing the record
+        index.writing('a')
+        index.commit_marks()
+        job = get_job('a', self.db)
+        job.parents.add('x')
+        self.db['cm-job-a'] = job
+        index.marked = set()
+        other = GraphIndex(self.db.basepath)
+        other.sync(self.db)
+        self.assertEqual(other.direct('parents', 'a'), set(['b', 'c', 'x']))
+
+    def testCommit(self):
+        index = load_graph_index(self.db)
+        other = GraphIndex(self.db.basepath)
+        other.sync(self.db)
+        job = get_job('a', self.db)
+        job.parents.add('x')
+        set_job('a', job, self.db)
+        set_job('a', job, self.db)
+        # listed once in 'inflight', and written at the end of the command
+        c = index._get_connection()
+        inflight = [row[0] for row in c.execute('SELECT * FROM inflight')]
+        self.assertEqual(inflight, ['a'])
+        self.assertEqual(index.direct('parents', 'a'), set(['b', 'c', 'x']))
+        other.sync(self.db)
+        self.assertEqual(other.direct('parents', 'a'), set(['b', 'c']))
+        indices_commit(self.db)
+        self.assertEqual(list(c.execute('SELECT * FROM inflight')), [])
+        other.sync(self.db)
+        self.assertEqual(other.direct('parents', 'a'), set(['b', 'c', 'x']))
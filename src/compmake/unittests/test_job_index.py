@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import (get_job, get_job_cache, job2cachekey, set_job,
+                           set_job_cache)
+from compmake.jobs.job_index import JobIndex, get_job_index, load_job_index
+from compmake.jobs.storage import indices_commit
+from compmake.jobs.uptodate import CacheQueryDB
+from compmake.structures import Cache
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return x
+
+
+def g(x):
+    raise ValueError(x)
+
+
+def gen(context):
+    context.comp(f, 10)
+
+
+@istest
+class TestJobIndex(CompmakeTest):
+
+    def mySetUp(self):
+        for i in range(3):
+            self.comp(f, i)
+        self.comp(g, self.comp(f, 4))
+        self.comp_dynamic(gen)
+        self.assert_cmd_fail('make')
+
+    def comp_dynamic(self, *args, **kwargs):
+        return self.cc.comp_dynamic(*args, **kwargs)
+
+    def expressions(self):
+        return ['failed', 'done', 'todo', 'blocked', 'root', 'generated',
+                'level1', 'dynamic', 'not_started', 'f()', 'g()']
+
+    def testSameResults(self):
+        with_index = dict((e, self.get_jobs(e)) for e in self.expressions())
+        set_compmake_config('job_index', False)
+        try:
+            without = dict((e, self.get_jobs(e)) for e in self.expressions())
+        finally:
+            set_compmake_config('job_index', True)
+        self.assertEqual(with_index, without)
+        self.assertEqual(with_index['failed'], ['g'])
+        self.assertEqual(with_index['generated'], ['gen-f'])
+        self.assertEqual(with_index['dynamic'], ['gen'])
+
+    def testRows(self):
+        index = get_job_index(self.db)
+        self.assertTrue(os.path.exists(index.filename))
+        # gen-f has not been started: not known yet
+        self.assertEqual(index.get(['gen-f'])['gen-f'].state, None)
+        load_job_index(self.db, CacheQueryDB(self.db).all_jobs())
+        info = index.get(['f', 'g'])
+        self.assertEqual(info['f'].state, Cache.DONE)
+        self.assertEqual(info['f'].command, 'f')
+        self.assertTrue(info['f'].cputime is not None)
+        self.assertTrue(info['f'].result_size > 0)
+        self.assertEqual(info['g'].state, Cache.FAILED)
+        self.assertEqual(info['g'].result_size, 0)
+        summary = index.summary()
+        self.assertEqual(summary['f'], {Cache.DONE: 4, Cache.NOT_STARTED: 1})
+        self.assertEqual(index.summary(['f', 'g']),
+                         {'f': {Cache.DONE: 1}, 'g': {Cache.FAILED: 1}})
+        self.assert_cmd_success('stats; stats f(); clean f; stats')
+        self.assertEqual(index.get(['f'])['f'].state, Cache.NOT_STARTED)
+
+    def testRebuild(self):
+        index = get_job_index(self.db)
+        index.remove()
+        cq = CacheQueryDB(self.db)
+        load_job_index(self.db, cq.all_jobs())
+        self.assertEqual(index.count(), len(cq.all_jobs()))
+        self.assertEqual(index.get(['g'])['g'].state, Cache.FAILED)
+        self.assertEqual(index.get(['gen-f'])['gen-f'].command, 'f')
+        # a job that is not in the DB anymore
+        index.set_job('gone', get_job('f', self.db))
+        index.commit()
+        self.assertJobsEqual('failed', ['g'])
+        self.assertEqual(index.job_ids('job_id = ?', ('gone',)), set())
+
+    def testUnknownState(self):
+        # as after set_job() for a job defined again, when the file
+        # did not exist
+        index = JobIndex(self.root)
+        index.remove()
+        set_job('g', get_job('g', self.db), self.db)
+        indices_commit(self.db)
+        self.assertEqual(index.get(['g'])['g'].state, None)
+        self.assertJobsEqual('failed', ['g'])
+        self.assertEqual(index.get(['g'])['g'].state, Cache.FAILED)
+
+    def testWrittenWithoutIndex(self):
+        self.assertJobsEqual('failed', ['g'])
+        set_compmake_config('job_index', False)
+        try:
+            set_job_cache('f', Cache(Cache.FAILED), self.db)
+        finally:
+            set_compmake_config('job_index', True)
+        self.assertJobsEqual('failed', ['f', 'g'])
+
+    def testInterrupted(self):
+        self.assertJobsEqual('failed', ['g'])
+        # the process dies after writing the record
+        index = get_job_index(self.db)
+        index.writing('f')
+        index.commit_marks()
+        self.db[job2cachekey('f')] = Cache(Cache.FAILED)
+        index.marked = set()
+        self.assertJobsEqual('failed', ['f', 'g'])
+        # (read once)
+        set_job_cache('f', get_job_cache('f', self.db), self.db)
+        inflight = 'job_id IN (SELECT job_id FROM inflight)'
+        # listed until the end of the job or of the command
+        self.assertEqual(index.job_ids(inflight), set(['f']))
+        indices_commit(self.db)
+        self.assertEqual(index.job_ids(inflight), set())
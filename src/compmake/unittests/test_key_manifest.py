@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake.jobs import all_jobs
+from compmake.storage import StorageFilesystem
+from compmake.storage.key_manifest import KeyManifest
+
+from .compmake_test import CompmakeTest
+
+
+def f1(x):
+    return x * 2
+
+
+@istest
+class TestKeyManifest(CompmakeTest):
+
+    def testPrefix(self):
+        db = self.db
+        for k in ['cm-job-a', 'cm-job-b', 'cm-cache-a', 'cm-jobs']:
+            db[k] = 1
+        self.assertEqual(db.keys(prefix='cm-job-'), ['cm-job-a', 'cm-job-b'])
+        self.assertEqual(db.keys(), ['cm-cache-a', 'cm-job-a', 'cm-job-b',
+                                     'cm-jobs'])
+        del db['cm-job-a']
+        self.assertEqual(db.keys(prefix='cm-job-'), ['cm-job-b'])
+
+    def testOtherProcess(self):
+        # another instance sees the changes by reading the tail
+        db2 = StorageFilesystem(self.root, compress=True)
+        self.assertEqual(db2.keys(), [])
+        self.db['a'] = 1
+        self.db['b'] = 1
+        self.assertEqual(db2.keys(), ['a', 'b'])
+        del self.db['a']
+        self.assertEqual(db2.keys(), ['b'])
+
+    def testRebuild(self):
+        for i in range(5):
+            self.comp(f1, i)
+        self.assert_cmd_success('make')
+        keys = self.db.keys()
+        os.unlink(self.db.manifest.filename)
+        self.assertEqual(self.db.keys(), keys)
+        self.assertEqual(set(all_jobs(self.db)),
+                         set(['f1', 'f1-2', 'f1-3', 'f1-4', 'f1-5']))
+
+        # the manifest agrees with the files
+        self.assertEqual(keys, sorted(set(self.db.keys0())))
+
+    def testCompaction(self):
+        m = KeyManifest(os.path.join(self.root0, 'manifest'))
+        m.rebuild(lambda: ['x'])
+        m.compact_min_lines = 10
+        for i in range(20):
+            m.add('k%d' % i)
+            m.remove('k%d' % i)
+        ino = os.stat(m.filename).st_ino
+        self.assertEqual(m.keys(), set(['x']))
+        # it was compacted
+        with open(m.filename) as f:
+            self.assertEqual(f.read(), '+x\n')
+        self.assertNotEqual(ino, os.stat(m.filename).st_ino)
+        m2 = KeyManifest(m.filename)
+        self.assertEqual(m2.keys(), set(['x']))
+
+    def testInterrupted(self):
+        # a writer died between adding() and add()
+        m = self.db.manifest
+        self.db['a'] = 1
+        m.adding('b')
+        self.assertEqual(self.db.keys(), ['a'])
+        # (the record written, without the manifest)
+        other = StorageFilesystem(self.root, compress=True)
+        other.manifest = None
+        other['b'] = 2
+        self.assertEqual(self.db.keys(), ['a', 'b'])
+        db2 = StorageFilesystem(self.root, compress=True)
+        self.assertEqual(db2.keys(), ['a', 'b'])
+        self.assertEqual(db2['b'], 2)
+        m.compact(exists=self.db._record_exists)
+        with open(m.filename) as f:
+            self.assertEqual(f.read(), '+a\n+b\n')
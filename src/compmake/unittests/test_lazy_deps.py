@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+from nose.tools import istest
+
+from compmake.jobs import get_job_userobject
+from compmake.jobs.dependencies import get_job_userobject_resolved
+from compmake.jobs.job_execution import get_cmd_args_kwargs
+from compmake.jobs.lazy_deps import LazyLoader, LazyResult
+
+from .compmake_test import CompmakeTest
+
+
+def make_list(n):
+    return list(range(n))
+
+
+def make_dict(n):
+    return dict(n=n)
+
+
+def pick(which, a, b):
+    if which == 'a':
+        return len(a)
+    else:
+        return b['n']
+
+
+def combine(a, b):
+    return [a, b]
+
+
+def delegate(context):
+    """ Returns promises to other jobs. """
+    a = context.comp(make_list, 5, job_id='d-a')
+    b = context.comp(make_dict, 3, job_id='d-b')
+    return [a, b]
+
+
+@istest
+class TestLazyDeps(CompmakeTest):
+
+    def define(self):
+        a = self.comp(make_list, 5, job_id='a')
+        b = self.comp(make_dict, 3, job_id='b')
+        self.comp(pick, 'a', a, b, job_id='pick_a', lazy_deps=True)
+        self.comp(pick, 'b', a, b, job_id='pick_b', lazy_deps=True)
+        self.comp(combine, a, b, job_id='both')
+
+    def testMake(self):
+        self.define()
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_userobject('pick_a', self.db), 5)
+        self.assertEqual(get_job_userobject('pick_b', self.db), 3)
+        self.assertTrue(self.get_job('pick_a').lazy_deps)
+        self.assertFalse(self.get_job('both').lazy_deps)
+
+    def testOnlyUsed(self):
+        self.define()
+        self.assert_cmd_success('make a b')
+        loader = LazyLoader(self.db)
+        _, args, _ = get_cmd_args_kwargs('pick_a', self.db, loader=loader)
+        self.assertEqual(loader.loaded, {})
+        self.assertEqual(pick(*args), 5)
+        self.assertEqual(list(loader.loaded), ['a'])
+        self.assertTrue(loader.walltime >= 0)
+
+    def testProxy(self):
+        self.define()
+        self.assert_cmd_success('make a b')
+        loader = LazyLoader(self.db)
+        a = LazyResult('a', loader)
+        b = LazyResult('b', loader)
+        self.assertTrue(isinstance(a, list))
+        self.assertTrue(isinstance(b, dict))
+        self.assertEqual(a, [0, 1, 2, 3, 4])
+        self.assertEqual(a[1:3], [1, 2])
+        self.assertEqual(a + [5], [0, 1, 2, 3, 4, 5])
+        self.assertEqual([9] + a, [9, 0, 1, 2, 3, 4])
+        self.assertEqual(sum(a), 10)
+        self.assertTrue(3 in a)
+        self.assertEqual(b.get('n'), 3)
+        self.assertEqual(b['n'] * 2, 6)
+        self.assertEqual(pickle.loads(pickle.dumps(b)), {'n': 3})
+
+    def testResolved(self):
+        self.cc.comp_dynamic(delegate, job_id='delegate')
+        self.assert_cmd_success('make recurse=1')
+        lazy = get_job_userobject_resolved('delegate', self.db, lazy=True)
+        self.assertTrue(all(type(x) is LazyResult for x in lazy))
+        self.assertEqual(lazy, [[0, 1, 2, 3, 4], {'n': 3}])
+        self.assertEqual(get_job_userobject_resolved('delegate', self.db),
+                         lazy)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+from nose.tools import istest
+
+from compmake.jobs import get_job_cache, get_job_userobject
+from compmake.storage import MemoryCache, StorageFilesystem, StorageSQLite
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return x
+
+
+def mk():
+    return set([1, 2, 3])
+
+
+def mut(x):
+    x.add(99)
+    return len(x)
+
+
+def read(x, _):
+    return sorted(x)
+
+
+@istest
+class TestMemoryCache(CompmakeTest):
+
+    def testWrapped(self):
+        db = self.cc.get_compmake_db()
+        self.assertTrue(isinstance(db, MemoryCache))
+        self.assertEqual(db.basepath, self.db.basepath)
+        self.comp(f, 1, job_id='a')
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_userobject('a', db), 1)
+
+    def check_cache(self, raw):
+        db = MemoryCache(raw, max_bytes=10000, max_result_bytes=100)
+        db['cm-job-a'] = 1
+        self.assertEqual(db['cm-job-a'], 1)
+        self.assertEqual(db['cm-job-a'], 1)
+        self.assertEqual(db.hits, 1)
+        self.assertEqual(db.misses, 1)
+
+        # every read returns a new object
+        db['cm-cache-c'] = [1]
+        db['cm-cache-c'].append(2)
+        self.assertEqual(db['cm-cache-c'], [1])
+        db.get_many(['cm-cache-c'])['cm-cache-c'].append(2)
+        self.assertEqual(db.get_many(['cm-cache-c']), {'cm-cache-c': [1]})
+        del db['cm-cache-c']
+
+        # invalidation on write
+        db['cm-job-a'] = 2
+        self.assertEqual(db['cm-job-a'], 2)
+        del db['cm-job-a']
+        self.assertFalse('cm-job-a' in db)
+
+        # large results and arguments are not cached
+        db['cm-res-big'] = 'x' * 1000
+        db['cm-args-a'] = 1
+        db['cm-res-big'], db['cm-args-a']
+        self.assertEqual(list(db.data), [])
+
+        # eviction of the least recently used
+        for i in range(100):
+            db['cm-cache-%d' % i] = list(range(100))
+            db['cm-cache-%d' % i]
+        self.assertTrue(db.nbytes <= db.max_bytes)
+        self.assertTrue(db.evictions > 0)
+        self.assertTrue('cm-cache-99' in db.data)
+        self.assertFalse('cm-cache-0' in db.data)
+        self.assertEqual(db.get_stats()['entries'], len(db.data))
+
+        # the values are not pickled
+        db2 = pickle.loads(pickle.dumps(db))
+        self.assertEqual(len(db2.data), 0)
+        self.assertEqual(db2['cm-cache-99'], list(range(100)))
+        return db
+
+    def testFilesystem(self):
+        db = self.check_cache(self.db)
+        # written by another process
+        other = StorageFilesystem(self.root, compress=True)
+        db['cm-job-b'], db['cm-job-b'] = 'a', 'b'
+        self.assertEqual(db['cm-job-b'], 'b')
+        other['cm-job-b'] = 'a long string'
+        self.assertEqual(db['cm-job-b'], 'a long string')
+
+    def testSQLite(self):
+        db = self.check_cache(StorageSQLite(self.root + '-sqlite'))
+        other = StorageSQLite(self.root + '-sqlite')
+        db['cm-job-b'] = 'b'
+        self.assertEqual(db['cm-job-b'], 'b')
+        other['cm-job-b'] = 'c'
+        self.assertEqual(db['cm-job-b'], 'c')
+        # the other records written stay cached (per-key versions)
+        other['cm-job-x'] = 'x'
+        hits = db.hits
+        self.assertEqual(db['cm-job-b'], 'c')
+        self.assertEqual(db.hits, hits + 1)
+
+    def testMake(self):
+        for i in range(5):
+            self.comp(f, i)
+        self.assert_cmd_success('make')
+        self.assert_cmd_success('clean;make')
+        db = self.cc.get_compmake_db()
+        self.assertTrue(db.hits > 0)
+        self.assertEqual(get_job_cache('f', db).state,
+                         get_job_cache('f', self.db).state)
+
+    def testMutation(self):
+        x = self.comp(mk, job_id='mk')
+        n = self.comp(mut, x, job_id='mut')
+        self.comp(read, x, n, job_id='read')
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_userobject('read', self.db), [1, 2, 3])
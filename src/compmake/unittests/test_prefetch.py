@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake.context import Context
+from compmake.jobs import get_job_cache, set_job_userobject
+from compmake.jobs.job_execution import get_cmd_args_kwargs
+from compmake.jobs.prefetch import Prefetcher, PrefetchedDB
+from compmake.storage import StorageSQLite
+
+from .compmake_test import CompmakeTest
+
+
+def f(x):
+    return [x] * 1000
+
+
+def g(a, b):
+    return len(a) + len(b)
+
+
+@istest
+class TestPrefetch(CompmakeTest):
+
+    def mySetUp(self):
+        a = self.comp(f, 1, job_id='a')
+        b = self.comp(f, 2, job_id='b')
+        self.comp(g, a, b, job_id='g')
+        self.assert_cmd_success('make a b')
+
+    def prefetch(self, max_bytes=1024 * 1024):
+        p = Prefetcher(self.db, max_bytes=max_bytes)
+        p.set_hint('g')
+        # the job before: starts prefetching g
+        p.take('a', self.db)
+        p.thread.join()
+        return p
+
+    def testHits(self):
+        p = self.prefetch()
+        view = p.take('g', self.db)
+        self.assertTrue(isinstance(view, PrefetchedDB))
+        _, args, _ = get_cmd_args_kwargs('g', db=view)
+        self.assertEqual(list(args), [[1] * 1000, [2] * 1000])
+        self.assertEqual((view.hits, view.misses), (3, 0))
+
+    def testChanged(self):
+        p = self.prefetch()
+        set_job_userobject('b', [3], self.db)
+        view = p.take('g', self.db)
+        _, args, _ = get_cmd_args_kwargs('g', db=view)
+        self.assertEqual(args[1], [3])
+        self.assertEqual((view.hits, view.misses), (2, 1))
+
+    def testMaxBytes(self):
+        p = self.prefetch(max_bytes=1)
+        view = p.take('g', self.db)
+        get_cmd_args_kwargs('g', db=view)
+        self.assertEqual((view.hits, view.misses), (1, 2))
+
+    def testOtherJob(self):
+        p = self.prefetch()
+        view = p.take('b', self.db)
+        self.assertEqual(view.values, {})
+
+    def testParmake(self):
+        for i in range(4):
+            self.comp(g, self.comp(f, i), [i], job_id='h%d' % i)
+        self.assert_cmd_success('parmake n=2')
+        for i in range(4):
+            cache = get_job_cache('h%d' % i, self.db)
+            self.assertEqual(cache.prefetch_hits + cache.prefetch_misses, 2)
+        self.assert_cmd_success('details h0')
+
+
+@istest
+class TestPrefetchSQLite(TestPrefetch):
+    """ The prefetching thread uses its own connection. """
+
+    def mySetUp(self):
+        self.db = StorageSQLite(self.root, compress=True)
+        self.cc = Context(db=self.db)
+        TestPrefetch.mySetUp(self)
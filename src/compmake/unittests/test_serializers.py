@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import sys
+
+from nose.tools import istest
+import nose
+
+from compmake import set_compmake_config
+from compmake.exceptions import UserError
+from compmake.jobs import get_job_args, get_job_userobject
+from compmake.jobs.storage import job2userobjectkey
+from compmake.storage.compression import decompress_data
+from compmake.storage.serializers import (deserialize, serialize,
+                                          serialize_canonical, serializers)
+from compmake.structures import Cache
+
+from .compmake_test import CompmakeTest
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+
+def f1(x):
+    return {'x': x, 't': (x, 2.0), 's': set([x])}
+
+
+def f2(a, b):
+    return [a, b]
+
+
+def read_header(db, key):
+    """ Returns the name of the serializer used for the record. """
+    with open(db.filename_for_key(key), 'rb') as f:
+        data = decompress_data(f.read())
+    n = bytearray(data[4:5])[0]
+    return data[5:5 + n].decode('ascii')
+
+
+@istest
+class TestSerializers(CompmakeTest):
+
+    def tearDown(self):
+        set_compmake_config('serializer', 'pickle')
+        set_compmake_config('serializers', '')
+        CompmakeTest.tearDown(self)
+
+    def testRoundTrip(self):
+        c = Cache(Cache.DONE)
+        c.jobs_defined = set(['a', 'b'])
+        values = [c, {'a': (1, 2), (1, 2): [1.0, b'x', None]}, set([1])]
+        for name in serializers:
+            for v in values:
+                v2 = deserialize(serialize(v, name))
+                if isinstance(v, Cache):
+                    self.assertEqual(v2.jobs_defined, v.jobs_defined)
+                    self.assertEqual(v2.state, v.state)
+                else:
+                    self.assertEqual(v2, v)
+
+    def testCanonical(self):
+        names = ['s%d' % i for i in range(1000)]
+        a = set(names[:8])
+        # the same elements in a bigger table
+        b = set(names)
+        b.difference_update(names[8:])
+        shared = frozenset(['x', 'y'])
+        for v1, v2 in [(a, b), ([frozenset(a), shared, shared],
+                                [frozenset(b), shared, shared])]:
+            data = serialize_canonical(v1, 'pickle')
+            self.assertEqual(data, serialize_canonical(v2, 'pickle'))
+            self.assertEqual(deserialize(data), v1)
+        # no sets: as serialize()
+        self.assertEqual(serialize_canonical([1, 'a'], 'pickle'),
+                         serialize([1, 'a'], 'pickle'))
+
+    def testLegacy(self):
+        # records written before the header was introduced
+        data = pickle.dumps({'a': 1}, 2)
+        self.assertEqual(deserialize(data), {'a': 1})
+
+    def testUnknown(self):
+        self.assertRaises(UserError, self.comp, f1, 1, serializer='unknown')
+        self.assertRaises(UserError, self.db.set, 'k', 1, serializer='none')
+
+    def testPerKeyTypeAndJob(self):
+        others = [x for x in serializers if x != 'pickle']
+        if not others:
+            raise nose.SkipTest('No other serializer available.')
+        other = others[0]
+
+        set_compmake_config('serializers', 'cm-cache:%s' % other)
+        self.comp(f1, 1)
+        self.comp(f1, 2, serializer=other)
+        self.assert_cmd_success('make')
+
+        self.assertEqual(read_header(self.db, 'cm-cache-f1'), other)
+        self.assertEqual(read_header(self.db, 'cm-job-f1'), 'pickle')
+        self.assertEqual(read_header(self.db, 'cm-res-f1'), 'pickle')
+        self.assertEqual(read_header(self.db, 'cm-res-f1-2'), other)
+        self.assertEqual(read_header(self.db, 'cm-args-f1-2'), other)
+
+        self.assertEqual(get_job_userobject('f1-2', self.db), f1(2))
+        self.assertEqual(get_job_args('f1-2', self.db)[1], [2])
+        self.assert_cmd_success('parmake recurse=1')
+        self.assertJobsEqual('done', ['f1', 'f1-2'])
+
+    def testPerDB(self):
+        others = [x for x in serializers if x != 'pickle']
+        if not others:
+            raise nose.SkipTest('No other serializer available.')
+        self.db.serializer = others[0]
+        a = self.comp(f1, 1)
+        self.comp(f2, a, a, job_id='both')
+        self.assert_cmd_success('make')
+        key = job2userobjectkey('both')
+        self.assertEqual(read_header(self.db, key), others[0])
+        self.assertEqual(get_job_userobject('both', self.db), [f1(1), f1(1)])
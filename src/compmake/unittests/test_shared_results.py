@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+import nose
+
+from compmake import set_compmake_config
+from compmake.context import Context
+from compmake.jobs import get_job, get_job_userobject, set_job_userobject
+from compmake.jobs.job_execution import get_cmd_args_kwargs
+from compmake.jobs.shared_results import (SharedResults, SharedResultsDB,
+                                          SharedSegments, share_result,
+                                          shared_memory_supported, take_shared)
+from compmake.storage import StorageSQLite
+
+from .compmake_test import CompmakeTest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def f(x):
+    return np.ones(100 * 1000) * x
+
+
+def g(a, b):
+    return float(a.sum() + b.sum()), a.flags.writeable
+
+
+def list_segments():
+    if not os.path.isdir('/dev/shm'):
+        return set()
+    return set(os.listdir('/dev/shm'))
+
+
+@istest
+class TestSharedResults(CompmakeTest):
+
+    def mySetUp(self):
+        if np is None or not shared_memory_supported():
+            raise nose.SkipTest
+        set_compmake_config('shared_results', 100)
+
+    def tearDown(self):
+        set_compmake_config('shared_results', 0)
+        SharedResults.available = {}
+        CompmakeTest.tearDown(self)
+
+    def share(self, job_id):
+        self.assert_cmd_success('make %s' % job_id)
+        user_object = get_job_userobject(job_id, self.db)
+        return share_result(job_id, user_object, self.db)
+
+    def testMap(self):
+        a = self.comp(f, 1, job_id='a')
+        b = self.comp(f, 2, job_id='b')
+        self.comp(g, a, b, job_id='g')
+        segments = SharedSegments(max_bytes=10 * 1000 * 1000)
+        segments.add('a', self.share('a'), ['g'])
+        segments.add('b', self.share('b'), ['g'])
+        self.assertEqual(segments.nbytes, 2 * 800 * 1000)
+
+        SharedResults.set_available(segments.descriptions(['a', 'b']))
+        view = take_shared(get_job('g', self.db), self.db)
+        self.assertTrue(isinstance(view, SharedResultsDB))
+        _, args, _ = get_cmd_args_kwargs('g', db=view)
+        self.assertEqual(view.hits, 2)
+        self.assertEqual(g(*args), (300 * 1000.0, False))
+
+        segments.release_unneeded(set(['g']))
+        self.assertEqual(len(segments.segments), 2)
+        segments.release_unneeded(set())
+        self.assertEqual(segments.segments, {})
+        self.assertEqual(segments.nbytes, 0)
+
+    def testChanged(self):
+        a = self.comp(f, 1, job_id='a')
+        self.comp(g, a, a, job_id='g')
+        segments = SharedSegments(max_bytes=10 * 1000 * 1000)
+        segments.add('a', self.share('a'), ['g'])
+        set_job_userobject('a', np.zeros(3), self.db)
+        SharedResults.set_available(segments.descriptions(['a']))
+        db = take_shared(get_job('g', self.db), self.db)
+        self.assertTrue(db is self.db)
+        segments.release_all()
+
+    def testNoTokens(self):
+        a = self.comp(f, 1, job_id='a')
+        self.comp(g, a, a, job_id='g')
+        segments = SharedSegments(max_bytes=10 * 1000 * 1000)
+        segments.add('a', self.share('a'), ['g'])
+        SharedResults.set_available(segments.descriptions(['a']))
+
+        class NoTokens(object):
+            """ A DB without cache_tokens(), like StorageClient. """
+            def __init__(self, db):
+                self.db = db
+
+            def __getitem__(self, key):
+                return self.db[key]
+
+        db = NoTokens(self.db)
+        self.assertEqual(share_result('a', get_job_userobject('a', db), db),
+                         None)
+        self.assertTrue(take_shared(get_job('g', db), db) is db)
+        segments.release_all()
+
+    def testMaxBytes(self):
+        self.comp(f, 1, job_id='a')
+        segments = SharedSegments(max_bytes=1000)
+        segments.add('a', self.share('a'), [])
+        self.assertEqual(segments.segments, {})
+
+    def testSmall(self):
+        self.comp(len, [1, 2], job_id='a')
+        self.assertEqual(self.share('a'), None)
+
+    def testParmake(self):
+        before = list_segments()
+        a = self.comp(f, 1, job_id='a')
+        b = self.comp(f, 2, job_id='b')
+        for i in range(4):
+            self.comp(g, a, b, job_id='g%d' % i)
+        self.assert_cmd_success('parmake n=2')
+        for i in range(4):
+            res = get_job_userobject('g%d' % i, self.db)
+            # (the arrays in shared memory are read-only)
+            self.assertEqual(res, (300 * 1000.0, False))
+        self.assertEqual(list_segments() - before, set())
+
+
+@istest
+class TestSharedResultsSQLite(TestSharedResults):
+    """ The tokens of SQLite are compared in another process. """
+
+    def mySetUp(self):
+        self.db = StorageSQLite(self.root, compress=True)
+        self.cc = Context(db=self.db)
+        TestSharedResults.mySetUp(self)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake.context import Context
+from compmake.jobs import all_jobs, get_job_userobject
+from compmake.storage import StorageFilesystem
+
+from .compmake_test import CompmakeTest
+
+
+def f1(x):
+    return x * 2
+
+
+def f2(a, b):
+    return a + b
+
+
+@istest
+class TestShardedLayout(CompmakeTest):
+
+    def define(self):
+        a = self.comp(f1, 1)
+        b = self.comp(f1, 2)
+        self.comp(f2, a, b, job_id='sum')
+
+    def testSharded(self):
+        root = os.path.join(self.root0, 'sharded')
+        db = StorageFilesystem(root, compress=True, layout='sharded')
+        self.cc = Context(db=db)
+        self.define()
+        self.assert_cmd_success('make')
+        self.assertEqual(get_job_userobject('sum', db), 6)
+        # no record in the top directory
+        self.assertEqual(db.keys(), sorted(set(db.keys())))
+        self.assertFalse([x for x in os.listdir(root) if '.pickle' in x])
+        filename = db.filename_for_key('cm-job-sum')
+        self.assertEqual(len(os.path.relpath(filename, root).split('/')), 3)
+
+        # the layout is remembered
+        db2 = StorageFilesystem(root, compress=True, layout='flat')
+        self.assertEqual(db2.layout, 'sharded')
+        self.assertEqual(set(all_jobs(db2)), set(['f1', 'f1-2', 'sum']))
+
+    def testMigrate(self):
+        self.define()
+        self.assert_cmd_success('make')
+        self.assertEqual(self.db.layout, 'flat')
+        keys = self.db.keys()
+
+        # an old flat DB (no marker) is readable as a sharded one
+        os.remove(os.path.join(self.root, StorageFilesystem.layout_marker))
+        db2 = StorageFilesystem(self.root, compress=True, layout='sharded')
+        self.assertTrue(db2.flat_leftovers)
+        self.assertEqual(db2.keys(), keys)
+        self.assertEqual(get_job_userobject('sum', db2), 6)
+
+        self.assert_cmd_success('migrate_layout layout=sharded')
+        self.assertEqual(self.db.layout, 'sharded')
+        self.assertEqual(self.db.keys(), keys)
+        self.assertFalse([x for x in os.listdir(self.root) if '.pickle' in x])
+        self.assert_cmd_success('make')
+        self.assertJobsEqual('done', ['f1', 'f1-2', 'sum'])
+        self.assertEqual(get_job_userobject('sum', self.db), 6)
+
+        self.assert_cmd_success('migrate_layout layout=flat')
+        self.assertEqual(self.db.layout, 'flat')
+        self.assertEqual(self.db.keys(), keys)
+        self.assertJobsEqual('done', ['f1', 'f1-2', 'sum'])
+        self.assert_cmd_success('clean; make')
+        self.assertEqual(get_job_userobject('sum', self.db), 6)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake.context import Context
+from compmake.jobs import all_jobs, get_job_userobject
+from compmake.scripts.master import load_existing_db
+from compmake.storage import StorageSegments, detect_storage_backend
+
+from .compmake_test import CompmakeTest
+
+
+def f1(x):
+    return x * 2
+
+
+def f2(a, b):
+    return a + b
+
+
+@istest
+class TestSegments(CompmakeTest):
+
+    def mySetUp(self):
+        self.db = StorageSegments(self.root, compress=True)
+        self.cc = Context(db=self.db)
+
+    def testExists(self):
+        db = self.db
+        k = 'ciao'
+        self.assertFalse(k in db)
+        db[k] = {'complex': 123}
+        self.assertTrue(k in db)
+        self.assertEqual(db[k], {'complex': 123})
+        self.assertTrue(db.sizeof(k) > 0)
+        del db[k]
+        self.assertFalse(k in db)
+        self.assertRaises(ValueError, db.__delitem__, k)
+
+    def testOtherProcess(self):
+        db = self.db
+        db2 = StorageSegments(self.root)
+        db['cm-job-a'] = 1
+        self.assertEqual(db2['cm-job-a'], 1)
+        token = db2.cache_token('cm-job-a')
+        db['cm-job-a'] = 2
+        self.assertNotEqual(db2.cache_token('cm-job-a'), token)
+        self.assertEqual(db2['cm-job-a'], 2)
+        del db2['cm-job-a']
+        self.assertFalse('cm-job-a' in db)
+
+    def testIncompleteEntry(self):
+        self.db['cm-job-a'] = 1
+        filename = self.db.segment_filename(self.db.segment)
+        with open(filename, 'ab') as f:
+            f.write(b'\x00\x01\x02')  # as if a writer crashed
+        db2 = StorageSegments(self.root)
+        self.assertEqual(db2.keys(), ['cm-job-a'])
+        db2['cm-job-b'] = 2
+        self.assertEqual(self.db['cm-job-b'], 2)
+        self.assertEqual(self.db['cm-job-a'], 1)
+
+    def testSegmentsAndCompact(self):
+        db = self.db
+        db.max_segment_bytes = 1000
+        for i in range(100):
+            db['cm-job-%d' % (i % 10)] = 'x' * 100 + str(i)
+        del db['cm-job-0']
+        self.assertTrue(len(db.segment_numbers()) > 5)
+        # read from the hints
+        db2 = StorageSegments(self.root)
+        self.assertEqual(db2.index, db.index)
+
+        before, after = db2.compact()
+        self.assertTrue(after < before / 5)
+        self.assertEqual(len(db2.segment_numbers()), 1)
+        # the other one notices
+        self.assertEqual(db['cm-job-9'], 'x' * 100 + '99')
+        self.assertEqual(len(db.keys(prefix='cm-job-')), 9)
+        db['cm-job-1'] = 1
+        self.assertEqual(StorageSegments(self.root)['cm-job-1'], 1)
+
+    def testCompactHints(self):
+        db = self.db
+        db.max_segment_bytes = 1000
+        for i in range(100):
+            db['cm-job-%d' % i] = 'x' * 100 + str(i)
+        old = db.segment_numbers()
+        written = []
+        write_hint = db._write_hint
+
+        def counted(n, entries):
+            written.append(n)
+            write_hint(n, entries)
+
+        db._write_hint = counted
+        db.compact()
+        new = db.segment_numbers()
+        self.assertTrue(len(new) > 5)
+        self.assertEqual(set(old) & set(new), set())
+        # the new segments are not scanned again
+        self.assertEqual(written, new[:-1])
+        # the full new segments keep their hints; the old ones are gone
+        hints = [n for n in old + new
+                 if os.path.exists(db.segment_filename(n, '.hint'))]
+        self.assertEqual(hints, new[:-1])
+        self.assertEqual(StorageSegments(self.root).index, db.index)
+
+    def testLaggingReader(self):
+        db = self.db
+        db.max_segment_bytes = 1000
+        db['cm-job-0'] = 0
+        reader = StorageSegments(self.root)
+        self.assertEqual(reader.keys(), ['cm-job-0'])
+        # the reader is several segments behind when they are compacted
+        for i in range(100):
+            db['cm-job-%d' % (i % 10)] = 'x' * 100 + str(i)
+        del db['cm-job-0']
+        db.compact()
+        db['cm-job-1'] = 1
+        self.assertEqual(reader['cm-job-1'], 1)
+        self.assertFalse('cm-job-0' in reader)
+        self.assertEqual(len(reader.keys(prefix='cm-job-')), 9)
+        # its writes go to the newest segment
+        reader['cm-job-2'] = 2
+        self.assertEqual(reader.segment, db.segment_numbers()[-1])
+        db3 = StorageSegments(self.root)
+        self.assertEqual(db3['cm-job-1'], 1)
+        self.assertEqual(db3['cm-job-2'], 2)
+        self.assertEqual(db3['cm-job-3'], 'x' * 100 + '93')
+        self.assertEqual(db3.index, reader.index)
+        self.assertEqual(db['cm-job-2'], 2)
+
+    def testMake(self):
+        a = self.comp(f1, 1)
+        b = self.comp(f1, 2)
+        self.comp(f2, a, b, job_id='sum')
+        self.assert_cmd_success('make')
+        self.assertEqual(set(all_jobs(self.db)), set(['f1', 'f1-2', 'sum']))
+
+        self.assertEqual(detect_storage_backend(self.root), 'segments')
+        self.assertTrue(os.path.exists(self.db.segdir))
+        self.assert_cmd_success('compact')
+        # read again from disk
+        context = load_existing_db(self.root)
+        db2 = context.get_compmake_db()
+        self.assertTrue(isinstance(db2.db, StorageSegments))
+        self.assertEqual(get_job_userobject('sum', db2), 6)
+        self.assert_cmd_success_script('ls')
+
+    def testParmake(self):
+        for i in range(4):
+            self.comp(f1, i)
+        self.assert_cmd_success('parmake n=2')
+        self.assert_cmd_success('clean;parmake n=2 new_process=1')
+        self.assertJobsEqual('done', ['f1', 'f1-2', 'f1-3', 'f1-4'])
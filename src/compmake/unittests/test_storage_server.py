@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.context import Context
+from compmake.exceptions import CompmakeDBError
+from compmake.jobs import get_job_userobject
+from compmake.storage import (StorageClient, StorageServer, open_storage,
+                              server_address)
+
+from .compmake_test import CompmakeTest
+
+
+def g(x):
+    return x * 2
+
+
+def h(*args):
+    return sum(args)
+
+
+@istest
+class TestStorageServer(CompmakeTest):
+
+    def mySetUp(self):
+        set_compmake_config('storage_server_connect', True)
+        self.server = StorageServer(self.db)
+        self.thread = self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        set_compmake_config('storage_server_connect', False)
+        CompmakeTest.tearDown(self)
+
+    def testProtocol(self):
+        self.assertEqual(self.server.address, server_address(self.root))
+        self.assertEqual(os.path.dirname(self.server.address),
+                         os.path.realpath(self.root))
+        self.assertEqual(os.stat(self.server.address).st_mode & 0o077, 0)
+        db = open_storage(self.root)
+        self.assertTrue(isinstance(db, StorageClient))
+        self.assertEqual(db.basepath, self.db.basepath)
+
+        db['cm-job-a'] = {'a': 1}
+        self.assertEqual(db['cm-job-a'], {'a': 1})
+        # written to the DB of the server
+        self.assertEqual(self.db['cm-job-a'], {'a': 1})
+        self.assertTrue('cm-job-a' in db)
+        self.assertFalse('cm-job-b' in db)
+        self.assertEqual(db.keys(prefix='cm-job-'), ['cm-job-a'])
+        self.assertEqual(db.sizeof('cm-job-a'), self.db.sizeof('cm-job-a'))
+        self.assertEqual(db.get_many(['cm-job-a', 'cm-job-b']),
+                         {'cm-job-a': {'a': 1}})
+        self.assertEqual(db.contains_many(['cm-job-a', 'cm-job-b']),
+                         set(['cm-job-a']))
+
+        db['cm-job-a'] = 2
+        self.assertEqual(db['cm-job-a'], 2)
+        self.assertTrue(db.get_stats()['hits'] > 0)
+        del db['cm-job-a']
+        self.assertFalse('cm-job-a' in db)
+        self.assertRaises(ValueError, db.__delitem__, 'cm-job-a')
+
+        # the socket is opened again by the copies
+        db2 = pickle.loads(pickle.dumps(db))
+        db2['cm-job-c'] = 3
+        self.assertEqual(db['cm-job-c'], 3)
+        db.reopen_after_fork()
+        self.assertEqual(db['cm-job-c'], 3)
+
+    def testParmake(self):
+        self.cc = Context(db=self.root)
+        self.assertTrue(isinstance(self.cc.get_compmake_db(), StorageClient))
+        res = [self.comp(g, i) for i in range(5)]
+        self.comp(h, *res)
+        self.assert_cmd_success('parmake n=2')
+        self.assertEqual(get_job_userobject('h', self.db), 20)
+        self.assert_cmd_success('ls; stats')
+        self.assertEqual(len(self.get_jobs('done')), 6)
+
+    def testNoServer(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.server.address))
+        db = open_storage(self.root)
+        self.assertFalse(isinstance(db, StorageClient))
+        # (tearDown stops it again)
+        self.thread = self.server.start()
+
+    def testNotASocket(self):
+        self.server.shutdown()
+        self.thread.join()
+        # (for example, planted by another user)
+        with open(self.server.address, 'w') as f:
+            f.write('x')
+        self.assertRaises(CompmakeDBError, StorageClient,
+                          self.server.address)
+        self.assertFalse(isinstance(open_storage(self.root), StorageClient))
+        self.thread = self.server.start()
+
+    def testLongPath(self):
+        dirname = os.path.join(self.root0, 'x' * 120)
+        address = server_address(dirname)
+        self.assertFalse(address.startswith(os.path.realpath(dirname)))
+        st = os.stat(os.path.dirname(address))
+        self.assertEqual(st.st_uid, os.getuid())
+        self.assertEqual(st.st_mode & 0o777, 0o700)
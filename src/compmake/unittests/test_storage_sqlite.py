@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+
+from nose.tools import istest
+
+from compmake.context import Context
+from compmake.jobs import all_jobs
+from compmake.scripts.master import load_existing_db
+from compmake.storage import StorageSQLite, detect_storage_backend
+
+from .compmake_test import CompmakeTest
+
+
+def f1(x):
+    return x * 2
+
+
+def f2(a, b):
+    return a + b
+
+
+@istest
+class TestSQLite(CompmakeTest):
+
+    def mySetUp(self):
+        self.db = StorageSQLite(self.root, compress=True)
+        self.cc = Context(db=self.db)
+
+    def testExists(self):
+        db = self.db
+        k = 'ciao'
+        self.assertFalse(k in db)
+        db[k] = {'complex': 123}
+        self.assertTrue(k in db)
+        self.assertEqual(db[k], {'complex': 123})
+        self.assertTrue(db.sizeof(k) > 0)
+        del db[k]
+        self.assertFalse(k in db)
+
+    def testPrefix(self):
+        db = self.db
+        for k in ['cm-job-a', 'cm-job-b', 'cm-cache-a', 'cm-jobs']:
+            db[k] = 1
+        self.assertEqual(db.keys(prefix='cm-job-'), ['cm-job-a', 'cm-job-b'])
+        self.assertEqual(len(db.keys()), 4)
+
+    def testCacheToken(self):
+        db = self.db
+        db['a'] = 1
+        db['b'] = 2
+        self.assertEqual(db.cache_token('c'), None)
+        # another connection sees the same tokens
+        db2 = StorageSQLite(self.root, compress=True)
+        tokens = db.cache_tokens(['a', 'b', 'c'])
+        self.assertEqual(set(tokens), set(['a', 'b']))
+        self.assertEqual(db2.cache_tokens(['a', 'b', 'c']), tokens)
+        self.assertEqual(db2.cache_token('a'), tokens['a'][0])
+        # and its writes change only the token of the record written
+        db2['a'] = 1
+        self.assertNotEqual(db.cache_token('a'), tokens['a'][0])
+        self.assertEqual(db.cache_token('b'), tokens['b'][0])
+        # also if written again after being deleted
+        token = db.cache_token('b')
+        del db2['b']
+        db2['b'] = 2
+        self.assertNotEqual(db.cache_token('b'), token)
+
+    def testMake(self):
+        a = self.comp(f1, 1)
+        b = self.comp(f1, 2)
+        self.comp(f2, a, b, job_id='sum')
+        self.assert_cmd_success('make')
+        self.assertEqual(set(all_jobs(self.db)), set(['f1', 'f1-2', 'sum']))
+
+        self.assertEqual(detect_storage_backend(self.root), 'sqlite')
+        self.assertTrue(os.path.exists(self.db.filename))
+        # read again from disk
+        context = load_existing_db(self.root)
+        db2 = context.get_compmake_db()
+        self.assertTrue(isinstance(db2.db, StorageSQLite))
+        from compmake.jobs import get_job_userobject
+        self.assertEqual(get_job_userobject('sum', db2), 6)
+        self.assert_cmd_success_script('ls')
+
+    def testParmake(self):
+        for i in range(4):
+            self.comp(f1, i)
+        self.assert_cmd_success('parmake n=2')
+        self.assert_cmd_success('clean;parmake n=2 new_process=1')
+        self.assertJobsEqual('done', ['f1', 'f1-2', 'f1-3', 'f1-4'])
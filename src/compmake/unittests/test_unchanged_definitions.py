@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+
+from nose.tools import istest
+
+from compmake import Context, get_compmake_config, set_compmake_config
+from compmake.jobs.storage import job2jobargskey, job2key
+
+from .compmake_test import CompmakeTest
+
+
+def f(*args):
+    return len(args)
+
+
+@istest
+class TestUnchangedDefinitions(CompmakeTest):
+
+    def mySetUp(self):
+        self.define(2)
+        self.assertEqual(self.cc.pop_definition_counts(), {'new': 4})
+        self.assert_cmd_success('make')
+
+    def define(self, value):
+        self.cc = Context(db=self.db)
+        a = self.comp(f, job_id='a')
+        b = self.comp(f, a, job_id='b')
+        self.comp(f, a, b, value, job_id='c')
+        self.comp(f, b, job_id='d')
+
+    def tokens(self):
+        keys = []
+        for job_id in ['a', 'b', 'c', 'd']:
+            keys.extend([job2key(job_id), job2jobargskey(job_id)])
+        return self.db.cache_tokens(keys)
+
+    def testUnchanged(self):
+        before = self.tokens()
+        self.define(2)
+        self.assertEqual(self.cc.pop_definition_counts(), {'unchanged': 4})
+        self.assertEqual(self.tokens(), before)
+        self.assertJobsEqual('done', ['a', 'b', 'c', 'd'])
+
+    def testReadsOnce(self):
+        reads = Counter()
+        getitem = self.db.__class__.__getitem__
+        contains = self.db.__class__.__contains__
+
+        class Counting(self.db.__class__):
+            def __getitem__(self, key):
+                reads['get', key] += 1
+                return getitem(self, key)
+
+            def __contains__(self, key):
+                reads['exists', key] += 1
+                return contains(self, key)
+
+        self.db.__class__ = Counting
+        # (without the MemoryCache, which would hide the reads)
+        memory_cache = get_compmake_config('memory_cache')
+        set_compmake_config('memory_cache', 0)
+        try:
+            self.define(2)
+        finally:
+            set_compmake_config('memory_cache', memory_cache)
+        # the stored definition is read (and checked) once per job
+        # (c and d are not the child of another job, whose definition
+        # would read them again)
+        for job_id in ['c', 'd']:
+            self.assertEqual(reads['get', job2key(job_id)], 1)
+            self.assertEqual(reads['exists', job2key(job_id)], 1)
+        for job_id in ['a', 'b', 'c', 'd']:
+            self.assertEqual(reads['exists', job2jobargskey(job_id)], 1)
+
+    def testChanged(self):
+        before = self.tokens()
+        self.define(3)
+        self.assertEqual(self.cc.pop_definition_counts(),
+                         {'unchanged': 3, 'changed': 1})
+        after = self.tokens()
+        changed = set(k for k in before if before[k] != after[k])
+        # (the job records the digest of the arguments)
+        self.assertEqual(changed, set([job2key('c'), job2jobargskey('c')]))
+
+    def testBatch(self):
+        before = self.tokens()
+        self.cc = Context(db=self.db)
+        with self.cc.batch_definitions():
+            self.define(2)
+        self.assertEqual(self.tokens(), before)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from nose.tools import istest
+
+from compmake import set_compmake_config
+from compmake.jobs import get_job_cache, set_job_cache
+from compmake.jobs.uptodate import CacheQueryDB
+from compmake.structures import Cache
+
+from .compmake_test import CompmakeTest
+
+
+def f(*args):
+    return len(args)
+
+
+def fail(*args):
+    raise ValueError('failed')
+
+
+def gen(context):
+    a = context.comp(f)
+    context.comp(f, a)
+
+
+def up_to_date_recursive(cq, job_id):
+    """ The recursive definition, for comparison. """
+    cache = cq.get_job_cache(job_id)
+    timestamp = cache.timestamp
+    if cache.state == Cache.NOT_STARTED:
+        return False, 'Not started', timestamp
+    if timestamp == Cache.TIMESTAMP_TO_REMAKE:
+        return False, 'Marked invalid', timestamp
+    for child in cq.direct_children(job_id):
+        child_up, _, child_timestamp = up_to_date_recursive(cq, child)
+        if not child_up:
+            return False, 'At least: Dep %r not up to date.' % child, timestamp
+        if child_timestamp > timestamp:
+            return False, 'At least: Dep %r have been updated.' % child, timestamp
+    defined_by = list(cq.get_job(job_id).defined_by)
+    defined_by.remove('root')
+    for defby in defined_by:
+        if not up_to_date_recursive(cq, defby)[0]:
+            return False, 'Definer %r not up to date.' % defby, timestamp
+    if cache.state == Cache.FAILED:
+        return False, 'Failed', timestamp
+    return True, '', timestamp
+
+
+@istest
+class TestUpToDateMany(CompmakeTest):
+
+    def mySetUp(self):
+        a = self.comp(f, job_id='a')
+        b = self.comp(f, a, job_id='b')
+        c = self.comp(f, a, b, job_id='c')
+        d = self.cc.comp_dynamic(gen, job_id='d')
+        x = self.comp(fail, c, job_id='x')
+        self.comp(f, c, d, job_id='e')
+        self.comp(f, x, job_id='y')
+        self.comp(f, job_id='z')
+
+    def check_same(self):
+        cq = CacheQueryDB(self.db)
+        jobs = sorted(cq.all_jobs())
+        cq.up_to_date_many(jobs)
+        reference = CacheQueryDB(self.db)
+        for job_id in jobs:
+            self.assertEqual(cq.up_to_date(job_id),
+                             up_to_date_recursive(reference, job_id))
+        return cq
+
+    def testSame(self):
+        self.check_same()
+        self.assert_cmd_fail('make recurse=1')
+        cq = self.check_same()
+        self.assertEqual(cq.up_to_date('x')[1], 'Failed')
+        # (y is blocked)
+        self.assertEqual(cq.up_to_date('y')[0], False)
+        self.assertEqual(cq.up_to_date('e')[0], True)
+
+        self.assert_cmd_success('invalidate a')
+        self.assert_cmd_success('clean d')
+        cq = self.check_same()
+        self.assertEqual(cq.up_to_date('a')[1], 'Marked invalid')
+        self.assertEqual(cq.up_to_date('d')[1], 'Not started')
+
+    def testUpdated(self):
+        set_compmake_config('early_cutoff', True)
+        try:
+            self.assert_cmd_success('make a b')
+        finally:
+            set_compmake_config('early_cutoff', False)
+        cache = get_job_cache('a', self.db)
+        cache.timestamp = get_job_cache('b', self.db).timestamp + 1
+        set_job_cache('a', cache, self.db)
+        cq = self.check_same()
+        self.assertEqual(cq.up_to_date('b')[1],
+                         "At least: Dep 'a' have been updated.")
+        set_compmake_config('early_cutoff', True)
+        try:
+            # the result of a is the same as the one b used
+            self.assertEqual(CacheQueryDB(self.db).up_to_date('b')[0], True)
+        finally:
+            set_compmake_config('early_cutoff', False)
+
+    def testAliases(self):
+        self.assert_cmd_success('make b')
+        self.assertJobsEqual('uptodate', ['a', 'b'])
+        self.assertJobsEqual('ready', ['a', 'b', 'c', 'd', 'z'])
+
+
+@istest
+class TestUpToDateChain(CompmakeTest):
+
+    def testDeepChain(self):
+        n = 3000
+        with self.cc.batch_definitions():
+            prev = self.comp(f, job_id='chain0')
+            for i in range(1, n):
+                prev = self.comp(f, prev, job_id='chain%d' % i)
+        for i in range(n):
+            cache = Cache(Cache.DONE)
+            cache.timestamp = 1000.0 + i
+            set_job_cache('chain%d' % i, cache, self.db)
+        top = 'chain%d' % (n - 1)
+        cq = CacheQueryDB(self.db)
+        self.assertEqual(cq.up_to_date(top), (True, '', 1000.0 + n - 1))
+
+        cache = get_job_cache('chain0', self.db)
+        cache.timestamp = Cache.TIMESTAMP_TO_REMAKE
+        set_job_cache('chain0', cache, self.db)
+        cq = CacheQueryDB(self.db)
+        self.assertEqual(cq.up_to_date(top)[1],
+                         "At least: Dep 'chain%d' not up to date." % (n - 2))
+        todo, done, ready = cq.list_todo_targets([top])
+        self.assertEqual(len(todo), n)
+        self.assertEqual(done, set())
+        self.assertEqual(ready, set(['chain0']))
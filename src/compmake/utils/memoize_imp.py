@@ -54,7 +54,12 @@ class memoized_reset(object):
         """Support instance methods."""
         fn = functools.partial(self.__call__, obj)
         fn.reset = self._reset
+        fn.prime = functools.partial(self._prime, obj)
         return fn
 
     def _reset(self):
         self.cache = {}
+
+    def _prime(self, obj, args, value):
+        """ Sets the value returned for the arguments ``args``. """
+        self.cache[(obj,) + tuple(args)] = value
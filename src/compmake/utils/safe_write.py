@@ -9,6 +9,8 @@ from compmake import logger
 __all__ = [
     'safe_write',
     'safe_read',
+    'fsync_file',
+    'fsync_dir',
 ]
 
 
@@ -16,15 +18,37 @@ def is_gzip_filename(filename):
     return '.gz' in filename
 
 
+def fsync_file(filename):
+    """ Makes sure the content of the file is on disk. """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(dirname):
+    """ Makes sure the entries of the directory (files created,
+        renamed, removed) are on disk. Does nothing on Windows. """
+    if os.name == 'nt':
+        return
+    fsync_file(dirname or '.')
+
+
 @contextmanager
-def safe_write(filename, mode='wb', compresslevel=5):
+def safe_write(filename, mode='wb', compresslevel=5, compress=None,
+               fsync=False):
     """ 
         Makes atomic writes by writing to a temp filename. 
-        Also if the filename ends in ".gz", writes to a compressed stream.
+        Also if the filename ends in ".gz", writes to a compressed stream
+        (unless ``compress`` is False).
         Yields a file descriptor.
         
         It is thread safe because it renames the file.
         If there is an error, the file will be removed if it exists.
+
+        If ``fsync`` is True, the file is on disk before it is renamed,
+        and the rename is on disk when this returns.
     """
     dirname = os.path.dirname(filename)
     if dirname:
@@ -41,7 +65,9 @@ def safe_write(filename, mode='wb', compresslevel=5):
                 #
     tmp_filename = '%s.tmp.%s' % (filename, os.getpid())
     try:
-        if is_gzip_filename(filename):
+        if compress is None:
+            compress = is_gzip_filename(filename)
+        if compress:
             fopen = lambda fname, fmode: gzip.open(filename=fname, mode=fmode,
                                                    compresslevel=compresslevel)
         else:
@@ -50,6 +76,8 @@ def safe_write(filename, mode='wb', compresslevel=5):
         with fopen(tmp_filename, mode) as f:
             yield f
         f.close()
+        if fsync:
+            fsync_file(tmp_filename)
 
         # if os.path.exists(filename):
         # msg = 'Race condition for writing to %r.' % filename
@@ -58,6 +86,8 @@ def safe_write(filename, mode='wb', compresslevel=5):
         # On Unix, if dst exists and is a file, it will be replaced silently
         #  if the user has permission.
         os.rename(tmp_filename, filename)
+        if fsync:
+            fsync_dir(dirname)
     except:
         if os.path.exists(tmp_filename):
             os.unlink(tmp_filename)
@@ -7,18 +7,24 @@ import time
 
 __all__ = [
     'TimeTrack',
+    'cpu_clock',
 ]
 
+try:
+    cpu_clock = time.process_time
+except AttributeError:  # Python 2 (time.clock() was removed in 3.8)
+    cpu_clock = time.clock
+
 
 class TimeTrack(object):
     def __init__(self, what=None):
         self.t0 = time.time()
-        self.c0 = time.clock()
+        self.c0 = cpu_clock()
         self.what = what
 
     def show(self, stream=sys.stdout, min_td=0.001):  # @UnusedVariable
         self.t1 = time.time()
-        self.c1 = time.clock()
+        self.c1 = cpu_clock()
         self.cd = self.c1 - self.c0
         self.td = self.t1 - self.t0
 